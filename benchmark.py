@@ -0,0 +1,602 @@
+# Нагрузочный тест бота: локальные заглушки Telegram Bot API и OpenWeatherMap,
+# бот запускается отдельным процессом и направляется на них через переменные окружения.
+#
+# Пример:
+#   python benchmark.py --users 200 --reminders 5000 --duration 120 --output results.json
+#
+# Замер запуска (импорт модуля и время до первого getUpdates на новой и уже готовой базе):
+#   python benchmark.py --startup-runs 10
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Фальшивый токен: формат должен пройти проверку в telebot
+FAKE_BOT_TOKEN = '123456:BENCHMARK'
+
+# Города, которые «пишут» пользователи
+BENCHMARK_CITIES = ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань', 'Самара',
+                    'Омск', 'Челябинск', 'Ростов-на-Дону', 'Уфа', 'Пермь', 'Воронеж', 'Волгоград',
+                    'Краснодар', 'Томск', 'Кемерово', 'Прокопьевск', 'London', 'Paris', 'Berlin']
+
+# Скрипт бота, который запускает тест
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+# Первый chat_id для получателей напоминаний (интерактивные пользователи - с 1)
+REMINDER_CHAT_BASE = 10_000_000
+
+
+# Функция для вычисления перцентиля (метод ближайшего ранга)
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+# Функция для сводки по списку задержек (в миллисекундах)
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 1) if values else None,
+        'p95_ms': round(percentile(values, 95) * 1000, 1) if values else None,
+        'p99_ms': round(percentile(values, 99) * 1000, 1) if values else None,
+        'max_ms': round(max(values) * 1000, 1) if values else None,
+    }
+
+
+# Функция для чтения параметров запроса (query string, form или JSON)
+def read_params(handler):
+    params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(handler.path).query))
+    length = int(handler.headers.get('Content-Length') or 0)
+    raw = handler.rfile.read(length) if length else b''
+    if raw:
+        if 'json' in handler.headers.get('Content-Type', ''):
+            params.update(json.loads(raw))
+        else:
+            params.update(dict(urllib.parse.parse_qsl(raw.decode('utf-8'))))
+    return params
+
+
+# Функция для отправки JSON-ответа
+def send_json(handler, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    handler.send_response(status)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+# Заглушка Telegram Bot API: отдаёт обновления через getUpdates и записывает все вызовы бота
+class FakeTelegram:
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.updates = []
+        self.next_update_id = 1
+        self.calls = {}
+        self.flood_errors = 0
+        self.condition = threading.Condition()
+        # Подписчики на исходящие вызовы: функция(время, метод, параметры)
+        self.listeners = []
+        # Выставляется при поступлении запроса getUpdates (для замера запуска бота)
+        self.polling = threading.Event()
+        self.server = None
+
+    # Поставить обновление в очередь getUpdates; возвращает update_id
+    def push_update(self, update):
+        with self.condition:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.condition.notify_all()
+            return update['update_id']
+
+    def message_update(self, chat_id, text):
+        return {'message': {'message_id': self.next_update_id, 'date': int(time.time()), 'text': text,
+                            'chat': {'id': chat_id, 'type': 'private'},
+                            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'}}}
+
+    def callback_update(self, chat_id, data, message_id=1):
+        return {'callback_query': {'id': str(self.next_update_id), 'chat_instance': str(chat_id), 'data': data,
+                                   'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'},
+                                   'message': {'message_id': message_id, 'date': int(time.time()), 'text': '-',
+                                               'chat': {'id': chat_id, 'type': 'private'}}}}
+
+    # Ответ на getUpdates: ждём обновлений не дольше timeout (long polling)
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), 1.0)
+        with self.condition:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            updates, self.updates = self.updates, []
+        delivered_at = time.monotonic()
+        for listener in self.listeners:
+            listener(delivered_at, 'getUpdates', {'updates': updates})
+        return updates
+
+    def handle(self, handler):
+        params = read_params(handler)
+        method = urllib.parse.urlparse(handler.path).path.rsplit('/', 1)[-1]
+
+        if method == 'getUpdates':
+            self.polling.set()
+            return send_json(handler, 200, {'ok': True, 'result': self.get_updates(params)})
+
+        if self.latency:
+            time.sleep(self.latency)
+        with self.condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            flood = method == 'sendMessage' and random.random() < self.error_rate
+            if flood:
+                self.flood_errors += 1
+        if flood:
+            return send_json(handler, 429, {'ok': False, 'error_code': 429,
+                                            'description': 'Too Many Requests: retry after 1',
+                                            'parameters': {'retry_after': 1}})
+
+        now = time.monotonic()
+        for listener in self.listeners:
+            listener(now, method, params)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'WeatherBot', 'username': 'weather_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id') or 0)
+            result = {'message_id': random.randint(1, 1_000_000), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        else:
+            result = True
+        send_json(handler, 200, {'ok': True, 'result': result})
+
+    def start(self):
+        self.server = start_stub_server(self.handle)
+        return self.server.server_port
+
+
+# Заглушка OpenWeatherMap: геокодинг, текущая погода и групповой запрос
+class FakeOpenWeatherMap:
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = {}
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    # Детерминированные «координаты» и id города по названию
+    @staticmethod
+    def city_point(name):
+        seed = sum(ord(char) * (index + 1) for index, char in enumerate(name.lower())) % 100000
+        return 40 + seed / 5000, 20 + seed / 2500
+
+    @staticmethod
+    def weather_payload(lat, lon, city_id):
+        return {'id': city_id, 'name': 'Stub', 'coord': {'lat': lat, 'lon': lon},
+                'main': {'temp': 20.5, 'feels_like': 19.0, 'humidity': 50, 'pressure': 1012},
+                'wind': {'speed': 3.2}, 'weather': [{'main': 'Clear', 'description': 'ясно'}]}
+
+    # Прогноз на 5 дней с шагом 3 часа (40 шагов) от ближайшего кратного трём часу
+    @staticmethod
+    def forecast_payload(lat, lon):
+        start = int(time.time()) // 10800 * 10800 + 10800
+        items = [{'dt': start + step * 10800,
+                  'main': {'temp': round(10 + 8 * ((step % 8) - 4) / 4 + lat % 5, 2)},
+                  'weather': [{'id': (800, 801, 500, 803)[step % 4], 'main': 'Clear', 'description': 'ясно'}]}
+                 for step in range(40)]
+        return {'cnt': len(items), 'list': items, 'city': {'name': 'Stub', 'country': 'RU', 'timezone': 10800}}
+
+    def handle(self, handler):
+        url = urllib.parse.urlparse(handler.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[url.path] = self.calls.get(url.path, 0) + 1
+            failed = random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if failed:
+            return send_json(handler, 500, {'cod': 500, 'message': 'stub error'})
+
+        if url.path == '/geo/1.0/direct':
+            name = params.get('q', '')
+            lat, lon = self.city_point(name)
+            send_json(handler, 200, [{'name': name, 'lat': lat, 'lon': lon, 'country': 'RU',
+                                      'local_names': {'ru': name}}])
+        elif url.path == '/data/2.5/weather':
+            lat, lon = float(params['lat']), float(params['lon'])
+            send_json(handler, 200, self.weather_payload(lat, lon, int(lat * 1000) * 100000 + int(lon * 1000)))
+        elif url.path == '/data/2.5/forecast':
+            send_json(handler, 200, self.forecast_payload(float(params['lat']), float(params['lon'])))
+        elif url.path == '/data/2.5/group':
+            ids = [int(city_id) for city_id in params.get('id', '').split(',') if city_id]
+            items = [self.weather_payload(city_id // 100000 / 1000, city_id % 100000 / 1000, city_id)
+                     for city_id in ids]
+            send_json(handler, 200, {'cnt': len(items), 'list': items})
+        else:
+            send_json(handler, 404, {'cod': 404, 'message': 'not found'})
+
+    def start(self):
+        self.server = start_stub_server(self.handle)
+        return self.server.server_port
+
+
+# Функция для запуска HTTP-заглушки в фоновом потоке
+def start_stub_server(handle):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            handle(self)
+
+        def do_POST(self):
+            handle(self)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Функция для заполнения базы пользователями и напоминаниями
+def seed_database(db_path, users, reminders, reminder_cities, reminder_time):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            city TEXT,
+            reminder_time TEXT,
+            days TEXT DEFAULT 'everyday',
+            is_active BOOLEAN DEFAULT 1
+        )
+    ''')
+    cities = BENCHMARK_CITIES[:reminder_cities] if reminder_cities <= len(BENCHMARK_CITIES) else \
+        BENCHMARK_CITIES + [f'Город {index}' for index in range(reminder_cities - len(BENCHMARK_CITIES))]
+
+    # У каждого интерактивного пользователя уже есть одно напоминание на ночь
+    rows = [(user_id, user_id, random.choice(BENCHMARK_CITIES), '03:33', 'everyday')
+            for user_id in range(1, users + 1)]
+    # Волна напоминаний на одну минуту
+    rows += [(REMINDER_CHAT_BASE + index, REMINDER_CHAT_BASE + index, cities[index % len(cities)],
+              reminder_time, 'everyday') for index in range(reminders)]
+    conn.executemany('INSERT INTO reminders (user_id, chat_id, city, reminder_time, days) VALUES (?, ?, ?, ?, ?)',
+                     rows)
+    conn.commit()
+    conn.close()
+
+
+# Шаги сценария пользователя: ('text', текст) или ('press', функция выбора кнопки по тексту)
+def build_conversation():
+    city = random.choice(BENCHMARK_CITIES)
+    popular = random.choice(['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург'])
+    return [
+        ('city_text', 'text', city),
+        ('popular_menu', 'text', '🌟 Популярные города'),
+        ('city_button', 'press', lambda text: text == popular),
+        ('set_reminder', 'press', lambda text: text.startswith('⏰')),
+        ('time_button', 'press', lambda text: text == '07:00'),
+        ('day_button', 'press', lambda text: text == 'Пн'),
+        ('my_reminders', 'text', '📋 Мои напоминания'),
+        ('delete_button', 'press', lambda text: text.startswith('❌')),
+    ]
+
+
+# Интерактивные пользователи: каждый ждёт ответа бота, прежде чем сделать следующий шаг
+class InteractiveLoad:
+    # Через сколько после первого ответа шаг считается завершённым, если клавиатуры нет
+    SETTLE = 0.3
+    # Сколько ждать ответа бота на шаг
+    STEP_TIMEOUT = 15
+
+    def __init__(self, telegram, users, think_time):
+        self.telegram = telegram
+        self.users = users
+        self.think_time = think_time
+        self.lock = threading.Lock()
+        # chat_id -> состояние пользователя
+        self.state = {}
+        self.pending = {}
+        self.latencies = {}
+        self.timeouts = 0
+        self.completed = 0
+        self.stopped = threading.Event()
+        telegram.listeners.append(self.on_call)
+
+    def on_call(self, now, method, params):
+        with self.lock:
+            if method == 'getUpdates':
+                for update in params['updates']:
+                    chat_id = self.update_chat_id(update)
+                    user = self.state.get(chat_id)
+                    if user is not None and user['update_id'] == update['update_id']:
+                        user['delivered_at'] = now
+                return
+
+            if method not in ('sendMessage', 'editMessageText'):
+                return
+            user = self.state.get(int(params.get('chat_id') or 0))
+            if user is None or user['delivered_at'] is None:
+                return
+
+            if user['first_reply_at'] is None:
+                user['first_reply_at'] = now
+                self.latencies.setdefault(user['step_name'], []).append(now - user['delivered_at'])
+            markup = params.get('reply_markup')
+            if markup:
+                markup = json.loads(markup) if isinstance(markup, str) else markup
+                if 'inline_keyboard' in markup:
+                    user['keyboard'] = [button for row in markup['inline_keyboard'] for button in row]
+                    user['has_keyboard'] = True
+
+    @staticmethod
+    def update_chat_id(update):
+        if 'message' in update:
+            return update['message']['chat']['id']
+        return update['callback_query']['message']['chat']['id']
+
+    # Отправить следующий шаг сценария пользователя
+    def send_step(self, chat_id, user):
+        if not user['steps']:
+            user['steps'] = build_conversation()
+        step_name, kind, value = user['steps'].pop(0)
+
+        if kind == 'text':
+            update = self.telegram.message_update(chat_id, value)
+        else:
+            button = next((button for button in user['keyboard'] if value(button['text'])), None)
+            if button is None:
+                # Нужной кнопки нет - начинаем сценарий заново
+                user['steps'] = []
+                return
+            update = self.telegram.callback_update(chat_id, button['callback_data'])
+
+        user.update(step_name=step_name, sent_at=time.monotonic(), delivered_at=None, first_reply_at=None,
+                    has_keyboard=False)
+        user['update_id'] = self.telegram.push_update(update)
+
+    def run(self):
+        for chat_id in range(1, self.users + 1):
+            self.state[chat_id] = {'steps': [], 'keyboard': [], 'update_id': None, 'next_at': 0,
+                                   'sent_at': None, 'delivered_at': None, 'first_reply_at': None,
+                                   'has_keyboard': False, 'step_name': None}
+
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            with self.lock:
+                for chat_id, user in self.state.items():
+                    if user['update_id'] is not None:
+                        done = user['first_reply_at'] is not None and (
+                            user['has_keyboard'] or now - user['first_reply_at'] > self.SETTLE)
+                        if done:
+                            self.completed += 1
+                        elif now - user['sent_at'] > self.STEP_TIMEOUT:
+                            self.timeouts += 1
+                            user['steps'] = []
+                        else:
+                            continue
+                        user['update_id'] = None
+                        user['next_at'] = now + random.uniform(0, 2 * self.think_time)
+                    if now >= user['next_at']:
+                        self.send_step(chat_id, user)
+            time.sleep(0.01)
+
+
+# Получатели напоминаний: считаем задержку доставки относительно запланированной минуты
+class ReminderTracker:
+    def __init__(self, telegram, expected, due_at):
+        self.expected = expected
+        self.due_at = due_at
+        self.lags = []
+        self.seen = set()
+        self.lock = threading.Lock()
+        telegram.listeners.append(self.on_call)
+
+    def on_call(self, now, method, params):
+        if method != 'sendMessage':
+            return
+        chat_id = int(params.get('chat_id') or 0)
+        if chat_id < REMINDER_CHAT_BASE or not params.get('text', '').startswith('🔔'):
+            return
+        with self.lock:
+            if chat_id not in self.seen:
+                self.seen.add(chat_id)
+                self.lags.append(time.time() - self.due_at)
+
+    def done(self):
+        return len(self.seen) >= self.expected
+
+
+# Функция для переменных окружения процесса бота (адреса заглушек и база)
+def bot_environment(telegram_port, weather_port, db_path, runtime, extra=()):
+    env = dict(os.environ, BOT_TOKEN=FAKE_BOT_TOKEN, WEATHER_API_KEY='benchmark',
+               TELEGRAM_API_URL=f'http://127.0.0.1:{telegram_port}',
+               WEATHER_API_BASE_URL=f'http://127.0.0.1:{weather_port}',
+               DB_PATH=db_path, BOT_RUNTIME=runtime, PYTHONUNBUFFERED='1',
+               # Заглушка OpenWeatherMap не ограничивает запросы; бюджет можно задать через --env
+               WEATHER_QUOTA_PER_MINUTE='0')
+    env.pop('WEBHOOK_URL', None)
+    for item in extra:
+        name, _, value = item.partition('=')
+        env[name] = value
+    return env
+
+
+# Функция для запуска бота отдельным процессом (script - другая сборка бота, например для replay.py)
+def start_bot(env, workdir, log, script=BOT_SCRIPT):
+    return subprocess.Popen([sys.executable, script], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+# Функция для остановки процесса бота
+def stop_bot(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+# Замер запуска: время импорта модуля бота и время от старта процесса до первого запроса getUpdates.
+# Холодный запуск - на новой базе (с миграциями схемы), тёплый - на уже созданной.
+def measure_startup(args):
+    telegram = FakeTelegram()
+    weather = FakeOpenWeatherMap()
+    telegram_port = telegram.start()
+    weather_port = weather.start()
+    workdir = tempfile.mkdtemp(prefix='weather-bot-startup-')
+    db_path = os.path.join(workdir, 'reminders.db')
+    env = bot_environment(telegram_port, weather_port, db_path, args.runtime, args.env)
+    bot_log = open(args.bot_log or os.path.join(workdir, 'bot.log'), 'w')
+
+    import_code = ('import sys, time; sys.path.insert(0, sys.argv[1]); started = time.perf_counter(); '
+                   'import bot; print(time.perf_counter() - started)')
+    import_times = []
+    first_poll = {'cold': [], 'warm': []}
+    try:
+        for _ in range(args.startup_runs):
+            output = subprocess.run([sys.executable, '-c', import_code, os.path.dirname(BOT_SCRIPT)], cwd=workdir,
+                                    env=env, capture_output=True, text=True, check=True).stdout
+            import_times.append(float(output.strip().splitlines()[-1]))
+
+            for kind in ('cold', 'warm'):
+                if kind == 'cold':
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(db_path + suffix):
+                            os.remove(db_path + suffix)
+                telegram.polling.clear()
+                started_at = time.monotonic()
+                process = start_bot(env, workdir, bot_log)
+                try:
+                    if telegram.polling.wait(60):
+                        first_poll[kind].append(time.monotonic() - started_at)
+                    else:
+                        print('Бот не начал опрос за 60 с, см. лог', bot_log.name)
+                finally:
+                    stop_bot(process)
+    finally:
+        bot_log.close()
+
+    return {
+        'config': vars(args),
+        'import': summarize(import_times),
+        'first_poll': {kind: summarize(values) for kind, values in first_poll.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота погоды на локальных заглушках')
+    parser.add_argument('--users', type=int, default=50, help='интерактивные пользователи')
+    parser.add_argument('--think-time', type=float, default=1.0, help='средняя пауза пользователя между шагами, с')
+    parser.add_argument('--reminders', type=int, default=1000, help='напоминания в волне')
+    parser.add_argument('--reminder-cities', type=int, default=20, help='разных городов в волне')
+    parser.add_argument('--duration', type=float, default=90, help='длительность интерактивной нагрузки, с')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='задержка заглушки Telegram, с')
+    parser.add_argument('--tg-error-rate', type=float, default=0.0, help='доля ответов 429 на sendMessage')
+    parser.add_argument('--owm-latency', type=float, default=0.05, help='задержка заглушки OpenWeatherMap, с')
+    parser.add_argument('--owm-error-rate', type=float, default=0.0, help='доля ответов 500 от OpenWeatherMap')
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    parser.add_argument('--bot-log', help='файл для вывода бота')
+    parser.add_argument('--env', action='append', default=[], help='дополнительные переменные бота NAME=VALUE')
+    parser.add_argument('--startup-runs', type=int, default=0,
+                        help='вместо нагрузки замерить запуск бота указанное число раз')
+    args = parser.parse_args()
+
+    if args.startup_runs:
+        return write_results(measure_startup(args), args.output)
+
+    telegram = FakeTelegram(args.tg_latency, args.tg_error_rate)
+    weather = FakeOpenWeatherMap(args.owm_latency, args.owm_error_rate)
+    telegram_port = telegram.start()
+    weather_port = weather.start()
+
+    workdir = tempfile.mkdtemp(prefix='weather-bot-bench-')
+    db_path = os.path.join(workdir, 'reminders.db')
+
+    # Волна напоминаний - в первую полную минуту, до которой осталось не меньше 20 секунд
+    due = (datetime.now() + timedelta(seconds=80)).replace(second=0, microsecond=0)
+    seed_database(db_path, args.users, args.reminders, args.reminder_cities, due.strftime('%H:%M'))
+
+    env = bot_environment(telegram_port, weather_port, db_path, args.runtime, args.env)
+
+    bot_log = open(args.bot_log or os.path.join(workdir, 'bot.log'), 'w')
+    started_at = time.monotonic()
+    process = start_bot(env, workdir, bot_log)
+
+    load = InteractiveLoad(telegram, args.users, args.think_time)
+    reminders = ReminderTracker(telegram, args.reminders, due.timestamp())
+    try:
+        load_thread = threading.Thread(target=load.run, daemon=True)
+        load_thread.start()
+
+        # Нагрузка идёт не меньше duration и до конца волны напоминаний (но не дольше 5 минут после неё)
+        deadline = started_at + args.duration
+        wave_deadline = due.timestamp() + 300
+        while time.monotonic() < deadline or (not reminders.done() and time.time() < wave_deadline):
+            if process.poll() is not None:
+                print('Бот завершился раньше времени, см. лог', bot_log.name)
+                break
+            time.sleep(0.5)
+        load.stopped.set()
+        elapsed = time.monotonic() - started_at
+    finally:
+        stop_bot(process)
+        bot_log.close()
+
+    all_latencies = [value for values in load.latencies.values() for value in values]
+    results = {
+        'config': vars(args),
+        'elapsed_s': round(elapsed, 2),
+        'interactive': {
+            'steps_completed': load.completed,
+            'steps_timed_out': load.timeouts,
+            'steps_per_s': round(load.completed / elapsed, 2) if elapsed else None,
+            'latency': summarize(all_latencies),
+            'latency_by_step': {name: summarize(values) for name, values in sorted(load.latencies.items())},
+        },
+        'reminders': {
+            'expected': args.reminders,
+            'delivered': len(reminders.seen),
+            'lag': summarize(reminders.lags),
+        },
+        'upstream': {
+            'telegram_calls': telegram.calls,
+            'telegram_flood_errors': telegram.flood_errors,
+            'weather_calls': weather.calls,
+            'weather_errors': weather.errors,
+        },
+    }
+
+    write_results(results, args.output)
+
+
+# Функция для вывода результатов (и записи в файл, если он указан)
+def write_results(results, path):
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if path:
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,37 @@
 import telebot
 import requests
 import os
+import asyncio
+import bisect
+import contextvars
+import cProfile
+import functools
+import heapq
+import hmac
+import io
+import itertools
+import json
+import mmap
+import pstats
+import queue
 import sqlite3
 import threading
 import time
 import re
-import urllib.parse
-from datetime import datetime, timedelta
+import random
+import socket
+import statistics
+import struct
+import tracemalloc
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from dotenv import load_dotenv
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from requests.adapters import HTTPAdapter
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, \
+    InlineQueryResultArticle, InputTextMessageContent
 
 # Загружаем переменные из .env файла
 load_dotenv()
@@ -17,17 +40,803 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 
-# Создаём бота
-bot = telebot.TeleBot(BOT_TOKEN)
+# Режим работы: threads (по умолчанию) или asyncio (AsyncTeleBot + aiohttp)
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'threads')
+
+# Адрес Telegram Bot API (можно направить на локальную заглушку, например для benchmark.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
+# Метрики в формате Prometheus (страница /metrics); METRICS_ENABLED=0 отключает сбор
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Все метрики, которые выводятся на /metrics
+metrics_registry = []
+
+
+# Функция для форматирования меток метрики
+def format_metric_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+# Счётчик с метками
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{format_metric_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+# Гистограмма с метками: для каждого набора меток - счётчики по корзинам и сумма
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, *labels):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        names = self.label_names + ('le',)
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_metric_labels(names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_metric_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_metric_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+# Показатель, который вычисляется в момент запроса /metrics
+class Gauge:
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        metrics_registry.append(self)
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+handler_seconds = Histogram('weather_bot_handler_seconds', 'Время обработки обновлений', ('handler', 'branch'))
+handler_errors = Counter('weather_bot_handler_errors_total', 'Ошибки в обработчиках', ('handler', 'branch'))
+function_seconds = Histogram('weather_bot_function_seconds', 'Время выполнения функций погоды', ('function',))
+function_errors = Counter('weather_bot_function_errors_total', 'Ошибки в функциях погоды', ('function',))
+db_seconds = Histogram('weather_bot_db_seconds', 'Время запросов к базе', ('function',))
+db_errors = Counter('weather_bot_db_errors_total', 'Ошибки запросов к базе', ('function',))
+weather_api_seconds = Histogram('weather_bot_weather_api_seconds', 'Время запросов к OpenWeatherMap', ('endpoint',))
+weather_api_errors = Counter('weather_bot_weather_api_errors_total', 'Ошибки запросов к OpenWeatherMap',
+                             ('endpoint',))
+cache_requests = Counter('weather_bot_cache_requests_total', 'Обращения к кэшам', ('cache', 'result'))
+reminder_tick_lag = Histogram('weather_bot_reminder_tick_lag_seconds',
+                              'Опоздание обработки минуты напоминаний относительно её начала', (),
+                              (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300))
+reminders_sent = Counter('weather_bot_reminders_total', 'Отправленные напоминания', ('result',))
+reminder_delivery_lag = Histogram('weather_bot_reminder_delivery_lag_seconds',
+                                  'Задержка доставки напоминания относительно его минуты', (),
+                                  (1, 2, 5, 10, 30, 60, 120, 300, 600))
+
+
+# Декоратор для замера времени и ошибок функции (при выключенных метриках функция не меняется)
+def timed(histogram, errors, label=None):
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+        name = label or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+
+        return wrapper
+    return decorator
+
+
+# Декоратор для обработчиков: метрики по каждой ветке (ветку определяет branch_func по обновлению)
+def timed_handler(handler_name, branch_func):
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(update):
+            branch = branch_func(update)
+            started = time.perf_counter()
+            try:
+                return func(update)
+            except Exception:
+                handler_errors.inc(handler_name, branch)
+                raise
+            finally:
+                handler_seconds.observe(time.perf_counter() - started, handler_name, branch)
+
+        return wrapper
+    return decorator
+
+
+# Функция для вывода всех метрик в текстовом формате Prometheus
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+# Профилирование (по умолчанию выключено, без накладных расходов): PROFILE_MODE=cprofile
+# профилирует часть вызовов обработчиков и тиков напоминаний через cProfile. Профили копятся
+# по веткам обработчиков и раз в PROFILE_INTERVAL секунд пишутся в PROFILE_DIR вместе со сводкой.
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'off')
+PROFILING_ENABLED = PROFILE_MODE == 'cprofile'
+# Доля профилируемых вызовов
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0.05'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '300'))
+# Сколько файлов профилей хранить (старые удаляются)
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '200'))
+# Снимки памяти tracemalloc раз в столько секунд (0 - не снимать); работает и без PROFILE_MODE
+PROFILE_TRACEMALLOC_INTERVAL = float(os.getenv('PROFILE_TRACEMALLOC_INTERVAL', '0'))
+PROFILE_TRACEMALLOC_FRAMES = 5
+# Сколько строк показывать в сводках
+PROFILE_TOP = 25
+
+# Накопленные профили: (обработчик, ветка) -> {'stats': pstats.Stats, 'calls', 'seconds'}
+profile_samples = {}
+profile_lock = threading.Lock()
+# cProfile профилирует один вызов за раз: пока он идёт, другие вызовы не попадают в выборку
+profiler_busy = threading.Lock()
+
+
+# Функция для вызова с профилированием (только для выбранной доли вызовов)
+def run_profiled(handler_name, branch, func, *args):
+    if random.random() >= PROFILE_SAMPLE_RATE or not profiler_busy.acquire(blocking=False):
+        return func(*args)
+
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        elapsed = time.perf_counter() - started
+        profiler_busy.release()
+        with profile_lock:
+            sample = profile_samples.get((handler_name, branch))
+            if sample is None:
+                profile_samples[(handler_name, branch)] = {'stats': pstats.Stats(profiler), 'calls': 1,
+                                                           'seconds': elapsed}
+            else:
+                sample['stats'].add(profiler)
+                sample['calls'] += 1
+                sample['seconds'] += elapsed
+
+
+# Декоратор для профилирования обработчика по веткам (ветку определяет branch_func по обновлению)
+def profiled_handler(handler_name, branch_func):
+    def decorator(func):
+        if not PROFILING_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(update):
+            return run_profiled(handler_name, branch_func(update), func, update)
+
+        return wrapper
+    return decorator
+
+
+# Декоратор для профилирования обычной функции (например, тика напоминаний)
+def profiled(handler_name, branch):
+    def decorator(func):
+        if not PROFILING_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return run_profiled(handler_name, branch, func, *args)
+
+        return wrapper
+    return decorator
+
+
+# Функция для удаления самых старых файлов профилей сверх PROFILE_MAX_FILES
+# (имена начинаются с времени записи, поэтому сортировка по имени - по времени)
+def rotate_profile_files():
+    files = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(('.prof', '.txt')))
+    for name in files[:max(len(files) - PROFILE_MAX_FILES, 0)]:
+        os.remove(os.path.join(PROFILE_DIR, name))
+
+
+# Функция для записи накопленных профилей: .prof на каждую ветку (для snakeviz, pstats)
+# и общая сводка по веткам с самыми затратными функциями
+def write_profiles():
+    with profile_lock:
+        samples = dict(profile_samples)
+        profile_samples.clear()
+    if not samples:
+        return
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    summary = io.StringIO()
+    for (handler_name, branch), sample in sorted(samples.items(), key=lambda item: -item[1]['seconds']):
+        sample['stats'].dump_stats(os.path.join(PROFILE_DIR, f"{stamp}-{handler_name}-{branch}.prof"))
+        summary.write(f"=== {handler_name}/{branch}: {sample['calls']} вызовов, "
+                      f"в среднем {sample['seconds'] / sample['calls'] * 1000:.1f} мс ===\n")
+        sample['stats'].stream = summary
+        sample['stats'].sort_stats('cumulative').print_stats(PROFILE_TOP)
+
+    with open(os.path.join(PROFILE_DIR, f"{stamp}-summary.txt"), 'w', encoding='utf-8') as file:
+        file.write(summary.getvalue())
+    rotate_profile_files()
+
+
+# Фоновая задача: запись профилей раз в PROFILE_INTERVAL секунд
+def profile_writer():
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        try:
+            write_profiles()
+        except Exception as e:
+            print(f"Ошибка при записи профилей: {e}")
+
+
+# Функция для размеров структур в памяти, рост которых стоит отслеживать: название -> размер
+def get_memory_watch():
+    return {
+        'conversations': len(conversation_store),
+        'geocode_cache': len(geocode_cache),
+        'geocode_miss_cache': len(geocode_miss_cache),
+        'weather_cache': len(weather_cache),
+        'forecast_cache': len(forecast_cache),
+        'callback_cities': len(callback_city_names),
+    }
+
+
+# Фоновая задача: снимки памяти tracemalloc с разницей от предыдущего снимка
+def memory_snapshot_writer():
+    # Выделения самого профилирования в отчёт не попадают
+    filters = [tracemalloc.Filter(False, path) for path in
+               (tracemalloc.__file__, cProfile.__file__, pstats.__file__, '<frozen importlib._bootstrap>')]
+    previous = None
+    while True:
+        time.sleep(PROFILE_TRACEMALLOC_INTERVAL)
+        try:
+            snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+            current, peak = tracemalloc.get_traced_memory()
+
+            report = io.StringIO()
+            report.write(f"Память (tracemalloc): сейчас {current / 1048576:.1f} МБ, пик {peak / 1048576:.1f} МБ\n\n")
+            report.write("Размеры структур:\n")
+            for name, size in get_memory_watch().items():
+                report.write(f"  {name}: {size}\n")
+            title = "Рост с прошлого снимка" if previous is not None else "Крупнейшие места выделения"
+            report.write(f"\n{title}:\n")
+            stats = snapshot.compare_to(previous, 'lineno') if previous is not None else snapshot.statistics('lineno')
+            for stat in stats[:PROFILE_TOP]:
+                report.write(f"  {stat}\n")
+            previous = snapshot
+
+            stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            with open(os.path.join(PROFILE_DIR, f"{stamp}-memory.txt"), 'w', encoding='utf-8') as file:
+                file.write(report.getvalue())
+            rotate_profile_files()
+        except Exception as e:
+            print(f"Ошибка при снимке памяти: {e}")
+
+
+# Запуск фоновых задач профилирования (если оно включено)
+def start_profiling():
+    if not PROFILING_ENABLED and PROFILE_TRACEMALLOC_INTERVAL <= 0:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if PROFILING_ENABLED:
+        threading.Thread(target=profile_writer, daemon=True).start()
+        print(f"🔬 Профилирование: {PROFILE_SAMPLE_RATE:.0%} вызовов, запись в {PROFILE_DIR} "
+              f"раз в {PROFILE_INTERVAL:.0f} с")
+    if PROFILE_TRACEMALLOC_INTERVAL > 0:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        threading.Thread(target=memory_snapshot_writer, daemon=True).start()
+        print(f"🔬 Снимки памяти раз в {PROFILE_TRACEMALLOC_INTERVAL:.0f} с")
+
+
+# Запись трафика (по умолчанию выключена): TRAFFIC_RECORD_PATH=traffic.jsonl.
+# Входящие обновления и исходящие вызовы Bot API пишутся построчно в JSONL с обезличенными id,
+# запись потом прогоняется через replay.py на заглушках.
+# Имена пользователей и чатов вырезаются и из ответов бота, но текст, который пользователи пишут
+# сами (названия городов, время и т.п.), сохраняется как есть: запись нельзя считать полностью
+# обезличенной, и хранить её нужно так же, как базу бота.
+TRAFFIC_RECORD_PATH = os.getenv('TRAFFIC_RECORD_PATH')
+# Соль для псевдонимов id; по умолчанию своя на каждый запуск (записи разных запусков не связать)
+TRAFFIC_RECORD_SALT = os.getenv('TRAFFIC_RECORD_SALT') or os.urandom(16).hex()
+# Служебные методы Bot API, которые не записываются
+TRAFFIC_SKIP_METHODS = {'getUpdates', 'getMe', 'deleteWebhook', 'setWebhook', 'getWebhookInfo'}
+# Параметры вызовов, которые попадают в запись (остальные отбрасываются)
+TRAFFIC_CALL_FIELDS = ('text', 'parse_mode', 'show_alert', 'cache_time', 'callback_query_id', 'inline_query_id')
+
+
+# Запись трафика в JSONL: строка {"t": секунды с начала записи, "type": "meta" | "update" | "call", ...}.
+# Из обновлений остаются только поля, нужные обработчикам; id пользователей и чатов заменяются
+# псевдонимами HMAC, имена - заглушкой (и в обновлениях, и в тексте ответов бота).
+# Нажатия кнопок подписываются текстом кнопки, чтобы при прогоне найти ту же кнопку
+# в новой клавиатуре (callback_data зависит от базы).
+class TrafficRecorder:
+    # Сколько последних кнопок помнить на чат
+    BUTTONS_PER_CHAT = 200
+    # Для скольких последних чатов помнить кнопки, имена и запросы
+    CHATS = 10000
+    # Чем заменяются имена
+    NAME_STUB = 'User'
+
+    def __init__(self, path, salt):
+        self.file = open(path, 'a', encoding='utf-8', buffering=1)
+        self.salt = salt.encode('utf-8')
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # псевдоним чата -> OrderedDict(callback_data -> текст кнопки)
+        self.buttons = OrderedDict()
+        # псевдоним чата -> имена его участников и самого чата, которые вырезаются из ответов бота
+        self.names = OrderedDict()
+        # id callback- и инлайн-запроса -> псевдоним чата (ответы на них приходят без chat_id)
+        self.query_chats = OrderedDict()
+        self.write({'type': 'meta', 'version': 1, 'started': datetime.now().isoformat(timespec='seconds'),
+                    'bot_version': BOT_VERSION, 'runtime': BOT_RUNTIME})
+
+    def write(self, entry):
+        line = json.dumps({'t': round(time.monotonic() - self.started, 3), **entry}, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    # Псевдоним для id: одинаковый для одного id в пределах записи, знак сохраняется (группы < 0)
+    def pseudonym(self, value):
+        text = str(value)
+        if not text.lstrip('-').isdigit():
+            return None
+        digest = hmac.new(self.salt, text.lstrip('-').encode('utf-8'), 'sha256').digest()
+        alias = int.from_bytes(digest[:6], 'big') or 1
+        return -alias if text.startswith('-') else alias
+
+    # Запомнить значение для чата (самые давние чаты вытесняются)
+    def remember(self, store, key, value):
+        with self.lock:
+            store[key] = value
+            store.move_to_end(key)
+            while len(store) > self.CHATS:
+                store.popitem(last=False)
+
+    # Запомнить имена пользователя и чата, чтобы вырезать их из ответов бота в этот чат
+    def remember_names(self, chat_alias, *sources):
+        names = set()
+        for source in sources:
+            for field in ('first_name', 'last_name', 'username', 'title'):
+                value = source.get(field)
+                if isinstance(value, str) and len(value.strip()) > 1:
+                    names.add(value.strip())
+                    if field == 'username':
+                        names.add('@' + value.strip())
+        with self.lock:
+            names |= self.names.get(chat_alias, set())
+        self.remember(self.names, chat_alias, names)
+
+    # Замена известных имён чата на заглушку во всех строках значения (длинные имена - первыми)
+    def scrub(self, chat_alias, value):
+        with self.lock:
+            names = sorted(self.names.get(chat_alias, ()), key=len, reverse=True)
+        if not names:
+            return value
+        if isinstance(value, str):
+            for name in names:
+                value = value.replace(name, self.NAME_STUB)
+            return value
+        if isinstance(value, list):
+            return [self.scrub(chat_alias, item) for item in value]
+        if isinstance(value, dict):
+            return {key: self.scrub(chat_alias, item) if key != 'callback_data' else item
+                    for key, item in value.items()}
+        return value
+
+    def anonymize_user(self, user):
+        return {'id': self.pseudonym(user['id']), 'is_bot': user.get('is_bot', False), 'first_name': 'User'}
+
+    def anonymize_message(self, message, text):
+        chat = message['chat']
+        return {'message_id': message['message_id'], 'date': message['date'], 'text': text,
+                'chat': {'id': self.pseudonym(chat['id']), 'type': chat.get('type', 'private')}}
+
+    # Запись входящего обновления (обновления других типов не записываются)
+    def record_update(self, update):
+        try:
+            if 'text' in update.get('message', {}):
+                message = update['message']
+                entry = self.anonymize_message(message, message['text'])
+                if 'from' in message:
+                    entry['from'] = self.anonymize_user(message['from'])
+                self.remember_names(entry['chat']['id'], message.get('from', {}), message['chat'])
+                self.write({'type': 'update', 'update': {'message': entry}})
+            elif 'callback_query' in update:
+                query = update['callback_query']
+                entry = {'id': query['id'], 'from': self.anonymize_user(query['from']),
+                         'data': query.get('data'), 'chat_instance': '0'}
+                if 'message' in query:
+                    entry['message'] = self.anonymize_message(query['message'], '-')
+                    entry['chat_instance'] = str(entry['message']['chat']['id'])
+                    self.remember_names(entry['message']['chat']['id'], query['from'], query['message']['chat'])
+                    self.remember(self.query_chats, query['id'], entry['message']['chat']['id'])
+                    with self.lock:
+                        button = self.buttons.get(entry['message']['chat']['id'], {}).get(entry['data'])
+                    if button is not None:
+                        entry['button'] = self.scrub(entry['message']['chat']['id'], button)
+                self.write({'type': 'update', 'update': {'callback_query': entry}})
+            elif 'inline_query' in update:
+                query = update['inline_query']
+                user_alias = self.pseudonym(query['from']['id'])
+                self.remember_names(user_alias, query['from'])
+                self.remember(self.query_chats, query['id'], user_alias)
+                self.write({'type': 'update', 'update': {'inline_query': {
+                    'id': query['id'], 'from': self.anonymize_user(query['from']),
+                    'query': query.get('query', ''), 'offset': query.get('offset', '')}}})
+        except Exception as e:
+            print(f"Ошибка записи обновления: {e}")
+
+    # Запись исходящего вызова Bot API
+    def record_call(self, method_name, params):
+        if method_name in TRAFFIC_SKIP_METHODS:
+            return
+        try:
+            params = params or {}
+            entry = {'type': 'call', 'method': method_name}
+            if 'chat_id' in params:
+                entry['chat_id'] = self.pseudonym(params['chat_id'])
+            for name in TRAFFIC_CALL_FIELDS:
+                if name in params:
+                    entry[name] = params[name]
+            for name in ('reply_markup', 'results'):
+                if name in params:
+                    value = params[name]
+                    entry[name] = json.loads(value) if isinstance(value, str) else value
+
+            keyboard = entry.get('reply_markup')
+            if isinstance(keyboard, dict) and 'inline_keyboard' in keyboard and entry.get('chat_id') is not None:
+                with self.lock:
+                    buttons = self.buttons.get(entry['chat_id'], OrderedDict())
+                    for row in keyboard['inline_keyboard']:
+                        for button in row:
+                            if 'callback_data' in button:
+                                buttons[button['callback_data']] = button['text']
+                                buttons.move_to_end(button['callback_data'])
+                    while len(buttons) > self.BUTTONS_PER_CHAT:
+                        buttons.popitem(last=False)
+                self.remember(self.buttons, entry['chat_id'], buttons)
+
+            # Имена вырезаются из всего текста вызова: сообщения, подсказки, кнопок и инлайн-результатов
+            query_id = params.get('callback_query_id') or params.get('inline_query_id')
+            with self.lock:
+                chat_alias = entry.get('chat_id') if 'chat_id' in entry else self.query_chats.get(str(query_id))
+            for name in ('text', 'reply_markup', 'results'):
+                if name in entry:
+                    entry[name] = self.scrub(chat_alias, entry[name])
+            self.write(entry)
+        except Exception as e:
+            print(f"Ошибка записи вызова {method_name}: {e}")
+
+
+traffic_recorder = None
+
+
+# Включение записи трафика: перехватываем запросы к Bot API (и синхронные, и асинхронные)
+def start_traffic_recording():
+    global traffic_recorder
+    if not TRAFFIC_RECORD_PATH:
+        return
+    traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_PATH, TRAFFIC_RECORD_SALT)
+
+    make_request = telebot.apihelper._make_request
+
+    def recorded_request(token, method_name, method='get', params=None, files=None):
+        result = make_request(token, method_name, method, params=params, files=files)
+        if method_name == 'getUpdates':
+            for update in result:
+                traffic_recorder.record_update(update)
+        else:
+            traffic_recorder.record_call(method_name, params)
+        return result
+
+    telebot.apihelper._make_request = recorded_request
+
+    if BOT_RUNTIME == 'asyncio':
+        from telebot import asyncio_helper
+
+        process_request = asyncio_helper._process_request
+
+        async def recorded_process_request(token, url, method='get', params=None, files=None, **kwargs):
+            # Параметры копируем заранее: _process_request меняет их на месте
+            sent = dict(params or {})
+            result = await process_request(token, url, method, params=params, files=files, **kwargs)
+            if url == 'getUpdates':
+                for update in result:
+                    traffic_recorder.record_update(update)
+            else:
+                traffic_recorder.record_call(url, sent)
+            return result
+
+        asyncio_helper._process_request = recorded_process_request
+
+    print(f"🎙 Запись трафика в {TRAFFIC_RECORD_PATH}")
+
+
+# Лимиты Telegram на исходящие сообщения: всего в секунду и в один чат в секунду.
+# Общий лимит Telegram действует на токен бота, поэтому он делится между живыми копиями
+# (их число обновляется вместе с арендой шардов напоминаний)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))
+
+
+# Очередь исходящих сообщений с общим лимитом, лимитом на чат и приоритетами.
+# Сообщения одного чата уходят строго по порядку и по одному.
+class OutboundQueue:
+    INTERACTIVE = 0
+    BULK = 1
+
+    # Сколько раз повторять сообщение после ответа 429
+    MAX_FLOOD_RETRIES = 10
+    # Как часто удалять из памяти неактивные чаты
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, workers=OUTBOUND_WORKERS):
+        self.global_rate = global_rate
+        self.global_tokens = global_rate
+        self.global_updated = time.monotonic()
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        # chat_id -> {'items': очередь сообщений, 'tokens', 'updated', 'busy'}
+        self.chats = {}
+        # Для каждого приоритета - куча чатов, готовых к отправке: (когда можно, порядковый номер, chat_id)
+        self.ready = ([], [])
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.last_prune = time.monotonic()
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbound')
+        # Поток отправки запускается при первом сообщении
+        self.thread = None
+
+    # Количество сообщений, ожидающих отправки
+    def depth(self):
+        with self.condition:
+            return sum(len(chat['items']) for chat in self.chats.values())
+
+    # Поставить вызов API в очередь; возвращает Future с результатом вызова
+    def submit(self, chat_id, func, priority=INTERACTIVE):
+        future = Future()
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.dispatch, daemon=True)
+                self.thread.start()
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = {'items': deque(), 'tokens': self.chat_burst, 'updated': time.monotonic(), 'busy': False}
+                self.chats[chat_id] = chat
+            chat['items'].append((priority, func, future, 0))
+            if len(chat['items']) == 1 and not chat['busy']:
+                self.schedule(chat_id, chat)
+            self.condition.notify()
+        return future
+
+    # Смена общего лимита (например, когда меняется число копий бота)
+    def set_global_rate(self, rate):
+        with self.condition:
+            if rate == self.global_rate:
+                return
+            self.global_rate = rate
+            self.global_tokens = min(self.global_tokens, rate)
+            self.condition.notify_all()
+
+    # Пополнение токенов чата (вызывается под self.condition)
+    def refill_chat(self, chat, now):
+        chat['tokens'] = min(self.chat_burst, chat['tokens'] + (now - chat['updated']) * self.chat_rate)
+        chat['updated'] = now
+
+    # Поставить чат в кучу готовых по приоритету его первого сообщения (под self.condition)
+    def schedule(self, chat_id, chat, not_before=0):
+        now = time.monotonic()
+        self.refill_chat(chat, now)
+        ready_at = max(now + max(0, 1 - chat['tokens']) / self.chat_rate, not_before)
+        priority = chat['items'][0][0]
+        heapq.heappush(self.ready[priority], (ready_at, next(self.counter), chat_id))
+
+    # Основной цикл: выбирает следующее сообщение с учётом приоритетов и лимитов
+    def dispatch(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now - self.last_prune > self.PRUNE_INTERVAL:
+                    self.prune(now)
+
+                heap = None
+                wake_at = None
+                for candidate in self.ready:
+                    if candidate and candidate[0][0] <= now:
+                        heap = candidate
+                        break
+                    if candidate:
+                        wake_at = candidate[0][0] if wake_at is None else min(wake_at, candidate[0][0])
+
+                if heap is None:
+                    self.condition.wait(None if wake_at is None else wake_at - now)
+                    continue
+
+                self.global_tokens = min(self.global_rate,
+                                         self.global_tokens + (now - self.global_updated) * self.global_rate)
+                self.global_updated = now
+                if self.global_tokens < 1:
+                    self.condition.wait((1 - self.global_tokens) / self.global_rate)
+                    continue
+                self.global_tokens -= 1
+
+                _, _, chat_id = heapq.heappop(heap)
+                chat = self.chats[chat_id]
+                self.refill_chat(chat, now)
+                chat['tokens'] -= 1
+                chat['busy'] = True
+                self.executor.submit(self.deliver, chat_id, chat, chat['items'].popleft())
+
+    # Отправка одного сообщения; при 429 сообщение возвращается в начало очереди чата
+    def deliver(self, chat_id, chat, item):
+        priority, func, future, attempts = item
+        retry_at = 0
+        try:
+            result = func()
+        except Exception as e:
+            retry_after = get_flood_retry_after(e)
+            if retry_after is not None and attempts < self.MAX_FLOOD_RETRIES:
+                retry_at = time.monotonic() + retry_after
+                item = (priority, func, future, attempts + 1)
+            else:
+                future.set_exception(e)
+                item = None
+        else:
+            future.set_result(result)
+            item = None
+
+        with self.condition:
+            chat['busy'] = False
+            if item is not None:
+                chat['items'].appendleft(item)
+            if chat['items']:
+                self.schedule(chat_id, chat, retry_at)
+            self.condition.notify()
+
+    # Удаление чатов без сообщений с полным запасом токенов (под self.condition)
+    def prune(self, now):
+        for chat_id, chat in list(self.chats.items()):
+            if not chat['items'] and not chat['busy']:
+                self.refill_chat(chat, now)
+                if chat['tokens'] >= self.chat_burst:
+                    del self.chats[chat_id]
+        self.last_prune = now
+
+
+# Функция для получения паузы из ответа 429 Too Many Requests (None - это не 429)
+def get_flood_retry_after(error):
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    return getattr(error, 'result_json', {}).get('parameters', {}).get('retry_after', 1)
+
+
+outbound_queue = OutboundQueue()
+
+
+# Бот, у которого сообщения в чаты идут через очередь с лимитами
+class RateLimitedTeleBot(telebot.TeleBot):
+    def send_message(self, chat_id, *args, **kwargs):
+        func = functools.partial(super().send_message, chat_id, *args, **kwargs)
+        return outbound_queue.submit(chat_id, func).result()
+
+    def edit_message_text(self, text=None, chat_id=None, *args, **kwargs):
+        func = functools.partial(super().edit_message_text, text, chat_id, *args, **kwargs)
+        return outbound_queue.submit(chat_id, func).result()
+
+    # Массовая отправка (напоминания): не ждёт результата и уступает интерактивным ответам
+    def queue_bulk_message(self, chat_id, *args, **kwargs):
+        func = functools.partial(super().send_message, chat_id, *args, **kwargs)
+        return outbound_queue.submit(chat_id, func, OutboundQueue.BULK)
+
+
+# Бот создаётся при запуске приложения (WeatherBotApp.create_bot), а не при импорте модуля
+bot = None
+
+# Обработчики, которые регистрируются в боте при его создании: (функция, фильтры)
+message_handler_specs = []
+callback_query_handler_specs = []
+
+
+# Декоратор для обработчика сообщений (фильтры - как у TeleBot.message_handler)
+def message_handler(**filters):
+    def decorator(func):
+        message_handler_specs.append((func, filters))
+        return func
+    return decorator
+
+
+inline_handler_specs = []
+
+
+# Декоратор для обработчика нажатий на инлайн-кнопки
+def callback_query_handler(**filters):
+    def decorator(func):
+        callback_query_handler_specs.append((func, filters))
+        return func
+    return decorator
+
+
+# Декоратор для обработчика инлайн-запросов (@бот название города в любом чате)
+def inline_handler(**filters):
+    def decorator(func):
+        inline_handler_specs.append((func, filters))
+        return func
+    return decorator
 
 # Информация о создателе
 CREATOR_NAME = "Pavel"
 CREATOR_NICKNAME = "@Gdrag182"
 BOT_VERSION = "2.0"
 
-# Словарь для хранения временных данных пользователей
-user_data = {}
-
 # Словарь для перевода погодных условий
 weather_conditions = {
     'clear': 'Ясно ☀️',
@@ -55,12 +864,59 @@ week_days = {
 popular_cities = ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург',
                   'Кемерово', 'Прокопьевск']
 
+# Кнопки главного меню
+main_menu_buttons = ["🌤 Узнать погоду", "🌟 Популярные города", "⏰ Напомнить о погоде",
+                     "📋 Мои напоминания", "ℹ️ О боте", "📞 Помощь", "👨‍💻 О разработчике"]
+# Названия веток handle_main_keyboard для метрик
+main_menu_branches = dict(zip(main_menu_buttons, ['weather', 'popular', 'remind', 'my_reminders', 'about',
+                                                  'help', 'creator']))
+
+
+# Функция для определения ветки handle_main_keyboard (для метрик и профилей)
+def get_message_branch(message):
+    return main_menu_branches.get(message.text, 'text')
+
+
+# Путь к базе данных
+DB_PATH = os.getenv('DB_PATH', 'reminders.db')
+
+# У каждого потока своё долгоживущее соединение с базой
+db_local = threading.local()
+
+
+# Функция для получения соединения с базой для текущего потока
+def get_db():
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        # cached_statements - кэш подготовленных запросов внутри соединения
+        conn = sqlite3.connect(DB_PATH, timeout=10, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=10000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-8000')
+        db_local.conn = conn
+    return conn
+
+
+# Колонки напоминания в порядке, в котором их возвращают запросы
+REMINDER_COLUMNS = 'id, user_id, chat_id, city, reminder_time, days, is_active, minute_of_day, weekday_mask'
+
+# Заполнение числовых колонок расписания из текстовых reminder_time ('ЧЧ:ММ') и days
+# ('everyday', 'workdays', 'weekend' или '1,3,5') - для старых строк и записей старых версий бота
+REMINDER_SCHEDULE_SQL = (
+    "minute_of_day = CAST(substr(reminder_time, 1, instr(reminder_time, ':') - 1) AS INTEGER) * 60"
+    " + CAST(substr(reminder_time, instr(reminder_time, ':') + 1) AS INTEGER), "
+    "weekday_mask = CASE WHEN days IS NULL OR days = 'everyday' THEN 127"
+    " WHEN days = 'workdays' THEN 31 WHEN days = 'weekend' THEN 96 ELSE "
+    + " | ".join(f"(CASE WHEN ',' || replace(days, ' ', '') || ',' LIKE '%,{day},%' THEN {1 << (day - 1)} ELSE 0 END)"
+                 for day in range(1, 8))
+    + " END"
+)
 
-# Создаём базу данных для напоминаний
-def init_database():
-    conn = sqlite3.connect('reminders.db')
-    cursor = conn.cursor()
 
+# Миграция 1: таблицы бота (в том числе перенос баз, созданных до появления версий схемы)
+def migrate_schema_v1(cursor):
     # Проверяем, существует ли таблица
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='reminders'")
     table_exists = cursor.fetchone()
@@ -107,205 +963,2395 @@ def init_database():
                 city TEXT,
                 reminder_time TEXT,
                 days TEXT DEFAULT 'everyday',
-                is_active BOOLEAN DEFAULT 1
+                is_active BOOLEAN DEFAULT 1,
+                minute_of_day INTEGER,
+                weekday_mask INTEGER
             )
         ''')
 
-    conn.commit()
-    conn.close()
+    # Расписание в числовых колонках (минута суток и маска дней недели)
+    cursor.execute("PRAGMA table_info(reminders)")
+    column_names = [column[1] for column in cursor.fetchall()]
+    if 'minute_of_day' not in column_names:
+        cursor.execute('ALTER TABLE reminders ADD COLUMN minute_of_day INTEGER')
+    if 'weekday_mask' not in column_names:
+        cursor.execute('ALTER TABLE reminders ADD COLUMN weekday_mask INTEGER')
+    cursor.execute(f'UPDATE reminders SET {REMINDER_SCHEDULE_SQL} WHERE minute_of_day IS NULL')
+    cursor.execute('DROP INDEX IF EXISTS idx_reminders_active_time')
+
+    # Кэш координат городов (ключ - нормализованное название или его синоним)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            query TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            name TEXT,
+            country TEXT
+        )
+    ''')
+
+    # Состояние незавершённой настройки напоминания (для CONVERSATION_BACKEND=sqlite)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            user_id INTEGER PRIMARY KEY,
+            step INTEGER,
+            city TEXT,
+            reminder_time TEXT,
+            expires_at REAL
+        )
+    ''')
+
+    # Аренда шардов напоминаний: у каждого шарда один владелец, пока не истекла аренда.
+    # fired_until - последняя минута (unix-время), обработанная по шарду
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_shards (
+            shard INTEGER PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL DEFAULT 0,
+            fired_until INTEGER
+        )
+    ''')
+
+    # Живые копии бота (по ним шарды делятся поровну)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_replicas (
+            replica_id TEXT PRIMARY KEY,
+            heartbeat_at REAL
+        )
+    ''')
+
+    # Индексы для поиска напоминаний по минуте срабатывания и по пользователю
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders (is_active, minute_of_day)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reminders_user_active ON reminders (user_id, is_active)')
+
+
+# Миграция 2: таблица городов, на которые ссылаются инлайн-кнопки по короткому номеру
+def migrate_schema_v2(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS callback_cities (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )
+    ''')
+
+
+# Миграция 3: журнал доставки напоминаний (outbox). Строка - одно напоминание в одну минуту:
+# pending - ещё не доставлено, sent - доставлено, failed - доставить не удалось
+def migrate_schema_v3(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reminder_outbox (
+            reminder_id INTEGER,
+            fire_at INTEGER,
+            chat_id INTEGER,
+            city TEXT,
+            shard INTEGER,
+            state TEXT DEFAULT 'pending',
+            sent_at REAL,
+            error TEXT,
+            PRIMARY KEY (reminder_id, fire_at)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reminder_outbox_fire ON reminder_outbox (fire_at, state)')
+
+
+# Миграция 4: временные названия на кнопках «Искать как есть» (текст пользователя, а не найденный
+# город), которые удаляются через CALLBACK_SEARCH_TTL. Строки, записанные до миграции, остаются
+# постоянными: на них ссылаются уже отправленные кнопки
+def migrate_schema_v4(cursor):
+    cursor.execute('ALTER TABLE callback_cities ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE callback_cities ADD COLUMN temporary INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_callback_cities_temporary ON callback_cities (temporary, created_at)')
 
 
-# Вызываем при запуске
-init_database()
+# Миграции схемы по порядку: миграция с номером N (с 1) переводит базу на версию N
+SCHEMA_MIGRATIONS = [migrate_schema_v1, migrate_schema_v2, migrate_schema_v3, migrate_schema_v4]
+# Версия схемы, которую ожидает код (PRAGMA user_version)
+SCHEMA_VERSION = len(SCHEMA_MIGRATIONS)
+
+
+# Создаём базу данных для напоминаний: при обычном перезапуске - только проверка версии схемы
+def init_database():
+    conn = get_db()
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    cursor = conn.cursor()
+    try:
+        # Блокировка записи: если базу одновременно обновляют несколько копий бота, миграции выполнит одна
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            SCHEMA_MIGRATIONS[target - 1](cursor)
+            cursor.execute(f'PRAGMA user_version = {target}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
 # Функция для добавления напоминания
+@timed(db_seconds, db_errors)
 def add_reminder(user_id, chat_id, city, reminder_time, days='everyday'):
-    conn = sqlite3.connect('reminders.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO reminders (user_id, chat_id, city, reminder_time, days)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, chat_id, city, reminder_time, days))
+        INSERT INTO reminders (user_id, chat_id, city, reminder_time, days, minute_of_day, weekday_mask)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (user_id, chat_id, city, reminder_time, days, time_to_minute(reminder_time), days_to_weekday_mask(days)))
+    reminder_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+
+    reminders_changed.set()
+    return reminder_id
 
 
 # Функция для получения активных напоминаний
+@timed(db_seconds, db_errors)
 def get_active_reminders():
-    conn = sqlite3.connect('reminders.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute(
-        'SELECT id, user_id, chat_id, city, reminder_time, days, is_active FROM reminders WHERE is_active = 1')
+    cursor.execute(f'SELECT {REMINDER_COLUMNS} FROM reminders WHERE is_active = 1')
     reminders = cursor.fetchall()
-    conn.close()
     return reminders
 
 
+# Функция для заполнения расписания у напоминаний, записанных в старом формате (например, старой
+# версией бота во время перехода): без этого их не найдёт запрос напоминаний по минуте
+@timed(db_seconds, db_errors)
+def backfill_reminder_schedule():
+    conn = get_db()
+    conn.execute(f'UPDATE reminders SET {REMINDER_SCHEDULE_SQL} WHERE is_active = 1 AND minute_of_day IS NULL')
+    conn.commit()
+
+
 # Функция для удаления напоминания
+@timed(db_seconds, db_errors)
 def delete_reminder(reminder_id):
-    conn = sqlite3.connect('reminders.db')
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('UPDATE reminders SET is_active = 0 WHERE id = ?', (reminder_id,))
     conn.commit()
-    conn.close()
 
 
 # Функция для получения списка напоминаний пользователя
+@timed(db_seconds, db_errors)
 def get_user_reminders(user_id):
-    conn = sqlite3.connect('reminders.db')
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute(
-        'SELECT id, user_id, chat_id, city, reminder_time, days, is_active FROM reminders WHERE user_id = ? AND is_active = 1',
-        (user_id,))
+    cursor.execute(f'SELECT {REMINDER_COLUMNS} FROM reminders WHERE user_id = ? AND is_active = 1', (user_id,))
     reminders = cursor.fetchall()
-    conn.close()
     return reminders
 
 
-# Функция для проверки корректности времени
-def is_valid_time(time_str):
-    pattern = r'^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$'
-    return re.match(pattern, time_str) is not None
+# Максимальное количество городов кнопок в памяти
+CALLBACK_CITY_CACHE_SIZE = int(os.getenv('CALLBACK_CITY_CACHE_SIZE', '10000'))
+# Сколько живут временные названия кнопок «Искать как есть», с
+CALLBACK_SEARCH_TTL = int(os.getenv('CALLBACK_SEARCH_TTL', '86400'))
+
+# Номера городов для инлайн-кнопок в памяти (LRU, только закреплённые города):
+# название -> номер и номер -> название
+callback_city_ids = OrderedDict()
+callback_city_names = OrderedDict()
+callback_city_lock = threading.Lock()
+
+
+# Функция для записи города кнопки в память (самые давние вытесняются)
+def callback_city_cache_put(city, city_id):
+    with callback_city_lock:
+        callback_city_ids[city] = city_id
+        callback_city_ids.move_to_end(city)
+        callback_city_names[city_id] = city
+        callback_city_names.move_to_end(city_id)
+        while len(callback_city_ids) > CALLBACK_CITY_CACHE_SIZE:
+            _, old_id = callback_city_ids.popitem(last=False)
+            callback_city_names.pop(old_id, None)
+
+
+# Функция для чтения из памяти: номер по названию или название по номеру (None, если нет)
+def callback_city_cache_get(cache, key):
+    with callback_city_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+# Функция для получения номера города (город получает номер при первом появлении на кнопке).
+# Сюда попадают только найденные названия городов, текст пользователя - через get_callback_search_id.
+@timed(db_seconds, db_errors)
+def get_callback_city_id(city):
+    city_id = callback_city_cache_get(callback_city_ids, city)
+    if city_id is not None:
+        return city_id
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO callback_cities (name, created_at, temporary) VALUES (?, ?, 0)
+        ON CONFLICT (name) DO UPDATE SET temporary = 0
+    ''', (city, int(time.time())))
+    cursor.execute('SELECT id FROM callback_cities WHERE name = ?', (city,))
+    city_id = cursor.fetchone()[0]
+    conn.commit()
+
+    callback_city_cache_put(city, city_id)
+    return city_id
+
+
+# Функция для получения временного номера текста пользователя (кнопка «Искать как есть»).
+# Заодно удаляются временные названия старше CALLBACK_SEARCH_TTL: старые кнопки с ними устаревают.
+@timed(db_seconds, db_errors)
+def get_callback_search_id(text):
+    text = normalize_city_name(text)
+    now = int(time.time())
+
+    conn = get_db()
+    cursor = conn.cursor()
+    # Последнюю строку не удаляем: иначе её номер достанется следующему названию и старая кнопка
+    # откроет чужой текст
+    cursor.execute('''
+        DELETE FROM callback_cities
+        WHERE temporary = 1 AND created_at < ? AND id < (SELECT MAX(id) FROM callback_cities)
+    ''', (now - CALLBACK_SEARCH_TTL,))
+    cursor.execute('''
+        INSERT INTO callback_cities (name, created_at, temporary) VALUES (?, ?, 1)
+        ON CONFLICT (name) DO UPDATE SET created_at = excluded.created_at WHERE temporary = 1
+    ''', (text, now))
+    cursor.execute('SELECT id FROM callback_cities WHERE name = ?', (text,))
+    city_id = cursor.fetchone()[0]
+    conn.commit()
+    return city_id
+
+
+# Функция для получения города по номеру с кнопки (None, если номер неизвестен)
+@timed(db_seconds, db_errors)
+def get_callback_city_name(city_id):
+    city = callback_city_cache_get(callback_city_names, city_id)
+    if city is not None:
+        return city
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT name, temporary FROM callback_cities WHERE id = ?', (city_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+
+    # Временные названия в память не попадают: их строки удаляются из базы
+    if not row[1]:
+        callback_city_cache_put(row[0], city_id)
+    return row[0]
+
+
+# Хранилище состояния диалога (незавершённая настройка напоминания)
+
+# Где хранить состояние: memory (в памяти процесса) или sqlite (переживает перезапуск, общее для процессов)
+CONVERSATION_BACKEND = os.getenv('CONVERSATION_BACKEND', 'memory')
+# Через сколько секунд бездействия состояние забывается
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', '3600'))
+# Максимальное количество состояний в памяти
+CONVERSATION_MAX_ENTRIES = int(os.getenv('CONVERSATION_MAX_ENTRIES', '100000'))
+
+# Шаги диалога хранятся числом, чтобы запись была компактной
+CONVERSATION_STEPS = {1: 'awaiting_time', 2: 'awaiting_days'}
+CONVERSATION_STEP_CODES = {name: code for code, name in CONVERSATION_STEPS.items()}
+
+
+# Функция для превращения компактной записи в словарь вида {'city', 'time', 'awaiting_...': True}
+def unpack_conversation_state(step, city, reminder_time):
+    state = {'city': city, CONVERSATION_STEPS[step]: True}
+    if reminder_time is not None:
+        state['time'] = reminder_time
+    return state
+
+
+# Состояния в памяти процесса: user_id -> (шаг, город, время, когда истекает)
+class MemoryConversationStore:
+    def __init__(self, ttl=CONVERSATION_TTL, max_entries=CONVERSATION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Порядок записей совпадает с порядком истечения, поэтому просроченные всегда в начале
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def evict(self, now):
+        while self.entries:
+            user_id, entry = next(iter(self.entries.items()))
+            if entry[3] > now and len(self.entries) <= self.max_entries:
+                break
+            self.entries.popitem(last=False)
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[3] <= time.time():
+                return None
+            return unpack_conversation_state(*entry[:3])
+
+    def set(self, user_id, step, city, reminder_time=None):
+        now = time.time()
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.entries[user_id] = (CONVERSATION_STEP_CODES[step], city, reminder_time, now + self.ttl)
+            self.evict(now)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Состояния в таблице conversation_state
+class SQLiteConversationStore:
+    # Как часто удалять просроченные записи (в количестве записей)
+    CLEANUP_EVERY = 1000
+
+    def __init__(self, ttl=CONVERSATION_TTL):
+        self.ttl = ttl
+        self.writes = itertools.count(1)
+
+    def get(self, user_id):
+        cursor = get_db().cursor()
+        cursor.execute('SELECT step, city, reminder_time FROM conversation_state WHERE user_id = ? AND expires_at > ?',
+                       (user_id, time.time()))
+        row = cursor.fetchone()
+        return unpack_conversation_state(*row) if row else None
+
+    def set(self, user_id, step, city, reminder_time=None):
+        now = time.time()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO conversation_state (user_id, step, city, reminder_time, expires_at) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (user_id, CONVERSATION_STEP_CODES[step], city, reminder_time, now + self.ttl))
+        if next(self.writes) % self.CLEANUP_EVERY == 0:
+            cursor.execute('DELETE FROM conversation_state WHERE expires_at <= ?', (now,))
+        conn.commit()
+
+    def delete(self, user_id):
+        conn = get_db()
+        conn.execute('DELETE FROM conversation_state WHERE user_id = ?', (user_id,))
+        conn.commit()
+
+    def __len__(self):
+        return get_db().execute('SELECT COUNT(*) FROM conversation_state').fetchone()[0]
+
+
+# Доступные хранилища состояния диалога
+conversation_backends = {
+    'memory': MemoryConversationStore,
+    'sqlite': SQLiteConversationStore,
+}
+
+conversation_store = conversation_backends[CONVERSATION_BACKEND]()
+
+
+# Функция для проверки корректности времени
+def is_valid_time(time_str):
+    pattern = r'^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$'
+    return re.match(pattern, time_str) is not None
+
+
+# Функция для разбора дней напоминания в множество дней недели (1 - Пн, 7 - Вс)
+def parse_days(days_string):
+    if days_string is None or days_string == "everyday":
+        return set(range(1, 8))
+    if days_string == "workdays":
+        return set(range(1, 6))
+    if days_string == "weekend":
+        return {6, 7}
+    return {int(d) for d in days_string.split(',') if d.strip().isdigit() and 1 <= int(d) <= 7}
+
+
+# Функция для перевода времени ЧЧ:ММ в минуту суток
+def time_to_minute(time_str):
+    hours, minutes = time_str.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+# Функция для перевода дней напоминания в маску дней недели (бит 0 - Пн, бит 6 - Вс)
+def days_to_weekday_mask(days_string):
+    return sum(1 << (day - 1) for day in parse_days(days_string))
+
+
+# Функция для получения бита дня недели указанной даты в маске дней
+def weekday_bit(moment):
+    return 1 << (moment.isoweekday() - 1)
+
+
+# Настройки клиента OpenWeatherMap (базовый адрес можно направить на локальную заглушку)
+WEATHER_API_BASE_URL = os.getenv('WEATHER_API_BASE_URL', 'https://api.openweathermap.org')
+WEATHER_CONNECT_TIMEOUT = float(os.getenv('WEATHER_CONNECT_TIMEOUT', '3'))
+WEATHER_READ_TIMEOUT = float(os.getenv('WEATHER_READ_TIMEOUT', '10'))
+WEATHER_MAX_RETRIES = int(os.getenv('WEATHER_MAX_RETRIES', '3'))
+WEATHER_POOL_SIZE = int(os.getenv('WEATHER_POOL_SIZE', '32'))
+
+# Бюджет запросов к OpenWeatherMap в минуту на процесс (0 - без ограничения)
+WEATHER_QUOTA_PER_MINUTE = int(os.getenv('WEATHER_QUOTA_PER_MINUTE', '60'))
+# Доля бюджета, которую запросы напоминаний и фоновой предзагрузки оставляют более важным запросам
+WEATHER_QUOTA_REMINDER_RESERVE = float(os.getenv('WEATHER_QUOTA_REMINDER_RESERVE', '0.2'))
+WEATHER_QUOTA_PREWARM_RESERVE = float(os.getenv('WEATHER_QUOTA_PREWARM_RESERVE', '0.5'))
+# Сколько подряд неудачных попыток запроса размыкают выключатель и на сколько секунд
+WEATHER_BREAKER_FAILURES = int(os.getenv('WEATHER_BREAKER_FAILURES', '5'))
+WEATHER_BREAKER_OPEN_SECONDS = float(os.getenv('WEATHER_BREAKER_OPEN_SECONDS', '30'))
+
+upstream_rejected = Counter('weather_bot_weather_api_rejected_total',
+                            'Запросы к OpenWeatherMap, не отправленные из-за бюджета или выключателя',
+                            ('reason', 'priority'))
+
+
+# Исключение: запрос к OpenWeatherMap не отправлен (бюджет исчерпан или выключатель разомкнут)
+class UpstreamUnavailable(Exception):
+    pass
+
+
+# Общий на процесс регулятор запросов к OpenWeatherMap: бюджет запросов в минуту с приоритетами
+# и выключатель, который перестаёт слать запросы, пока API подряд отвечает ошибками
+class UpstreamGovernor:
+    INTERACTIVE = 0
+    REMINDER = 1
+    PREWARM = 2
+    PRIORITY_NAMES = ('interactive', 'reminder', 'prewarm')
+
+    def __init__(self, calls_per_minute=WEATHER_QUOTA_PER_MINUTE,
+                 reserves=(0, WEATHER_QUOTA_REMINDER_RESERVE, WEATHER_QUOTA_PREWARM_RESERVE),
+                 max_waits=(2, 20, 0), failure_threshold=WEATHER_BREAKER_FAILURES,
+                 open_seconds=WEATHER_BREAKER_OPEN_SECONDS):
+        self.capacity = calls_per_minute
+        self.tokens = calls_per_minute
+        self.updated = time.monotonic()
+        # Класс может взять запрос из бюджета, только если после этого останется его резерв
+        self.reserves = [reserve * calls_per_minute for reserve in reserves]
+        # Сколько секунд класс готов ждать освобождения бюджета
+        self.max_waits = max_waits
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.failures = 0
+        # Когда выключатель разомкнулся (None - замкнут) и когда ушёл пробный запрос
+        self.opened_at = None
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    # Попытка взять запрос из бюджета: 0 - взят, иначе сколько секунд ждать
+    def take_token(self, priority):
+        if self.capacity <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+            self.updated = now
+            floor = self.reserves[priority]
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                return 0
+            return (floor + 1 - self.tokens) * 60 / self.capacity
+
+    # Можно ли отправить запрос с точки зрения выключателя. После паузы выключатель пропускает
+    # один пробный запрос: успех замыкает его, ошибка размыкает снова.
+    def circuit_allows(self, claim_probe=False):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.open_seconds:
+                return False
+            # Пробный запрос уже идёт (если он пропал без результата - через паузу пускаем новый)
+            if self.probe_started is not None and now - self.probe_started < self.open_seconds:
+                return False
+            if claim_probe:
+                self.probe_started = now
+            return True
+
+    # Разомкнут ли выключатель (API недоступен)
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None
+
+    # Отказ в запросе с записью причины в метрики
+    def reject(self, reason, priority, path):
+        upstream_rejected.inc(reason, self.PRIORITY_NAMES[priority])
+        if reason == 'circuit_open':
+            raise UpstreamUnavailable(f"OpenWeatherMap недоступен, запрос {path} не отправлен")
+        raise UpstreamUnavailable(f"Бюджет запросов к OpenWeatherMap исчерпан, запрос {path} не отправлен")
+
+    # Проверка перед запросом: 0 - можно отправлять, иначе сколько ждать бюджета.
+    # Если бюджета не дождаться до deadline или выключатель разомкнут - UpstreamUnavailable.
+    def check(self, priority, path, deadline):
+        if not self.circuit_allows():
+            self.reject('circuit_open', priority, path)
+        wait = self.take_token(priority)
+        if wait == 0:
+            if not self.circuit_allows(claim_probe=True):
+                self.reject('circuit_open', priority, path)
+            return 0
+        if time.monotonic() + wait > deadline:
+            self.reject('quota', priority, path)
+        return wait
+
+    # Разрешение на запрос (ждёт бюджет в текущем потоке)
+    def acquire(self, path):
+        priority = upstream_priority.get()
+        deadline = time.monotonic() + self.max_waits[priority]
+        wait = self.check(priority, path, deadline)
+        while wait:
+            time.sleep(wait)
+            wait = self.check(priority, path, deadline)
+
+    # Разрешение на запрос в режиме asyncio (ждёт бюджет, не блокируя цикл событий)
+    async def async_acquire(self, path):
+        priority = upstream_priority.get()
+        deadline = time.monotonic() + self.max_waits[priority]
+        wait = self.check(priority, path, deadline)
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.check(priority, path, deadline)
+
+    # Запрос прошёл: выключатель замыкается
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print("🔌 OpenWeatherMap снова отвечает, запросы возобновлены")
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started = None
+
+    # Попытка запроса не прошла: после нескольких ошибок подряд выключатель размыкается
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_started = None
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"🔌 OpenWeatherMap не отвечает ({self.failures} ошибок подряд), "
+                          f"запросы приостановлены на {self.open_seconds:.0f} с")
+                self.opened_at = time.monotonic()
+
+
+# Приоритет запросов к OpenWeatherMap в текущем потоке или задаче asyncio
+upstream_priority = contextvars.ContextVar('upstream_priority', default=UpstreamGovernor.INTERACTIVE)
+
+upstream_governor = UpstreamGovernor()
+
+
+# Клиент OpenWeatherMap: общий пул keep-alive соединений, таймауты и повторы
+class WeatherClient:
+    # Сколько максимум ждать по заголовку Retry-After, чтобы не блокировать поток надолго
+    MAX_RETRY_AFTER = 30
+
+    def __init__(self, base_url, api_key, connect_timeout=WEATHER_CONNECT_TIMEOUT,
+                 read_timeout=WEATHER_READ_TIMEOUT, max_retries=WEATHER_MAX_RETRIES,
+                 pool_size=WEATHER_POOL_SIZE, backoff_base=0.5, governor=upstream_governor):
+        self.base_url = base_url.rstrip('/')
+        self.governor = governor
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.pool_size = pool_size
+        self.session = self.create_session()
+
+    # Сессия с пулом keep-alive соединений
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    # Параметры запроса с ключом API (пустые значения отбрасываются)
+    def build_params(self, params):
+        return {name: value for name, value in dict(params, appid=self.api_key).items() if value is not None}
+
+    # Задержка перед повтором: экспоненциальная со случайным разбросом
+    def backoff(self, attempt):
+        return random.uniform(0, self.backoff_base * 2 ** attempt)
+
+    # Задержка перед повтором после ответа 429
+    def retry_after(self, response, attempt):
+        try:
+            return min(float(response.headers['Retry-After']), self.MAX_RETRY_AFTER)
+        except (KeyError, ValueError):
+            return self.backoff(attempt)
+
+    # Запись итога попытки в выключатель (ошибки клиента вроде 404 не считаются отказом API)
+    def record_outcome(self, status):
+        if status == 429 or status >= 500:
+            self.governor.record_failure()
+        else:
+            self.governor.record_success()
+
+    # GET-запрос с повторами при 429, 5xx и сетевых ошибках; каждая попытка берётся из бюджета
+    def get(self, path, params):
+        url = f"{self.base_url}{path}"
+        params = self.build_params(params)
+
+        for attempt in range(self.max_retries + 1):
+            is_last = attempt == self.max_retries
+            self.governor.acquire(path)
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                weather_api_errors.inc(path)
+                self.governor.record_failure()
+                if is_last:
+                    raise UpstreamUnavailable(f"OpenWeatherMap не отвечает, запрос {path} не выполнен") from e
+                delay = self.backoff(attempt)
+            else:
+                weather_api_seconds.observe(time.perf_counter() - started, path)
+                if response.status_code >= 400:
+                    weather_api_errors.inc(path)
+                self.record_outcome(response.status_code)
+                if response.status_code == 429 and not is_last:
+                    delay = self.retry_after(response, attempt)
+                elif response.status_code >= 500 and not is_last:
+                    delay = self.backoff(attempt)
+                else:
+                    return response
+            time.sleep(delay)
+
+    # Геокодинг: список найденных городов (пустой - город не найден).
+    # Ошибка API - UpstreamUnavailable, чтобы не путать её с ненайденным городом.
+    def geocode(self, city_name, limit=1):
+        response = self.get('/geo/1.0/direct', {'q': city_name, 'limit': limit})
+        if response.status_code != 200:
+            raise UpstreamUnavailable(f"OpenWeatherMap ответил {response.status_code} на геокодинг")
+        return response.json()
+
+    # Текущая погода по координатам (None, если API вернул ошибку)
+    def current_weather(self, lat, lon):
+        response = self.get('/data/2.5/weather', {'lat': lat, 'lon': lon, 'units': 'metric', 'lang': 'ru'})
+        if response.status_code == 200:
+            return response.json()
+        return None
+
+    # Прогноз на 5 дней с шагом 3 часа по координатам (None, если API вернул ошибку)
+    def forecast(self, lat, lon):
+        response = self.get('/data/2.5/forecast', {'lat': lat, 'lon': lon, 'units': 'metric', 'lang': 'ru'})
+        if response.status_code == 200:
+            return response.json()
+        return None
+
+    # Текущая погода сразу для нескольких городов по их id (не больше 20 за запрос)
+    def group_weather(self, city_ids):
+        response = self.get('/data/2.5/group', {'id': ','.join(str(city_id) for city_id in city_ids),
+                                                'units': 'metric', 'lang': 'ru'})
+        if response.status_code == 200:
+            return response.json().get('list', [])
+        return []
+
+
+# Асинхронный клиент OpenWeatherMap на aiohttp (для режима asyncio)
+class AsyncWeatherClient(WeatherClient):
+    # Сессия aiohttp создаётся при первом запросе, внутри работающего цикла событий
+    def create_session(self):
+        return None
+
+    async def get(self, path, params):
+        import aiohttp
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]),
+                connector=aiohttp.TCPConnector(limit=self.pool_size))
+
+        url = f"{self.base_url}{path}"
+        params = self.build_params(params)
+
+        for attempt in range(self.max_retries + 1):
+            is_last = attempt == self.max_retries
+            await self.governor.async_acquire(path)
+            started = time.perf_counter()
+            try:
+                async with self.session.get(url, params=params) as response:
+                    weather_api_seconds.observe(time.perf_counter() - started, path)
+                    if response.status >= 400:
+                        weather_api_errors.inc(path)
+                    self.record_outcome(response.status)
+                    if response.status == 429 and not is_last:
+                        delay = self.retry_after(response, attempt)
+                    elif response.status >= 500 and not is_last:
+                        delay = self.backoff(attempt)
+                    else:
+                        data = await response.json(content_type=None) if response.status == 200 else None
+                        return response.status, data
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                weather_api_errors.inc(path)
+                self.governor.record_failure()
+                if is_last:
+                    raise UpstreamUnavailable(f"OpenWeatherMap не отвечает, запрос {path} не выполнен") from e
+                delay = self.backoff(attempt)
+            await asyncio.sleep(delay)
+
+    async def geocode(self, city_name, limit=1):
+        status, data = await self.get('/geo/1.0/direct', {'q': city_name, 'limit': limit})
+        if status != 200:
+            raise UpstreamUnavailable(f"OpenWeatherMap ответил {status} на геокодинг")
+        return data
+
+    async def current_weather(self, lat, lon):
+        status, data = await self.get('/data/2.5/weather', {'lat': lat, 'lon': lon, 'units': 'metric', 'lang': 'ru'})
+        return data
+
+    async def forecast(self, lat, lon):
+        status, data = await self.get('/data/2.5/forecast', {'lat': lat, 'lon': lon, 'units': 'metric', 'lang': 'ru'})
+        return data
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+weather_client = WeatherClient(WEATHER_API_BASE_URL, WEATHER_API_KEY)
+async_weather_client = AsyncWeatherClient(WEATHER_API_BASE_URL, WEATHER_API_KEY)
+
+
+# Размер кэша координат городов в памяти
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', '10000'))
+
+# Кэш координат в памяти (LRU): нормализованное название -> (lat, lon, город, страна)
+geocode_cache = OrderedDict()
+geocode_cache_lock = threading.Lock()
+
+
+# Функция для приведения названия города к единому виду (регистр, пробелы, ё)
+def normalize_city_name(city):
+    return ' '.join(city.lower().replace('ё', 'е').split())
+
+
+# Функция для чтения координат из кэша в памяти
+def geocode_cache_get(key):
+    with geocode_cache_lock:
+        value = geocode_cache.get(key)
+        if value is not None:
+            geocode_cache.move_to_end(key)
+        return value
+
+
+# Функция для записи координат в кэш в памяти
+def geocode_cache_put(keys, value):
+    with geocode_cache_lock:
+        for key in keys:
+            geocode_cache[key] = value
+            geocode_cache.move_to_end(key)
+        while len(geocode_cache) > GEOCODE_CACHE_SIZE:
+            geocode_cache.popitem(last=False)
+
+
+# Функция для загрузки кэша координат из базы при запуске
+def load_geocode_cache():
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT query, lat, lon, name, country FROM geocode_cache LIMIT ?', (GEOCODE_CACHE_SIZE,))
+    rows = cursor.fetchall()
+
+    for query, lat, lon, name, country in rows:
+        geocode_cache_put([query], (lat, lon, name, country))
+
+
+# Функция для поиска координат в базе (если они вытеснены из памяти)
+@timed(db_seconds, db_errors)
+def get_saved_coordinates(key):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT lat, lon, name, country FROM geocode_cache WHERE query = ?', (key,))
+    row = cursor.fetchone()
+    return row
+
+
+# Функция для сохранения координат в базу под всеми синонимами названия
+@timed(db_seconds, db_errors)
+def save_coordinates(keys, value):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.executemany(
+        'INSERT OR REPLACE INTO geocode_cache (query, lat, lon, name, country) VALUES (?, ?, ?, ?, ?)',
+        [(key, *value) for key in keys])
+    conn.commit()
+
+
+# Самое длинное название города, которое имеет смысл отправлять в геокодинг
+CITY_NAME_MAX_LENGTH = int(os.getenv('CITY_NAME_MAX_LENGTH', '60'))
+# Самое большое число слов в названии («Рио-де-Жанейро» - одно слово, «Нижний Новгород» - два)
+CITY_NAME_MAX_WORDS = 5
+# Название: буквы любого алфавита, между ними пробелы, дефисы, апострофы, точки и запятая
+# перед кодом страны («London, GB»); цифры, ссылки, эмодзи и команды сюда не проходят
+CITY_NAME_PATTERN = re.compile(r"[^\W\d_]+(?:[ '’.,-]+[^\W\d_]+)*\.?")
+
+# Сколько помнить названия, для которых геокодинг ничего не нашёл
+GEOCODE_MISS_TTL = int(os.getenv('GEOCODE_MISS_TTL', '3600'))
+GEOCODE_MISS_CACHE_SIZE = int(os.getenv('GEOCODE_MISS_CACHE_SIZE', '10000'))
+
+# Кэш ненайденных названий (LRU): нормализованное название -> время, до которого запись действует
+geocode_miss_cache = OrderedDict()
+geocode_miss_lock = threading.Lock()
+
+city_input_rejected = Counter('weather_bot_city_input_rejected_total',
+                              'Тексты, отброшенные до запроса геокодинга', ('reason',))
+
+
+# Функция для проверки текста перед геокодингом: причина отказа или None, если текст похож на город
+def city_input_rejection(text):
+    text = text.strip()
+    if not text:
+        return 'empty'
+    if text.startswith('/'):
+        return 'command'
+    if len(text) > CITY_NAME_MAX_LENGTH:
+        return 'too_long'
+    if len(text.split()) > CITY_NAME_MAX_WORDS:
+        return 'too_many_words'
+    if not CITY_NAME_PATTERN.fullmatch(text):
+        return 'characters'
+    return None
+
+
+# Функция для проверки, что название недавно не нашлось в геокодинге
+def geocode_miss_get(key):
+    with geocode_miss_lock:
+        expires_at = geocode_miss_cache.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < time.monotonic():
+            del geocode_miss_cache[key]
+            return False
+        geocode_miss_cache.move_to_end(key)
+        return True
+
+
+# Функция для запоминания названия, которое геокодинг не нашёл
+def geocode_miss_put(key):
+    with geocode_miss_lock:
+        geocode_miss_cache[key] = time.monotonic() + GEOCODE_MISS_TTL
+        geocode_miss_cache.move_to_end(key)
+        while len(geocode_miss_cache) > GEOCODE_MISS_CACHE_SIZE:
+            geocode_miss_cache.popitem(last=False)
+
+
+# Локальный справочник городов: собирается build_city_index.py из data/cities.csv и открывается через mmap
+CITY_INDEX_PATH = os.getenv('CITY_INDEX_PATH',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cities.idx'))
+# Формат файла: заголовок, записи городов, отсортированные ключи (названия), отсортированные
+# варианты ключей без одной буквы (для поиска с опечаткой), строки
+CITY_INDEX_MAGIC = b'CTYX'
+CITY_INDEX_VERSION = 1
+# Заголовок: магия, версия, количество городов, ключей и вариантов без буквы
+CITY_INDEX_HEADER = struct.Struct('<4sHIII')
+# Город: широта, долгота, население (тыс.), смещения русского и английского названий, страна
+CITY_RECORD = struct.Struct('<ffIII2s')
+# Ключ: смещение строки, её длина в байтах, номер города (для вариантов без буквы - номер ключа)
+CITY_KEY_RECORD = struct.Struct('<IHI')
+# Сколько ключей с общим началом просматривать при поиске по префиксу
+CITY_PREFIX_SCAN = 200
+
+
+# Функция для вариантов названия, под которыми город попадает в справочник (дефис можно писать пробелом)
+def city_name_variants(name):
+    key = normalize_city_name(name)
+    return {key, ' '.join(key.replace('-', ' ').split())}
+
+
+# Функция для расстояния между строками (вставка, удаление, замена, перестановка соседних букв)
+def edit_distance(a, b):
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+# Справочник городов в файле, открытом через mmap: поиск двоичным поиском прямо по файлу
+class CityIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.city_count, self.key_count, self.delete_count = \
+            CITY_INDEX_HEADER.unpack_from(self.data, 0)
+        if magic != CITY_INDEX_MAGIC or version != CITY_INDEX_VERSION:
+            raise ValueError(f"неизвестный формат справочника городов: {path}")
+        self.cities_offset = CITY_INDEX_HEADER.size
+        self.keys_offset = self.cities_offset + self.city_count * CITY_RECORD.size
+        self.deletes_offset = self.keys_offset + self.key_count * CITY_KEY_RECORD.size
+        self.strings_offset = self.deletes_offset + self.delete_count * CITY_KEY_RECORD.size
+
+    # Ключ таблицы (байты строки) и номер, на который он ссылается
+    def entry(self, table, index):
+        offset, length, target = CITY_KEY_RECORD.unpack_from(self.data, table + index * CITY_KEY_RECORD.size)
+        start = self.strings_offset + offset
+        return self.data[start:start + length], target
+
+    # Первая позиция в таблице, ключ на которой не меньше искомого
+    def lower_bound(self, table, count, needle):
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(table, mid)[0] < needle:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Номера, на которые ссылаются все ключи таблицы, равные искомому
+    def targets(self, table, count, needle):
+        index = self.lower_bound(table, count, needle)
+        while index < count:
+            key, target = self.entry(table, index)
+            if key != needle:
+                break
+            yield target
+            index += 1
+
+    # Строка из области строк (названия хранятся с нулевым байтом в конце)
+    def name(self, offset):
+        start = self.strings_offset + offset
+        return self.data[start:self.data.find(b'\0', start)].decode('utf-8')
+
+    # Город по номеру: (lat, lon, русское название, страна, английское название, население в тыс.)
+    def city(self, index):
+        lat, lon, population, name_ru, name_en, country = \
+            CITY_RECORD.unpack_from(self.data, self.cities_offset + index * CITY_RECORD.size)
+        return round(lat, 4), round(lon, 4), self.name(name_ru), country.decode('ascii'), self.name(name_en), population
+
+    # Город по точному (нормализованному) названию; при совпадении названий - самый крупный
+    def exact(self, key):
+        for target in self.targets(self.keys_offset, self.key_count, key.encode('utf-8')):
+            return self.city(target)
+        return None
+
+    # Номера городов, названия которых начинаются с указанного текста
+    def prefix(self, text):
+        needle = text.encode('utf-8')
+        index = self.lower_bound(self.keys_offset, self.key_count, needle)
+        found = []
+        for index in range(index, min(index + CITY_PREFIX_SCAN, self.key_count)):
+            key, target = self.entry(self.keys_offset, index)
+            if not key.startswith(needle):
+                break
+            found.append(target)
+        return found
+
+    # Номера городов, названия которых отличаются от текста на одну опечатку.
+    # Варианты без одной буквы собраны заранее, поэтому нужно лишь несколько двоичных поисков.
+    def fuzzy(self, text):
+        variants = {text} | {text[:i] + text[i + 1:] for i in range(len(text))}
+        key_indexes = set()
+        for variant in variants:
+            needle = variant.encode('utf-8')
+            # Текст длиннее названия на букву
+            index = self.lower_bound(self.keys_offset, self.key_count, needle)
+            if index < self.key_count and self.entry(self.keys_offset, index)[0] == needle:
+                key_indexes.add(index)
+            # Название длиннее текста на букву, замена или перестановка букв
+            key_indexes.update(self.targets(self.deletes_offset, self.delete_count, needle))
+
+        found = []
+        for index in key_indexes:
+            key, target = self.entry(self.keys_offset, index)
+            if edit_distance(text, key.decode('utf-8')) <= 1:
+                found.append(target)
+        return found
+
+
+# Справочник открывается при первом обращении (None - файла нет или он повреждён)
+city_index = None
+city_index_loaded = False
+city_index_lock = threading.Lock()
+
+
+# Функция для получения справочника городов
+def get_city_index():
+    global city_index, city_index_loaded
+    if not city_index_loaded:
+        with city_index_lock:
+            if not city_index_loaded:
+                try:
+                    city_index = CityIndex(CITY_INDEX_PATH)
+                except (OSError, ValueError) as e:
+                    print(f"Справочник городов недоступен, города ищутся только через API: {e}")
+                city_index_loaded = True
+    return city_index
+
+
+# Функция для поиска координат города в локальном справочнике
+def local_city_coordinates(key):
+    index = get_city_index()
+    city = index.exact(key) if index is not None else None
+    if city is None:
+        return None
+    lat, lon, name, country, _, _ = city
+    return lat, lon, name, country
+
+
+# Функция для поиска городов по началу названия, а если их мало - и с опечаткой (крупные города первыми)
+def search_cities(text, limit=10):
+    index = get_city_index()
+    key = normalize_city_name(text)
+    if index is None or not key:
+        return []
+
+    targets = list(dict.fromkeys(index.prefix(key)))
+    if len(targets) < limit and len(key) >= 3:
+        targets += [target for target in index.fuzzy(key) if target not in targets]
+    cities = [index.city(target) for target in targets]
+    cities.sort(key=lambda city: city[5], reverse=True)
+    return cities[:limit]
+
+
+# Функция для подсказок при опечатке: названия похожих городов, если сам город неизвестен
+# ни справочнику, ни кэшу (пустой список - можно спрашивать API). Подсказки показываются до
+# запроса к API, поэтому это только «может быть», а не «город не найден».
+def get_city_suggestions(city, limit=3):
+    index = get_city_index()
+    key = normalize_city_name(city)
+    if index is None or len(key) < 3 or lookup_city_coordinates(key) is not None:
+        return []
+    cities = sorted((index.city(target) for target in set(index.fuzzy(key))), key=lambda city: city[5], reverse=True)
+    return [city[2] for city in cities[:limit]]
+
+
+# Координаты, уже найденные при разборе текущего обновления: ключ -> координаты или None.
+# Подсказки, фильтр и сам запрос погоды смотрят один и тот же город, а искать его (и считать
+# промах кэша в метриках) нужно один раз.
+city_lookups = contextvars.ContextVar('city_lookups', default=None)
+
+
+# Функция для вызова обработчика с отдельным набором найденных координат на одно обновление
+def call_with_city_lookups(handler, update):
+    token = city_lookups.set({})
+    try:
+        return handler(update)
+    finally:
+        city_lookups.reset(token)
+
+
+# Функция для поиска координат без запроса к API (результат запоминается до конца обновления)
+def lookup_city_coordinates(key):
+    lookups = city_lookups.get()
+    if lookups is not None and key in lookups:
+        return lookups[key]
+    result = find_city_coordinates(key)
+    if lookups is not None:
+        lookups[key] = result
+    return result
+
+
+# Функция для поиска координат (сначала кэш в памяти, потом справочник городов, потом база)
+def find_city_coordinates(key):
+    cached = geocode_cache_get(key)
+    if cached is not None:
+        cache_requests.inc('geocode', 'hit')
+        return cached
+
+    local = local_city_coordinates(key)
+    if local is not None:
+        cache_requests.inc('geocode', 'gazetteer_hit')
+        return local
+
+    saved = get_saved_coordinates(key)
+    if saved is not None:
+        cache_requests.inc('geocode', 'db_hit')
+        geocode_cache_put([key], saved)
+    else:
+        cache_requests.inc('geocode', 'miss')
+    return saved
+
+
+# Функция для названия города на кнопках: найденное название (из кэша координат или справочника),
+# а не текст пользователя, чтобы «москва», «Москва » и «Moscow» были одним городом
+def canonical_city_name(city):
+    key = normalize_city_name(city)
+    found = geocode_cache_get(key) or local_city_coordinates(key)
+    if found is not None and found[2]:
+        return found[2]
+    return key
+
+
+# Функция для разбора ответа геокодинга и сохранения его в кэш
+def remember_city_coordinates(key, data):
+    if data and len(data) > 0:
+        lat = data[0]['lat']
+        lon = data[0]['lon']
+        local_names = data[0].get('local_names', {})
+        found_city = local_names.get('ru', data[0]['name'])
+        country = data[0].get('country', '')
+        result = (lat, lon, found_city, country)
+
+        # Запоминаем город и под запросом, и под русским и латинским названием
+        aliases = {key, normalize_city_name(found_city), normalize_city_name(data[0]['name'])}
+        if local_names.get('en'):
+            aliases.add(normalize_city_name(local_names['en']))
+        geocode_cache_put(aliases, result)
+        save_coordinates(aliases, result)
+        return result
+    # Пустой список - город точно не найден (в отличие от ошибки API), повторно не спрашиваем
+    if data == []:
+        geocode_miss_put(key)
+    return None, None, None, None
+
+
+# Функция для получения координат города (геокодинг).
+# Если OpenWeatherMap недоступен, выбрасывает UpstreamUnavailable (город при этом может существовать).
+@timed(function_seconds, function_errors)
+def get_city_coordinates(city_name):
+    key = normalize_city_name(city_name)
+    cached = lookup_city_coordinates(key)
+    if cached is not None:
+        return cached
+    if geocode_miss_get(key):
+        cache_requests.inc('geocode', 'negative_hit')
+        return None, None, None, None
+
+    return remember_city_coordinates(key, weather_client.geocode(city_name))
+
+
+# Время жизни кэша погоды (OpenWeatherMap обновляет данные примерно раз в 10 минут)
+WEATHER_CACHE_TTL = int(os.getenv('WEATHER_CACHE_TTL', '600'))
+# Максимальное количество точек в кэше погоды
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', '5000'))
+# Насколько устаревшую погоду показывать, когда OpenWeatherMap недоступен
+WEATHER_STALE_MAX_AGE = int(os.getenv('WEATHER_STALE_MAX_AGE', '21600'))
+
+# Кэш погоды (LRU): округлённые координаты -> (время получения, данные API)
+weather_cache = OrderedDict()
+weather_cache_lock = threading.Lock()
+# Запросы погоды, которые выполняются прямо сейчас: ключ -> {'event', 'data', 'error', 'priority'}
+weather_inflight = {}
+# Сколько городов помещается в один групповой запрос
+WEATHER_GROUP_SIZE = 20
+
+weather_executor = ThreadPoolExecutor(max_workers=WEATHER_POOL_SIZE, thread_name_prefix='weather')
+
+# Погода, заранее полученная для текущего обработчика в режиме asyncio: город -> (сообщение, ошибка)
+prefetched_weather = contextvars.ContextVar('prefetched_weather', default=None)
+
+
+# Функция для параллельного вызова в пуле погоды с приоритетом запросов вызывающего потока
+def map_with_priority(func, items):
+    priority = upstream_priority.get()
+
+    def run(item):
+        token = upstream_priority.set(priority)
+        try:
+            return func(item)
+        finally:
+            upstream_priority.reset(token)
+
+    return weather_executor.map(run, items)
+
+
+# Функция для разбора ошибки общего запроса у того, кто его ждал: True - запросить самому.
+# Отказ регулятора запросу с более низким приоритетом (прогрев, напоминания) не относится к
+# интерактивному запросу, остальные ошибки ведущего пробрасываются ожидавшим.
+def flight_should_retry(error, priority):
+    if error is None:
+        return False
+    if isinstance(error, UpstreamUnavailable) and upstream_priority.get() < priority:
+        return True
+    raise error
+
+
+# Функция для получения ключа кэша погоды по координатам
+def weather_cache_key(lat, lon):
+    return round(lat, 2), round(lon, 2)
+
+
+# Функция для запроса текущей погоды у OpenWeatherMap
+def fetch_current_weather(lat, lon):
+    return weather_client.current_weather(lat, lon)
+
+
+# Функция для чтения свежей погоды из кэша (вызывается под weather_cache_lock)
+def weather_cache_lookup(key):
+    entry = weather_cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < WEATHER_CACHE_TTL:
+        cache_requests.inc('weather', 'hit')
+        weather_cache.move_to_end(key)
+        return entry[1]
+    cache_requests.inc('weather', 'miss')
+    return None
+
+
+# Функция для чтения последней известной погоды, даже устаревшей (когда API недоступен).
+# Возвращает копию данных с возрастом в секундах (stale_seconds) или None.
+def weather_cache_stale(key):
+    with weather_cache_lock:
+        entry = weather_cache.get(key)
+    if entry is None:
+        return None
+    age = time.monotonic() - entry[0]
+    if age > WEATHER_STALE_MAX_AGE:
+        return None
+    cache_requests.inc('weather', 'stale')
+    return dict(entry[1], stale_seconds=age)
+
+
+# Функция для записи погоды в кэш с вытеснением самых старых точек
+def weather_cache_store(key, data):
+    with weather_cache_lock:
+        weather_cache[key] = (time.monotonic(), data)
+        weather_cache.move_to_end(key)
+        while len(weather_cache) > WEATHER_CACHE_SIZE:
+            weather_cache.popitem(last=False)
+
+
+# Функция для получения id города OpenWeatherMap для точки (нужен для группового запроса).
+# id берётся из записи кэша, даже устаревшей, и вытесняется вместе с ней.
+# Вызывается под weather_cache_lock.
+def weather_cache_city_id(key):
+    entry = weather_cache.get(key)
+    return entry[1].get('id') if entry is not None else None
+
+
+# Функция для получения текущей погоды с кэшем и объединением одинаковых запросов
+def get_current_weather(lat, lon):
+    key = weather_cache_key(lat, lon)
+
+    with weather_cache_lock:
+        data = weather_cache_lookup(key)
+        if data is not None:
+            return data
+
+        flight = weather_inflight.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = {'event': threading.Event(), 'data': None, 'error': None,
+                      'priority': upstream_priority.get()}
+            weather_inflight[key] = flight
+
+    # Кто-то уже запрашивает эту точку - ждём его результат
+    if not is_leader:
+        flight['event'].wait()
+        if flight_should_retry(flight['error'], flight['priority']):
+            return get_current_weather(lat, lon)
+        return flight['data']
+
+    try:
+        try:
+            data = fetch_current_weather(lat, lon)
+        except Exception:
+            # API недоступен: отвечаем последней известной погодой, если она есть
+            data = weather_cache_stale(key)
+            if data is None:
+                raise
+        else:
+            if data is not None:
+                weather_cache_store(key, data)
+            else:
+                data = weather_cache_stale(key)
+        flight['data'] = data
+        return data
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with weather_cache_lock:
+            weather_inflight.pop(key, None)
+        flight['event'].set()
+
+
+# Функция для оформления сообщения о погоде
+def format_weather_message(data, city_name, country):
+    temperature = data['main']['temp']
+    feels_like = data['main']['feels_like']
+    humidity = data['main']['humidity']
+    pressure = data['main']['pressure']
+    wind_speed = data['wind']['speed']
+    weather_main = data['weather'][0]['main'].lower()
+    weather_description = data['weather'][0]['description']
+
+    weather_emoji = weather_conditions.get(weather_main, '🌡')
+
+    return (
+        f"🏙 *{city_name}, {country}*\n\n"
+        f"{weather_emoji} *{weather_description.capitalize()}*\n\n"
+        f"🌡 *Температура:* {temperature:.1f}°C\n"
+        f"🤔 *Ощущается как:* {feels_like:.1f}°C\n"
+        f"💧 *Влажность:* {humidity}%\n"
+        f"📊 *Давление:* {pressure} гПа\n"
+        f"💨 *Ветер:* {wind_speed} м/с\n\n"
+        f"{format_stale_note(data)}"
+        f"✨ Хорошего дня!"
+    )
+
+
+# Функция для пометки об устаревших данных (погода из кэша, пока OpenWeatherMap недоступен)
+def format_stale_note(data):
+    stale_seconds = data.get('stale_seconds')
+    if stale_seconds is None:
+        return ""
+    minutes = max(1, round(stale_seconds / 60))
+    return f"🕒 _Сервис погоды недоступен, данные обновлены {minutes} мин назад_\n\n"
+
+
+# Функция для получения ответа (сообщение, ошибка) по данным о погоде
+def build_weather_reply(data, city_name, country):
+    if data is not None:
+        return format_weather_message(data, city_name, country), None
+    else:
+        return None, f"❌ Не удалось получить погоду для города {city_name}"
+
+
+# Функция для получения погоды по координатам
+@timed(function_seconds, function_errors)
+def get_weather_by_coords(lat, lon, city_name, country):
+    try:
+        return build_weather_reply(get_current_weather(lat, lon), city_name, country)
+
+    except UpstreamUnavailable as e:
+        print(f"Ошибка погоды: {e}")
+        return None, weather_unavailable_message()
+    except Exception:
+        return None, "😕 Произошла ошибка. Попробуй позже!"
+
+
+# Функция для получения погоды сразу для многих точек: ключ кэша -> данные API.
+# Свежие данные берутся из кэша, известные города - групповыми запросами по 20,
+# остальные - параллельно по одному.
+def fetch_weather_batch(points):
+    points = {weather_cache_key(lat, lon): (lat, lon) for lat, lon in points}
+    results = {}
+
+    with weather_cache_lock:
+        for key in points:
+            data = weather_cache_lookup(key)
+            if data is not None:
+                results[key] = data
+        keys_by_id = {}
+        for key in points:
+            city_id = weather_cache_city_id(key) if key not in results else None
+            if city_id:
+                keys_by_id[city_id] = key
+
+    city_ids = list(keys_by_id)
+    for start in range(0, len(city_ids), WEATHER_GROUP_SIZE):
+        try:
+            items = weather_client.group_weather(city_ids[start:start + WEATHER_GROUP_SIZE])
+        except Exception as e:
+            print(f"Ошибка группового запроса погоды: {e}")
+            continue
+        for data in items:
+            key = keys_by_id.get(data.get('id'))
+            if key is not None:
+                weather_cache_store(key, data)
+                results[key] = data
+
+    missing = [key for key in points if key not in results]
+    for key, data in zip(missing, map_with_priority(lambda key: get_current_weather(*points[key]), missing)):
+        if data is not None:
+            results[key] = data
+    return results
+
+
+# Функция для координат города в групповой выборке: None, если OpenWeatherMap недоступен
+def get_city_coordinates_or_none(city_name):
+    try:
+        return get_city_coordinates(city_name)
+    except Exception as e:
+        print(f"Ошибка геокодинга: {e}")
+        return None
+
+
+# Функция для получения погоды сразу для нескольких городов: город -> (сообщение, ошибка)
+def get_weather_info_batch(cities):
+    cities = list(dict.fromkeys(cities))
+    coordinates = dict(zip(cities, map_with_priority(get_city_coordinates_or_none, cities)))
+    weather = fetch_weather_batch([point[:2] for point in coordinates.values() if point and point[0] and point[1]])
+
+    results = {}
+    for city, point in coordinates.items():
+        if point is None:
+            results[city] = None, weather_unavailable_message()
+            continue
+        lat, lon, found_city, country = point
+        if lat and lon:
+            results[city] = build_weather_reply(weather.get(weather_cache_key(lat, lon)), found_city, country)
+        else:
+            results[city] = None, city_not_found_message(city)
+    return results
+
+
+# Функция для текста ошибки "город не найден"
+def city_not_found_message(city):
+    return f"❌ Город '{city}' не найден. Проверь название или попробуй написать на английском!"
+
+
+# Функция для текста ошибки "сервис погоды недоступен" (город при этом мог и найтись)
+def weather_unavailable_message():
+    return "⏳ Сервис погоды сейчас недоступен. Попробуй через пару минут!"
+
+
+# Функция для получения погоды (основная, с геокодингом)
+def get_weather_info(city):
+    # В режиме asyncio погода для обработчика получена заранее, без блокировки цикла событий
+    prefetched = prefetched_weather.get()
+    if prefetched is not None and city in prefetched:
+        return prefetched[city]
+
+    try:
+        lat, lon, found_city, country = get_city_coordinates(city)
+
+        if lat and lon:
+            return get_weather_by_coords(lat, lon, found_city, country)
+        else:
+            return None, city_not_found_message(city)
+
+    except UpstreamUnavailable as e:
+        print(f"Ошибка геокодинга: {e}")
+        return None, weather_unavailable_message()
+    except Exception as e:
+        print(f"Ошибка: {e}")
+        return None, f"😕 Произошла ошибка. Попробуй позже!"
+
+
+# Асинхронные версии функций погоды: те же кэши, но запросы через aiohttp
+
+# Запросы погоды, которые выполняются прямо сейчас в цикле событий:
+# ключ -> (Future с парой (данные, ошибка), приоритет ведущего запроса)
+async_weather_inflight = {}
+
+
+async def async_get_city_coordinates(city_name):
+    key = normalize_city_name(city_name)
+    cached = lookup_city_coordinates(key)
+    if cached is not None:
+        return cached
+    if geocode_miss_get(key):
+        cache_requests.inc('geocode', 'negative_hit')
+        return None, None, None, None
+
+    return remember_city_coordinates(key, await async_weather_client.geocode(city_name))
+
+
+async def async_get_current_weather(lat, lon):
+    key = weather_cache_key(lat, lon)
+
+    with weather_cache_lock:
+        data = weather_cache_lookup(key)
+    if data is not None:
+        return data
+
+    flight = async_weather_inflight.get(key)
+    if flight is not None:
+        future, priority = flight
+        data, error = await asyncio.shield(future)
+        if flight_should_retry(error, priority):
+            return await async_get_current_weather(lat, lon)
+        return data
+
+    flight = asyncio.get_running_loop().create_future()
+    async_weather_inflight[key] = (flight, upstream_priority.get())
+    try:
+        try:
+            data = await async_weather_client.current_weather(lat, lon)
+        except Exception:
+            data = weather_cache_stale(key)
+            if data is None:
+                raise
+        else:
+            if data is not None:
+                weather_cache_store(key, data)
+            else:
+                data = weather_cache_stale(key)
+        flight.set_result((data, None))
+        return data
+    except Exception as e:
+        flight.set_result((None, e))
+        raise
+    except BaseException:
+        flight.set_result((None, None))
+        raise
+    finally:
+        async_weather_inflight.pop(key, None)
+
+
+async def async_get_weather_info(city):
+    try:
+        lat, lon, found_city, country = await async_get_city_coordinates(city)
+
+        if lat and lon:
+            try:
+                return build_weather_reply(await async_get_current_weather(lat, lon), found_city, country)
+            except UpstreamUnavailable as e:
+                print(f"Ошибка погоды: {e}")
+                return None, weather_unavailable_message()
+            except Exception:
+                return None, "😕 Произошла ошибка. Попробуй позже!"
+        else:
+            return None, city_not_found_message(city)
+
+    except UpstreamUnavailable as e:
+        print(f"Ошибка геокодинга: {e}")
+        return None, weather_unavailable_message()
+    except Exception as e:
+        print(f"Ошибка: {e}")
+        return None, f"😕 Произошла ошибка. Попробуй позже!"
+
+
+# Прогноз погоды: весь прогноз города (5 дней по 3 часа) запрашивается один раз и хранится
+# в кэше в виде колонок; виды «Сегодня», «Завтра» и «Неделя» строятся из одной копии
+
+# Время жизни прогноза в кэше (OpenWeatherMap обновляет прогноз раз в 3 часа)
+FORECAST_CACHE_TTL = int(os.getenv('FORECAST_CACHE_TTL', '1800'))
+# Максимальное количество точек в кэше прогнозов
+FORECAST_CACHE_SIZE = int(os.getenv('FORECAST_CACHE_SIZE', '1000'))
+# Сколько дней показывать в виде «Неделя» (API отдаёт прогноз на 5 дней вперёд)
+FORECAST_DAYS = 6
+
+# Кэш прогнозов (LRU): округлённые координаты -> (время получения, Forecast)
+forecast_cache = OrderedDict()
+forecast_cache_lock = threading.Lock()
+# Запросы прогноза, которые выполняются прямо сейчас: ключ -> {'event', 'data', 'error', 'priority'}
+forecast_inflight = {}
+
+# Названия дней недели по номеру (0 - понедельник)
+week_day_names = list(week_days.values())
+
+
+# Прогноз в колонках: время шага (unix), температура и код погоды OpenWeatherMap.
+# Минимум, максимум и преобладающая погода за день считаются по срезам массивов.
+class Forecast:
+    __slots__ = ('times', 'temps', 'codes', 'utc_offset')
+
+    def __init__(self, data):
+        items = data.get('list', [])
+        self.times = array('q', [item['dt'] for item in items])
+        self.temps = array('f', [item['main']['temp'] for item in items])
+        self.codes = array('H', [item['weather'][0]['id'] for item in items])
+        # Смещение местного времени города от UTC, в секундах
+        self.utc_offset = data.get('city', {}).get('timezone', 0)
+
+    # Местное время шага прогноза
+    def local_time(self, timestamp):
+        return datetime.fromtimestamp(timestamp + self.utc_offset, timezone.utc)
+
+    # Границы среза шагов, попадающих в местный день (0 - сегодня), и дата этого дня
+    def day_slice(self, day_offset):
+        today = int((time.time() + self.utc_offset) // 86400)
+        start = (today + day_offset) * 86400 - self.utc_offset
+        lo = bisect.bisect_left(self.times, start)
+        hi = bisect.bisect_left(self.times, start + 86400, lo)
+        return lo, hi, datetime.fromtimestamp((today + day_offset) * 86400, timezone.utc).date()
+
+    # Сводка по дням: [(дата, минимум, максимум, преобладающий код погоды)]
+    def daily_summary(self, days):
+        summary = []
+        for day_offset in range(days):
+            lo, hi, day = self.day_slice(day_offset)
+            if lo == hi:
+                continue
+            temps = self.temps[lo:hi]
+            code = statistics.mode(self.codes[lo:hi])
+            summary.append((day, min(temps), max(temps), code))
+        return summary
+
+
+# Функция для описания погоды по коду OpenWeatherMap (группы 2xx-8xx)
+def condition_for_code(code):
+    if code == 800:
+        key = 'clear'
+    elif code > 800:
+        key = 'clouds'
+    else:
+        key = {2: 'thunderstorm', 3: 'drizzle', 5: 'rain', 6: 'snow', 7: 'mist'}.get(code // 100)
+    return weather_conditions.get(key, '🌡')
+
+
+# Функция для записи прогноза в кэш с вытеснением самых старых точек
+def forecast_cache_store(key, forecast):
+    with forecast_cache_lock:
+        forecast_cache[key] = (time.monotonic(), forecast)
+        forecast_cache.move_to_end(key)
+        while len(forecast_cache) > FORECAST_CACHE_SIZE:
+            forecast_cache.popitem(last=False)
+
+
+# Функция для чтения свежего прогноза из кэша (вызывается под forecast_cache_lock)
+def forecast_cache_lookup(key):
+    entry = forecast_cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < FORECAST_CACHE_TTL:
+        cache_requests.inc('forecast', 'hit')
+        forecast_cache.move_to_end(key)
+        return entry[1]
+    cache_requests.inc('forecast', 'miss')
+    return None
+
+
+# Функция для получения прогноза с кэшем и объединением одинаковых запросов
+def get_forecast(lat, lon):
+    key = weather_cache_key(lat, lon)
+
+    with forecast_cache_lock:
+        forecast = forecast_cache_lookup(key)
+        if forecast is not None:
+            return forecast
+
+        flight = forecast_inflight.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = {'event': threading.Event(), 'data': None, 'error': None,
+                      'priority': upstream_priority.get()}
+            forecast_inflight[key] = flight
+
+    if not is_leader:
+        flight['event'].wait()
+        if flight_should_retry(flight['error'], flight['priority']):
+            return get_forecast(lat, lon)
+        return flight['data']
+
+    try:
+        data = weather_client.forecast(lat, lon)
+        forecast = Forecast(data) if data is not None else None
+        flight['data'] = forecast
+        if forecast is not None:
+            forecast_cache_store(key, forecast)
+        return forecast
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with forecast_cache_lock:
+            forecast_inflight.pop(key, None)
+        flight['event'].set()
+
+
+# Функция для оформления прогноза по шагам на один день (0 - сегодня, 1 - завтра)
+def format_day_forecast(forecast, day_offset, city_name, country):
+    lo, hi, day = forecast.day_slice(day_offset)
+    title = "сегодня" if day_offset == 0 else "завтра"
+    if lo == hi:
+        return f"📅 *{city_name}, {country} — {title}*\n\nНа этот день прогноза пока нет."
+
+    temps = forecast.temps[lo:hi]
+    lines = [f"📅 *{city_name}, {country} — {title}, {week_day_names[day.weekday()].lower()} {day:%d.%m}*",
+             f"🌡 от {min(temps):+.0f}°C до {max(temps):+.0f}°C", ""]
+    for timestamp, temp, code in zip(forecast.times[lo:hi], temps, forecast.codes[lo:hi]):
+        lines.append(f"`{forecast.local_time(timestamp):%H:%M}` {condition_for_code(code)} {temp:+.0f}°C")
+    return "\n".join(lines)
+
+
+# Функция для оформления прогноза по дням
+def format_week_forecast(forecast, city_name, country):
+    lines = [f"📅 *{city_name}, {country} — прогноз по дням*", ""]
+    for day, low, high, code in forecast.daily_summary(FORECAST_DAYS):
+        lines.append(f"*{week_day_names[day.weekday()]}, {day:%d.%m}:* {condition_for_code(code)} "
+                     f"{low:+.0f}…{high:+.0f}°C")
+    return "\n".join(lines)
+
+
+# Виды прогноза: название -> функция(прогноз, город, страна) -> текст
+forecast_views = {
+    'today': lambda forecast, city_name, country: format_day_forecast(forecast, 0, city_name, country),
+    'tomorrow': lambda forecast, city_name, country: format_day_forecast(forecast, 1, city_name, country),
+    'week': format_week_forecast,
+}
+
+
+# Функция для получения прогноза (сообщение, ошибка) по названию города
+@timed(function_seconds, function_errors)
+def get_forecast_info(city, view):
+    try:
+        lat, lon, found_city, country = get_city_coordinates(city)
+        if not (lat and lon):
+            return None, city_not_found_message(city)
+
+        forecast = get_forecast(lat, lon)
+        if forecast is None:
+            return None, f"❌ Не удалось получить прогноз для города {found_city}"
+        return forecast_views[view](forecast, found_city, country), None
+
+    except UpstreamUnavailable as e:
+        print(f"Ошибка прогноза: {e}")
+        return None, weather_unavailable_message()
+    except Exception as e:
+        print(f"Ошибка прогноза: {e}")
+        return None, f"😕 Произошла ошибка. Попробуй позже!"
+
+
+# Функция для загрузки прогноза в кэш в режиме asyncio (обработчик потом читает его из кэша)
+async def async_prefetch_forecast(city):
+    try:
+        lat, lon, _, _ = await async_get_city_coordinates(city)
+        if not (lat and lon):
+            return
+        key = weather_cache_key(lat, lon)
+        with forecast_cache_lock:
+            if forecast_cache_lookup(key) is not None:
+                return
+        data = await async_weather_client.forecast(lat, lon)
+        if data is not None:
+            forecast_cache_store(key, Forecast(data))
+    except Exception as e:
+        print(f"Ошибка прогноза: {e}")
+
+
+# Сколько пропущенных минут планировщик догоняет после задержки
+REMINDER_CATCHUP_MINUTES = int(os.getenv('REMINDER_CATCHUP_MINUTES', '10'))
+# Максимальный сон планировщика: напоминания, добавленные другими копиями бота,
+# подхватываются не позже чем через это время (и страховка от перевода часов)
+REMINDER_MAX_SLEEP = 60
+# За сколько минут до напоминаний заранее загружать погоду в кэш (0 - не загружать).
+# Должно быть заметно меньше WEATHER_CACHE_TTL, иначе данные устареют до отправки.
+PREWARM_MINUTES = int(os.getenv('PREWARM_MINUTES', '2'))
+# Сколько городов одновременно запрашивать при рассылке напоминаний в режиме asyncio
+REMINDER_WORKERS = int(os.getenv('REMINDER_WORKERS', '16'))
+
+# Событие будит планировщик, когда набор напоминаний изменился
+reminders_changed = threading.Event()
+
+
+# Функция для получения напоминаний, которые должны сработать в указанную минуту
+# (из указанных шардов; None - из всех)
+@timed(db_seconds, db_errors)
+def get_due_reminders(moment, shards=None):
+    query = f'''
+        SELECT {REMINDER_COLUMNS} FROM reminders
+        WHERE is_active = 1 AND minute_of_day = ? AND weekday_mask & ? != 0
+    '''
+    params = [moment.hour * 60 + moment.minute, weekday_bit(moment)]
+    if shards is not None:
+        if not shards:
+            return []
+        query += f" AND user_id % ? IN ({', '.join('?' * len(shards))})"
+        params += [REMINDER_SHARDS, *shards]
+    return get_db().execute(query, params).fetchall()
+
+
+# Функция для поиска ближайшей минуты (после указанной), в которую есть напоминания
+@timed(db_seconds, db_errors)
+def next_reminder_moment(after):
+    cursor = get_db().cursor()
+    day_start = after.replace(hour=0, minute=0, second=0, microsecond=0)
+    first_minute = after.hour * 60 + after.minute + 1
+    for offset in range(8):
+        day = day_start + timedelta(days=offset)
+        cursor.execute('''
+            SELECT MIN(minute_of_day) FROM reminders
+            WHERE is_active = 1 AND minute_of_day >= ? AND weekday_mask & ? != 0
+        ''', (first_minute if offset == 0 else 0, weekday_bit(day)))
+        minute = cursor.fetchone()[0]
+        if minute is not None:
+            return day + timedelta(minutes=minute)
+    return None
+
+
+# Число шардов напоминаний (одинаковое у всех копий бота). Напоминание попадает в шард по user_id,
+# каждый шард рассылает только копия, которая держит его аренду в таблице reminder_shards.
+# Копии должны работать с одним файлом базы.
+REMINDER_SHARDS = max(int(os.getenv('REMINDER_SHARDS', '16')), 1)
+# Срок аренды шарда: за это время шарды упавшей копии переходят к живым
+REMINDER_LEASE_TTL = float(os.getenv('REMINDER_LEASE_TTL', '15'))
+# Как часто копия продлевает аренду и перераспределяет шарды
+REMINDER_HEARTBEAT = float(os.getenv('REMINDER_HEARTBEAT', '5'))
+# Идентификатор этой копии бота
+REPLICA_ID = os.getenv('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}-{random.getrandbits(32):08x}"
+
+# Шарды этой копии: шард -> окончание аренды (unix-время)
+shard_leases = {}
+# Последняя обработанная минута по каждому своему шарду (unix-время)
+shard_fired_until = {}
+# Шарды, рассылка которых идёт прямо сейчас (их нельзя отдавать другой копии)
+busy_shards = set()
+shard_lock = threading.Lock()
+
+
+# Функция для создания строк шардов (при первом запуске или увеличении REMINDER_SHARDS)
+def init_reminder_shards():
+    conn = get_db()
+    conn.executemany('INSERT OR IGNORE INTO reminder_shards (shard) VALUES (?)',
+                     [(shard,) for shard in range(REMINDER_SHARDS)])
+    conn.commit()
+
+
+# Функция для продления аренды своих шардов и захвата свободных: каждая копия держит не больше
+# своей доли шардов, лишние отдаёт, а шарды с истёкшей арендой забирает себе
+@timed(db_seconds, db_errors)
+def renew_reminder_leases():
+    now = time.time()
+    expires_at = now + REMINDER_LEASE_TTL
+    default_fired = int((datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=1)).timestamp())
+
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        # Захват шардов идёт в одной транзакции с блокировкой записи, чтобы две копии не взяли один шард
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            INSERT INTO reminder_replicas (replica_id, heartbeat_at) VALUES (?, ?)
+            ON CONFLICT (replica_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+        ''', (REPLICA_ID, now))
+        cursor.execute('DELETE FROM reminder_replicas WHERE heartbeat_at < ?', (now - REMINDER_LEASE_TTL * 4,))
+        cursor.execute('SELECT COUNT(*) FROM reminder_replicas WHERE heartbeat_at >= ?', (now - REMINDER_LEASE_TTL,))
+        live_replicas = max(cursor.fetchone()[0], 1)
+        target = -(-REMINDER_SHARDS // live_replicas)
+
+        cursor.execute('SELECT shard, owner, expires_at, fired_until FROM reminder_shards WHERE shard < ?',
+                       (REMINDER_SHARDS,))
+        rows = cursor.fetchall()
+        fired = {shard: fired_until for shard, _, _, fired_until in rows}
+        mine = sorted(shard for shard, owner, _, _ in rows if owner == REPLICA_ID)
+        free = [shard for shard, owner, lease_end, _ in rows if owner != REPLICA_ID and (owner is None or lease_end <= now)]
+
+        with shard_lock:
+            busy = set(busy_shards)
+        released = [shard for shard in reversed(mine) if shard not in busy][:max(len(mine) - target, 0)]
+        mine = [shard for shard in mine if shard not in released]
+        mine.extend(free[:max(target - len(mine), 0)])
+
+        if released:
+            cursor.executemany('UPDATE reminder_shards SET owner = NULL, expires_at = 0 WHERE shard = ? AND owner = ?',
+                               [(shard, REPLICA_ID) for shard in released])
+        cursor.executemany('UPDATE reminder_shards SET owner = ?, expires_at = ? WHERE shard = ?',
+                           [(REPLICA_ID, expires_at, shard) for shard in mine])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    with shard_lock:
+        acquired = [shard for shard in mine if shard not in shard_leases]
+        for shard in list(shard_leases):
+            if shard not in mine:
+                del shard_leases[shard]
+                shard_fired_until.pop(shard, None)
+        for shard in mine:
+            shard_leases[shard] = expires_at
+            if shard not in shard_fired_until:
+                shard_fired_until[shard] = fired[shard] if fired[shard] is not None else default_fired
+    if acquired:
+        print(f"🔀 Копия {REPLICA_ID} получила шарды напоминаний: {acquired}")
+        reminders_changed.set()
+    outbound_queue.set_global_rate(OUTBOUND_GLOBAL_RATE / live_replicas)
+
+
+# Фоновая задача: продление аренды шардов и заполнение расписания у напоминаний в старом формате
+def maintain_reminder_leases():
+    while True:
+        time.sleep(REMINDER_HEARTBEAT)
+        try:
+            renew_reminder_leases()
+            backfill_reminder_schedule()
+        except Exception as e:
+            print(f"Ошибка при продлении аренды шардов: {e}")
+
+
+# Функция для выбора своих шардов, по которым минута ещё не обработана; шарды помечаются занятыми
+def claim_reminder_shards(moment):
+    timestamp = int(moment.timestamp())
+    now = time.time()
+    with shard_lock:
+        shards = {shard for shard, lease_end in shard_leases.items()
+                  if lease_end > now and shard_fired_until.get(shard, timestamp) < timestamp}
+        busy_shards.update(shards)
+    return shards
+
+
+# Функция для отметки минуты обработанной по шардам (и снятия с них занятости).
+# Вызывается только после успешной волны: если запись не удалась, минута останется необработанной.
+def release_reminder_shards(shards, moment):
+    if not shards:
+        return
+    timestamp = int(moment.timestamp())
+    try:
+        conn = get_db()
+        conn.executemany('UPDATE reminder_shards SET fired_until = ? WHERE shard = ? AND owner = ?',
+                         [(timestamp, shard, REPLICA_ID) for shard in shards])
+        conn.commit()
+        with shard_lock:
+            for shard in shards:
+                if shard in shard_fired_until:
+                    shard_fired_until[shard] = max(shard_fired_until[shard], timestamp)
+    finally:
+        abandon_reminder_shards(shards)
+
+
+# Функция для снятия занятости с шардов без отметки минуты: после сбоя волны
+# следующий проход повторит минуту, а журнал отправки отсеет уже отправленное
+def abandon_reminder_shards(shards):
+    with shard_lock:
+        busy_shards.difference_update(shards)
+
+
+# Функция для получения минуты, с которой нужно продолжить рассылку: у только что
+# полученного шарда она может быть раньше, чем у остальных
+def get_reminder_resume_point(last_fired):
+    with shard_lock:
+        if not shard_fired_until:
+            return last_fired
+        oldest = datetime.fromtimestamp(min(shard_fired_until.values()))
+    return min(last_fired, oldest)
+
+
+# Функция для получения минут, которые планировщик ещё не обработал (с учётом догоняния)
+def pending_reminder_moments(last_fired):
+    now = datetime.now().replace(second=0, microsecond=0)
+    moment = max(last_fired, now - timedelta(minutes=REMINDER_CATCHUP_MINUTES))
+    moments = []
+    while moment < now:
+        moment += timedelta(minutes=1)
+        moments.append(moment)
+    return moments
+
+
+# Функция для расчёта сна планировщика до ближайшей минуты с напоминаниями
+def reminder_sleep_timeout(last_fired):
+    next_moment = next_reminder_moment(last_fired)
+    if next_moment is None:
+        return REMINDER_MAX_SLEEP
+    return min(max((next_moment - datetime.now()).total_seconds(), 0), REMINDER_MAX_SLEEP)
+
+
+# Сколько дней хранить журнал доставки напоминаний
+REMINDER_OUTBOX_RETENTION_DAYS = int(os.getenv('REMINDER_OUTBOX_RETENTION_DAYS', '7'))
+# Изменения состояния журнала пишутся одной транзакцией на пачку: при стольких накопленных
+# изменениях или раз в столько секунд. Больше пачка - меньше нагрузка на базу, но больше
+# напоминаний отправится повторно, если процесс упадёт до записи пачки.
+REMINDER_OUTBOX_BATCH = int(os.getenv('REMINDER_OUTBOX_BATCH', '100'))
+REMINDER_OUTBOX_FLUSH_SECONDS = float(os.getenv('REMINDER_OUTBOX_FLUSH_SECONDS', '1'))
+
+
+# Функция для записи напоминаний минуты в журнал доставки и выбора недоставленных: напоминания
+# минуты из указанных шардов плюс то, что осталось недоставленным за окно догоняния (например,
+# после перезапуска посреди рассылки). Уже доставленные повторно не отправляются.
+# Возвращает строки журнала (reminder_id, fire_at, chat_id, city), сгруппированные по городу.
+@timed(db_seconds, db_errors)
+def prepare_reminder_outbox(moment, shards):
+    if not shards:
+        return {}
+    fire_at = int(moment.timestamp())
+    window_start = int((moment - timedelta(minutes=REMINDER_CATCHUP_MINUTES)).timestamp())
+    shard_list = ', '.join('?' * len(shards))
+
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany('''
+            INSERT OR IGNORE INTO reminder_outbox (reminder_id, fire_at, chat_id, city, shard)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(reminder[0], fire_at, reminder[2], reminder[3], reminder[1] % REMINDER_SHARDS)
+              for reminder in get_due_reminders(moment, shards)])
+        # Недоставленное за пределами окна догоняния уже неактуально
+        cursor.execute(f'''
+            UPDATE reminder_outbox SET state = 'failed', error = 'expired'
+            WHERE fire_at < ? AND state = 'pending' AND shard IN ({shard_list})
+        ''', (window_start, *shards))
+        cursor.execute(f'''
+            SELECT reminder_id, fire_at, chat_id, city FROM reminder_outbox
+            WHERE fire_at BETWEEN ? AND ? AND state = 'pending' AND shard IN ({shard_list})
+        ''', (window_start, fire_at, *shards))
+        rows = cursor.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(normalize_city_name(row[3]), []).append(row)
+    return groups
+
+
+# Журнал доставки волны напоминаний: результаты копятся в памяти и пишутся в базу пачками
+class ReminderOutboxWriter:
+    def __init__(self, batch_size=REMINDER_OUTBOX_BATCH, flush_seconds=REMINDER_OUTBOX_FLUSH_SECONDS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.updates = []
+        self.written_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Результат доставки одной строки журнала (error=None - доставлено)
+    def record(self, row, error=None):
+        now = time.time()
+        if error is None:
+            reminders_sent.inc('sent')
+            reminder_delivery_lag.observe(now - row[1])
+            update = ('sent', now, None, row[0], row[1])
+        else:
+            reminders_sent.inc('error')
+            print(f"Ошибка при обработке напоминания: {error}")
+            update = ('failed', None, str(error)[:200], row[0], row[1])
+
+        with self.lock:
+            self.updates.append(update)
+            if len(self.updates) < self.batch_size and time.monotonic() - self.written_at < self.flush_seconds:
+                return
+            updates, self.updates = self.updates, []
+            self.written_at = time.monotonic()
+        self.write(updates)
+
+    # Запись накопленных результатов (в конце волны)
+    def flush(self):
+        with self.lock:
+            updates, self.updates = self.updates, []
+        self.write(updates)
+
+    # Запись пачки результатов одной транзакцией
+    def write(self, updates):
+        if not updates:
+            return
+        conn = get_db()
+        conn.executemany('UPDATE reminder_outbox SET state = ?, sent_at = ?, error = ? '
+                         'WHERE reminder_id = ? AND fire_at = ?', updates)
+        conn.commit()
+
+
+# Функция для отчёта о волне напоминаний: сколько доставлено, сколько ошибок и осталось,
+# и задержка доставки относительно минуты напоминания
+@timed(db_seconds, db_errors)
+def report_reminder_wave(moment, shards):
+    fire_at = int(moment.timestamp())
+    shard_list = ', '.join('?' * len(shards))
+    conn = get_db()
+    counts = dict(conn.execute(f'''
+        SELECT state, COUNT(*) FROM reminder_outbox
+        WHERE fire_at = ? AND shard IN ({shard_list}) GROUP BY state
+    ''', (fire_at, *shards)).fetchall())
+    lags = sorted(row[0] for row in conn.execute(f'''
+        SELECT sent_at - fire_at FROM reminder_outbox
+        WHERE fire_at = ? AND state = 'sent' AND shard IN ({shard_list})
+    ''', (fire_at, *shards)))
+
+    # Старые записи журнала больше не нужны
+    conn.execute('DELETE FROM reminder_outbox WHERE fire_at < ?',
+                 (fire_at - REMINDER_OUTBOX_RETENTION_DAYS * 86400,))
+    conn.commit()
+
+    if not counts:
+        return None
+    report = {
+        'sent': counts.get('sent', 0),
+        'failed': counts.get('failed', 0),
+        'pending': counts.get('pending', 0),
+        'lag_p50': lags[len(lags) // 2] if lags else None,
+        'lag_p95': lags[min(len(lags) - 1, len(lags) * 95 // 100)] if lags else None,
+        'lag_max': lags[-1] if lags else None,
+    }
+    lag_text = (f", задержка p50 {report['lag_p50']:.1f} с, p95 {report['lag_p95']:.1f} с, "
+                f"макс. {report['lag_max']:.1f} с") if lags else ""
+    print(f"📬 Напоминания {moment:%H:%M}: доставлено {report['sent']}, ошибок {report['failed']}, "
+          f"не доставлено {report['pending']}{lag_text}")
+    return report
+
+
+# Функция для получения короткого названия дня недели
+def get_day_short_name(moment):
+    day_names = {1: "Пн", 2: "Вт", 3: "Ср", 4: "Чт", 5: "Пт", 6: "Сб", 7: "Вс"}
+    return day_names.get(moment.isoweekday(), "")
+
+
+# Функция для подписи дней напоминания по маске дней недели
+def format_weekday_mask(weekday_mask):
+    if weekday_mask == 0b1111111:
+        return "ежедневно"
+    if weekday_mask == 0b0011111:
+        return "будни"
+    if weekday_mask == 0b1100000:
+        return "выходные"
+    day_names = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+    return ", ".join(name for bit, name in enumerate(day_names) if weekday_mask & (1 << bit))
+
+
+# Функция для текста напоминания
+def format_reminder_message(city, today_name, weather_msg):
+    return (f"🔔 *Напоминание о погоде в {city}!*\n"
+            f"📅 *{today_name}*\n\n"
+            f"{weather_msg}")
+
+
+# Функция для постановки напоминания из журнала в очередь отправки (возвращает Future)
+def send_reminder_message(row, weather_msg):
+    chat_id, city = row[2], row[3]
+    today_name = get_day_short_name(datetime.fromtimestamp(row[1]))
+    return bot.queue_bulk_message(chat_id, format_reminder_message(city, today_name, weather_msg),
+                                  parse_mode='Markdown')
+
+
+# Функция для отправки напоминаний, запланированных на указанную минуту
+@profiled('reminders', 'tick')
+def send_due_reminders(moment):
+    shards = claim_reminder_shards(moment)
+    try:
+        send_shard_reminders(moment, shards)
+    except BaseException:
+        abandon_reminder_shards(shards)
+        raise
+    release_reminder_shards(shards, moment)
+
+
+# Функция для отправки напоминаний минуты из указанных шардов
+def send_shard_reminders(moment, shards):
+    groups = prepare_reminder_outbox(moment, shards)
+    if not groups:
+        return
+
+    # Погода для всех городов волны - несколькими групповыми запросами
+    weather_by_city = get_weather_info_batch(rows[0][3] for rows in groups.values())
+
+    # Ставим готовое сообщение всем чатам группы в очередь отправки и ждём доставки волны.
+    # Если погоды нет, напоминания остаются в журнале недоставленными до следующей попытки.
+    futures = []
+    for rows in groups.values():
+        weather_msg, error_msg = weather_by_city[rows[0][3]]
+        if not weather_msg:
+            print(f"Ошибка при обработке напоминаний для {rows[0][3]}: {error_msg}")
+            continue
+        for row in rows:
+            futures.append((row, send_reminder_message(row, weather_msg)))
+    wait([future for _, future in futures])
+
+    # Результаты пишем в журнал уже после ожидания: колбэки Future выполняются позже, чем
+    # просыпается wait, и запись из них могла не успеть до flush
+    outbox = ReminderOutboxWriter()
+    for row, future in futures:
+        outbox.record(row, future.exception())
+    outbox.flush()
+    report_reminder_wave(moment, shards)
+
+
+# Фоновая задача для проверки напоминаний
+def check_reminders():
+    upstream_priority.set(UpstreamGovernor.REMINDER)
+    # Последняя обработанная минута: всё, что после неё, ещё не отправлено
+    last_fired = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=1)
+
+    while True:
+        try:
+            # Догоняем все минуты после last_fired, если проснулись с опозданием
+            for moment in pending_reminder_moments(get_reminder_resume_point(last_fired)):
+                reminder_tick_lag.observe(time.time() - moment.timestamp())
+                send_due_reminders(moment)
+                last_fired = moment
+
+            # Спим до ближайшей минуты с напоминаниями или до изменения напоминаний
+            reminders_changed.clear()
+            reminders_changed.wait(reminder_sleep_timeout(last_fired))
+        except Exception as e:
+            print(f"Ошибка в проверке напоминаний: {e}")
+            time.sleep(5)
+
+
+# Функция для отправки напоминаний минуты в режиме asyncio
+async def async_send_due_reminders(async_bot, moment, semaphore):
+    shards = claim_reminder_shards(moment)
+    try:
+        await async_send_shard_reminders(async_bot, moment, shards, semaphore)
+    except BaseException:
+        abandon_reminder_shards(shards)
+        raise
+    release_reminder_shards(shards, moment)
+
+
+# Функция для отправки напоминаний минуты из указанных шардов в режиме asyncio
+async def async_send_shard_reminders(async_bot, moment, shards, semaphore):
+    groups = prepare_reminder_outbox(moment, shards)
+    if not groups:
+        return
+
+    async def fetch(rows):
+        async with semaphore:
+            return await async_get_weather_info(rows[0][3])
+
+    async def deliver(row, weather_msg):
+        today_name = get_day_short_name(datetime.fromtimestamp(row[1]))
+        await call_async_bot(async_bot, 'send_message',
+                             (row[2], format_reminder_message(row[3], today_name, weather_msg)),
+                             {'parse_mode': 'Markdown'}, OutboundQueue.BULK)
+
+    weather_results = await asyncio.gather(*(fetch(rows) for rows in groups.values()))
+
+    delivered_rows = []
+    deliveries = []
+    for rows, (weather_msg, error_msg) in zip(groups.values(), weather_results):
+        if not weather_msg:
+            print(f"Ошибка при обработке напоминаний для {rows[0][3]}: {error_msg}")
+            continue
+        delivered_rows.extend(rows)
+        deliveries.extend(deliver(row, weather_msg) for row in rows)
+    results = await asyncio.gather(*deliveries, return_exceptions=True)
+
+    outbox = ReminderOutboxWriter()
+    for row, result in zip(delivered_rows, results):
+        outbox.record(row, result if isinstance(result, BaseException) else None)
+    outbox.flush()
+    report_reminder_wave(moment, shards)
+
+
+# Задача проверки напоминаний в режиме asyncio (работает в том же цикле событий, что и бот)
+async def async_check_reminders(async_bot):
+    upstream_priority.set(UpstreamGovernor.REMINDER)
+    semaphore = asyncio.Semaphore(REMINDER_WORKERS)
+    last_fired = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=1)
+
+    while True:
+        try:
+            for moment in pending_reminder_moments(get_reminder_resume_point(last_fired)):
+                reminder_tick_lag.observe(time.time() - moment.timestamp())
+                await async_send_due_reminders(async_bot, moment, semaphore)
+                last_fired = moment
+
+            # Событие выставляется из других потоков, поэтому проверяем его раз в секунду
+            reminders_changed.clear()
+            deadline = time.monotonic() + reminder_sleep_timeout(last_fired)
+            while not reminders_changed.is_set() and time.monotonic() < deadline:
+                await asyncio.sleep(min(1, deadline - time.monotonic()))
+        except Exception as e:
+            print(f"Ошибка в проверке напоминаний: {e}")
+            await asyncio.sleep(5)
+
+
+# Фоновая задача: заранее загружает погоду городов, напоминания которых сработают в ближайшие минуты.
+# Каждую минуту просматривается всё окно, поэтому новые напоминания тоже попадают в предзагрузку,
+# а уже загруженные города берутся из кэша без запросов.
+def prewarm_reminders():
+    upstream_priority.set(UpstreamGovernor.PREWARM)
+    while True:
+        try:
+            moment = datetime.now().replace(second=0, microsecond=0)
+            with shard_lock:
+                shards = set(shard_leases)
+            cities = set()
+            for _ in range(PREWARM_MINUTES):
+                moment += timedelta(minutes=1)
+                cities.update(reminder[3] for reminder in get_due_reminders(moment, shards))
+            if cities:
+                get_weather_info_batch(cities)
 
+            # Просыпаемся в начале следующей минуты
+            now = datetime.now()
+            time.sleep(60 - now.second - now.microsecond / 1000000)
+        except Exception as e:
+            print(f"Ошибка при предзагрузке погоды: {e}")
+            time.sleep(5)
 
-# Функция для проверки, нужно ли отправить напоминание сегодня
-def should_send_today(days_string):
-    if days_string is None:
-        return True
 
-    if days_string == "everyday":
-        return True
+# Обновление погоды популярных городов идёт не больше чем в одном потоке за раз
+popular_cities_refresh_lock = threading.Lock()
 
-    today = datetime.now().isoweekday()
 
-    if days_string == "workdays":
-        return today <= 5
-    elif days_string == "weekend":
-        return today >= 6
-    else:
-        days_list = days_string.split(',')
-        return str(today) in days_list
+# Функция для обновления погоды популярных городов одним групповым запросом
+def refresh_popular_cities():
+    if not popular_cities_refresh_lock.acquire(blocking=False):
+        return
+    token = upstream_priority.set(UpstreamGovernor.PREWARM)
+    try:
+        get_weather_info_batch(popular_cities)
+    finally:
+        upstream_priority.reset(token)
+        popular_cities_refresh_lock.release()
 
 
-# Функция для получения координат города (геокодинг)
-def get_city_coordinates(city_name):
-    try:
-        encoded_city = urllib.parse.quote(city_name)
-        url = f'http://api.openweathermap.org/geo/1.0/direct?q={encoded_city}&limit=1&appid={WEATHER_API_KEY}'
-        response = requests.get(url)
-        data = response.json()
-
-        if data and len(data) > 0:
-            lat = data[0]['lat']
-            lon = data[0]['lon']
-            found_city = data[0].get('local_names', {}).get('ru', data[0]['name'])
-            country = data[0].get('country', '')
-            return lat, lon, found_city, country
-        return None, None, None, None
-    except Exception as e:
-        print(f"Ошибка геокодинга: {e}")
-        return None, None, None, None
+# Данные инлайн-кнопок: код операции и поля через двоеточие, например "t:1f:bo" - время 07:00
+# для города номер 51. Город передаётся номером из таблицы callback_cities, поэтому данные
+# кнопки укладываются в лимит Telegram (64 байта) при любом названии города.
+CALLBACK_SEPARATOR = ':'
+CALLBACK_DATA_LIMIT = 64
 
+# Варианты дней напоминания на кнопках (на кнопке - номер варианта)
+callback_day_options = ('1', '2', '3', '4', '5', '6', '7', 'everyday', 'workdays', 'weekend')
+# Виды прогноза на кнопках (на кнопке - номер вида)
+callback_forecast_views = ('today', 'tomorrow', 'week')
 
-# Функция для получения погоды по координатам
-def get_weather_by_coords(lat, lon, city_name, country):
-    try:
-        url = f'https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={WEATHER_API_KEY}&units=metric&lang=ru'
-        response = requests.get(url)
-        data = response.json()
 
-        if response.status_code == 200:
-            temperature = data['main']['temp']
-            feels_like = data['main']['feels_like']
-            humidity = data['main']['humidity']
-            pressure = data['main']['pressure']
-            wind_speed = data['wind']['speed']
-            weather_main = data['weather'][0]['main'].lower()
-            weather_description = data['weather'][0]['description']
-
-            weather_emoji = weather_conditions.get(weather_main, '🌡')
-
-            weather_message = (
-                f"🏙 *{city_name}, {country}*\n\n"
-                f"{weather_emoji} *{weather_description.capitalize()}*\n\n"
-                f"🌡 *Температура:* {temperature:.1f}°C\n"
-                f"🤔 *Ощущается как:* {feels_like:.1f}°C\n"
-                f"💧 *Влажность:* {humidity}%\n"
-                f"📊 *Давление:* {pressure} гПа\n"
-                f"💨 *Ветер:* {wind_speed} м/с\n\n"
-                f"✨ Хорошего дня!"
-            )
+# Функция для записи числа в кнопку (основание 36: короче десятичного)
+def encode_callback_int(value):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    text = ''
+    while True:
+        value, digit = divmod(value, 36)
+        text = digits[digit] + text
+        if value == 0:
+            return text
 
-            return weather_message, None
-        else:
-            return None, f"❌ Не удалось получить погоду для города {city_name}"
 
-    except Exception as e:
-        return None, f"😕 Произошла ошибка. Попробуй позже!"
+# Функция для чтения числа из кнопки (знаки и пробелы, которые допускает int, не принимаются)
+def decode_callback_int(text):
+    if not (text.isascii() and text.isalnum()):
+        raise ValueError(f"некорректное число в данных кнопки: {text!r}")
+    return int(text, 36)
 
 
-# Функция для получения погоды (основная, с геокодингом)
-def get_weather_info(city):
-    try:
-        lat, lon, found_city, country = get_city_coordinates(city)
+# Функция для перевода минуты суток обратно во время ЧЧ:ММ
+def minute_to_time(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
 
-        if lat and lon:
-            return get_weather_by_coords(lat, lon, found_city, country)
-        else:
-            return None, f"❌ Город '{city}' не найден. Проверь название или попробуй написать на английском!"
 
-    except Exception as e:
-        print(f"Ошибка: {e}")
-        return None, f"😕 Произошла ошибка. Попробуй позже!"
+# Типы полей кнопок: тип -> (запись значения в строку, чтение значения из строки).
+# Чтение возвращает None, если поле испорчено или устарело.
+callback_field_codecs = {
+    'int': (encode_callback_int, decode_callback_int),
+    'city': (lambda city: encode_callback_int(get_callback_city_id(city)),
+             lambda text: get_callback_city_name(decode_callback_int(text))),
+    'search': (lambda text: encode_callback_int(get_callback_search_id(text)),
+               lambda text: get_callback_city_name(decode_callback_int(text))),
+    'time': (lambda time_str: encode_callback_int(time_to_minute(time_str)),
+             lambda text: minute_to_time(decode_callback_int(text)) if decode_callback_int(text) < 24 * 60 else None),
+    'days': (lambda option: encode_callback_int(callback_day_options.index(option)),
+             lambda text: callback_day_options[decode_callback_int(text)]),
+    'view': (lambda view: encode_callback_int(callback_forecast_views.index(view)),
+             lambda text: callback_forecast_views[decode_callback_int(text)]),
+}
 
+# Маршруты нажатий на инлайн-кнопки: код операции -> (название ветки, обработчик, типы полей)
+callback_routes = {}
 
-# Фоновая задача для проверки напоминаний
-def check_reminders():
-    while True:
-        try:
-            current_time = datetime.now().strftime("%H:%M")
-            reminders = get_active_reminders()
 
-            for reminder in reminders:
-                try:
-                    reminder_id, user_id, chat_id, city, reminder_time, days, is_active = reminder
-
-                    if reminder_time == current_time and should_send_today(days):
-                        weather_msg, error_msg = get_weather_info(city)
-                        if weather_msg:
-                            today_num = datetime.now().isoweekday()
-                            day_names = {1: "Пн", 2: "Вт", 3: "Ср", 4: "Чт", 5: "Пт", 6: "Сб", 7: "Вс"}
-                            today_name = day_names.get(today_num, "")
-
-                            bot.send_message(chat_id,
-                                             f"🔔 *Напоминание о погоде в {city}!*\n"
-                                             f"📅 *{today_name}*\n\n"
-                                             f"{weather_msg}",
-                                             parse_mode='Markdown')
-                except Exception as e:
-                    print(f"Ошибка при обработке напоминания: {e}")
-                    continue
+# Декоратор для обработчика нажатия кнопки с указанным кодом операции.
+# Обработчик получает нажатие и уже прочитанные поля кнопки.
+def callback_route(opcode, branch, *fields):
+    def decorator(func):
+        callback_routes[opcode] = (branch, func, fields)
+        return func
+    return decorator
 
-            time.sleep(60)
-        except Exception as e:
-            print(f"Ошибка в проверке напоминаний: {e}")
-            time.sleep(60)
 
+# Функция для данных кнопки: код операции и значения полей маршрута
+def make_callback_data(opcode, *values):
+    _, _, fields = callback_routes[opcode]
+    parts = [opcode] + [callback_field_codecs[field][0](value) for field, value in zip(fields, values)]
+    data = CALLBACK_SEPARATOR.join(parts)
+    if len(data.encode('utf-8')) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"данные кнопки длиннее {CALLBACK_DATA_LIMIT} байт: {data}")
+    return data
 
-# Запускаем проверку напоминаний в отдельном потоке
-reminder_thread = threading.Thread(target=check_reminders, daemon=True)
-reminder_thread.start()
+
+# Функция для разбора данных кнопки: (ветка, обработчик, значения полей) или None для старых и
+# испорченных кнопок
+def parse_callback_data(data):
+    parts = data.split(CALLBACK_SEPARATOR)
+    route = callback_routes.get(parts[0])
+    if route is None or len(parts) - 1 != len(route[2]):
+        return None
+
+    branch, handler, fields = route
+    try:
+        values = [callback_field_codecs[field][1](text) for field, text in zip(fields, parts[1:])]
+    except (ValueError, IndexError):
+        return None
+    if None in values:
+        return None
+    return branch, handler, values
 
 
 # Создаём клавиатуру с популярными городами
 def get_cities_keyboard():
+    # Пока пользователь выбирает, обновляем погоду популярных городов в фоне
+    if not popular_cities_refresh_lock.locked():
+        weather_executor.submit(refresh_popular_cities)
+
     keyboard = InlineKeyboardMarkup(row_width=2)
     buttons = []
     for city in popular_cities:
-        buttons.append(InlineKeyboardButton(city, callback_data=f"city_{city}"))
+        buttons.append(InlineKeyboardButton(city, callback_data=make_callback_data('c', city)))
     keyboard.add(*buttons)
-    keyboard.add(InlineKeyboardButton("🔍 Другой город", callback_data="other_city"))
+    keyboard.add(InlineKeyboardButton("🔍 Другой город", callback_data=make_callback_data('o')))
     return keyboard
 
 
@@ -314,23 +3360,23 @@ def get_days_keyboard(city, time):
     keyboard = InlineKeyboardMarkup(row_width=3)
 
     days_buttons = [
-        InlineKeyboardButton("Пн", callback_data=f"day_{city}_{time}_1"),
-        InlineKeyboardButton("Вт", callback_data=f"day_{city}_{time}_2"),
-        InlineKeyboardButton("Ср", callback_data=f"day_{city}_{time}_3"),
-        InlineKeyboardButton("Чт", callback_data=f"day_{city}_{time}_4"),
-        InlineKeyboardButton("Пт", callback_data=f"day_{city}_{time}_5"),
-        InlineKeyboardButton("Сб", callback_data=f"day_{city}_{time}_6"),
-        InlineKeyboardButton("Вс", callback_data=f"day_{city}_{time}_7")
+        InlineKeyboardButton("Пн", callback_data=make_callback_data('d', city, time, '1')),
+        InlineKeyboardButton("Вт", callback_data=make_callback_data('d', city, time, '2')),
+        InlineKeyboardButton("Ср", callback_data=make_callback_data('d', city, time, '3')),
+        InlineKeyboardButton("Чт", callback_data=make_callback_data('d', city, time, '4')),
+        InlineKeyboardButton("Пт", callback_data=make_callback_data('d', city, time, '5')),
+        InlineKeyboardButton("Сб", callback_data=make_callback_data('d', city, time, '6')),
+        InlineKeyboardButton("Вс", callback_data=make_callback_data('d', city, time, '7'))
     ]
     keyboard.add(*days_buttons)
 
     keyboard.add(
-        InlineKeyboardButton("📅 Ежедневно", callback_data=f"day_{city}_{time}_everyday"),
-        InlineKeyboardButton("💼 Будни", callback_data=f"day_{city}_{time}_workdays"),
-        InlineKeyboardButton("🎉 Выходные", callback_data=f"day_{city}_{time}_weekend")
+        InlineKeyboardButton("📅 Ежедневно", callback_data=make_callback_data('d', city, time, 'everyday')),
+        InlineKeyboardButton("💼 Будни", callback_data=make_callback_data('d', city, time, 'workdays')),
+        InlineKeyboardButton("🎉 Выходные", callback_data=make_callback_data('d', city, time, 'weekend'))
     )
 
-    keyboard.add(InlineKeyboardButton("🔙 Назад к выбору времени", callback_data=f"back_to_time_{city}"))
+    keyboard.add(InlineKeyboardButton("🔙 Назад к выбору времени", callback_data=make_callback_data('b', city)))
     return keyboard
 
 
@@ -340,11 +3386,11 @@ def get_time_keyboard(city):
     times = ["07:00", "09:00", "12:00", "15:00", "18:00", "20:00"]
     buttons = []
     for time in times:
-        buttons.append(InlineKeyboardButton(time, callback_data=f"time_{city}_{time}"))
+        buttons.append(InlineKeyboardButton(time, callback_data=make_callback_data('t', city, time)))
     keyboard.add(*buttons)
 
-    keyboard.add(InlineKeyboardButton("✏️ Своё время", callback_data=f"custom_time_{city}"))
-    keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+    keyboard.add(InlineKeyboardButton("✏️ Своё время", callback_data=make_callback_data('u', city)))
+    keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data=make_callback_data('m')))
     return keyboard
 
 
@@ -354,56 +3400,56 @@ def get_manage_reminders_keyboard(user_id):
     keyboard = InlineKeyboardMarkup(row_width=1)
 
     if not reminders:
-        keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+        keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data=make_callback_data('m')))
         return keyboard
 
     for reminder in reminders:
-        reminder_id, _, _, city, reminder_time, days, _ = reminder
+        reminder_id, _, _, city, reminder_time, _, _, _, weekday_mask = reminder
+        days_text = format_weekday_mask(weekday_mask)
 
-        if days is None:
-            days = "everyday"
+        button_text = f"❌ {city} в {reminder_time} ({days_text})"
+        keyboard.add(InlineKeyboardButton(button_text, callback_data=make_callback_data('x', reminder_id)))
 
-        if days == "everyday":
-            days_text = "ежедневно"
-        elif days == "workdays":
-            days_text = "будни"
-        elif days == "weekend":
-            days_text = "выходные"
-        else:
-            days_list = days.split(',')
-            days_short = []
-            day_names = {"1": "Пн", "2": "Вт", "3": "Ср", "4": "Чт",
-                         "5": "Пт", "6": "Сб", "7": "Вс"}
-            for d in days_list:
-                if d in day_names:
-                    days_short.append(day_names[d])
-            days_text = ", ".join(days_short)
+    keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data=make_callback_data('m')))
+    return keyboard
 
-        button_text = f"❌ {city} в {reminder_time} ({days_text})"
-        keyboard.add(InlineKeyboardButton(button_text, callback_data=f"delete_{reminder_id}"))
 
-    keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+# Клавиатура действий после показа погоды
+def get_weather_actions_keyboard(city):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("🔄 Другой город", callback_data=make_callback_data('o')),
+        InlineKeyboardButton("🌟 Популярные", callback_data=make_callback_data('p')),
+        InlineKeyboardButton("📅 Прогноз", callback_data=make_callback_data('f', city)),
+        InlineKeyboardButton("⏰ Напомнить", callback_data=make_callback_data('r', city))
+    )
+    return keyboard
+
+
+# Клавиатура переключения видов прогноза (текущий вид отмечен)
+def get_forecast_keyboard(city, current_view):
+    labels = {'today': "Сегодня", 'tomorrow': "Завтра", 'week': "Неделя"}
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    keyboard.add(*[
+        InlineKeyboardButton(f"• {label} •" if view == current_view else label,
+                             callback_data=make_callback_data('v', view, city))
+        for view, label in labels.items()
+    ])
+    keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data=make_callback_data('m')))
     return keyboard
 
 
 # Создаём главную клавиатуру (ReplyKeyboard)
 def get_main_keyboard():
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    buttons = [
-        KeyboardButton("🌤 Узнать погоду"),
-        KeyboardButton("🌟 Популярные города"),
-        KeyboardButton("⏰ Напомнить о погоде"),
-        KeyboardButton("📋 Мои напоминания"),
-        KeyboardButton("ℹ️ О боте"),
-        KeyboardButton("📞 Помощь"),
-        KeyboardButton("👨‍💻 О разработчике")
-    ]
+    buttons = [KeyboardButton(text) for text in main_menu_buttons]
     keyboard.add(*buttons)
     return keyboard
 
 
 # Команда /start с красивым приветствием
-@bot.message_handler(commands=['start'])
+@message_handler(commands=['start'])
+@timed_handler('message', lambda message: 'start')
 def send_welcome(message):
     user_name = message.from_user.first_name
 
@@ -422,7 +3468,9 @@ def send_welcome(message):
 
 
 # Обработка кнопок главного меню
-@bot.message_handler(func=lambda message: True)
+@message_handler(func=lambda message: True)
+@timed_handler('message', get_message_branch)
+@profiled_handler('message', get_message_branch)
 def handle_main_keyboard(message):
     if message.text == "🌤 Узнать погоду":
         bot.send_message(message.chat.id,
@@ -456,7 +3504,7 @@ def handle_main_keyboard(message):
                              reply_markup=get_manage_reminders_keyboard(user_id))
         else:
             keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu"))
+            keyboard.add(InlineKeyboardButton("🔙 Назад в меню", callback_data=make_callback_data('m')))
 
             bot.send_message(message.chat.id,
                              "📋 *У тебя пока нет активных напоминаний*\n\n"
@@ -510,12 +3558,13 @@ def handle_main_keyboard(message):
 
     else:
         user_id = message.from_user.id
-        if user_id in user_data and user_data[user_id].get('awaiting_time'):
-            city = user_data[user_id]['city']
+        state = conversation_store.get(user_id)
+        if state and state.get('awaiting_time'):
+            city = state['city']
             time_str = message.text.strip()
 
             if is_valid_time(time_str):
-                user_data[user_id] = {'city': city, 'time': time_str, 'awaiting_days': True}
+                conversation_store.set(user_id, 'awaiting_days', city, time_str)
                 bot.send_message(message.chat.id,
                                  f"⏰ *Выбери дни для напоминания*\n\n"
                                  f"📍 Город: {city}\n"
@@ -529,195 +3578,746 @@ def handle_main_keyboard(message):
                                  "Пожалуйста, введи время в формате *ЧЧ:ММ* (например, 14:30 или 09:15)",
                                  parse_mode='Markdown')
         else:
-            bot.send_chat_action(message.chat.id, 'typing')
             city = message.text
+            # Спам, ссылки и длинные тексты отвечаем сразу, не тратя запросы к API
+            reason = city_input_rejection(city)
+            if reason is not None:
+                city_input_rejected.inc(reason)
+                bot.send_message(message.chat.id,
+                                 "🤷 Это не похоже на название города.\n\n"
+                                 "Напиши название буквами (например: Москва, Нижний Новгород, London) "
+                                 "или выбери действие в меню 👇",
+                                 reply_markup=get_main_keyboard())
+                return
+
+            suggestions = get_city_suggestions(city)
+            if suggestions:
+                keyboard = InlineKeyboardMarkup(row_width=1)
+                keyboard.add(*[InlineKeyboardButton(f"🏙 {name}", callback_data=make_callback_data('c', name))
+                               for name in suggestions])
+                # Справочник знает не все города, а API ещё не спрашивали: город может и существовать,
+                # поэтому не пишем «не найден» и оставляем возможность искать как есть
+                keyboard.add(InlineKeyboardButton(f"🔎 Нет, искать «{city}»",
+                                                  callback_data=make_callback_data('s', city)))
+                bot.send_message(message.chat.id, "🤔 Может быть, ты имел в виду:", reply_markup=keyboard)
+                return
+
+            bot.send_chat_action(message.chat.id, 'typing')
             weather_msg, error_msg = get_weather_info(city)
 
             if weather_msg:
                 bot.send_message(message.chat.id, weather_msg, parse_mode='Markdown')
-
-                keyboard = InlineKeyboardMarkup(row_width=2)
-                keyboard.add(
-                    InlineKeyboardButton("🔄 Другой город", callback_data="other_city"),
-                    InlineKeyboardButton("🌟 Популярные", callback_data="show_popular"),
-                    InlineKeyboardButton("⏰ Напомнить", callback_data=f"set_reminder_{city}")
-                )
                 bot.send_message(message.chat.id, "👇 *Что делаем дальше?*",
-                                 parse_mode='Markdown', reply_markup=keyboard)
+                                 parse_mode='Markdown',
+                                 reply_markup=get_weather_actions_keyboard(canonical_city_name(city)))
             else:
                 bot.send_message(message.chat.id, error_msg)
 
 
-# Обработка нажатий на инлайн-кнопки
-@bot.callback_query_handler(func=lambda call: True)
+# Функция для определения ветки handle_callback (для метрик)
+def get_callback_branch(data):
+    route = callback_routes.get(data.split(CALLBACK_SEPARATOR, 1)[0])
+    return route[0] if route is not None else 'unknown'
+
+
+# Обработка нажатий на инлайн-кнопки: обработчик выбирается по коду операции
+@callback_query_handler(func=lambda call: True)
+@timed_handler('callback', lambda call: get_callback_branch(call.data))
+@profiled_handler('callback', lambda call: get_callback_branch(call.data))
 def handle_callback(call):
-    if call.data.startswith("city_"):
-        city = call.data.replace("city_", "")
-        bot.answer_callback_query(call.id, f"Ищем погоду в {city}...")
+    parsed = parse_callback_data(call.data)
+    if parsed is None:
+        # Кнопка из старого сообщения (до смены формата) или с неизвестным городом
+        bot.answer_callback_query(call.id, "Кнопка устарела, начни заново 🙏")
+        bot.send_message(call.message.chat.id,
+                         "🏠 *Главное меню*",
+                         parse_mode='Markdown',
+                         reply_markup=get_main_keyboard())
+        return
 
-        weather_msg, error_msg = get_weather_info(city)
+    _, handler, values = parsed
+    handler(call, *values)
+    bot.answer_callback_query(call.id)
 
-        if weather_msg:
-            bot.send_message(call.message.chat.id, weather_msg, parse_mode='Markdown')
 
-            keyboard = InlineKeyboardMarkup(row_width=2)
-            keyboard.add(
-                InlineKeyboardButton("🔄 Другой город", callback_data="other_city"),
-                InlineKeyboardButton("🌟 Популярные", callback_data="show_popular"),
-                InlineKeyboardButton("⏰ Напомнить", callback_data=f"set_reminder_{city}")
-            )
-            bot.send_message(call.message.chat.id, "👇 *Что делаем дальше?*",
-                             parse_mode='Markdown', reply_markup=keyboard)
-        else:
-            bot.send_message(call.message.chat.id, error_msg)
+# Кнопка города: показываем погоду
+@callback_route('c', 'city', 'city')
+def handle_city_callback(call, city):
+    bot.answer_callback_query(call.id, f"Ищем погоду в {city}...")
 
-    elif call.data.startswith("set_reminder_"):
-        city = call.data.replace("set_reminder_", "")
-        bot.send_message(call.message.chat.id,
-                         f"⏰ *Выбери время для напоминания о погоде в {city}:*",
-                         parse_mode='Markdown',
-                         reply_markup=get_time_keyboard(city))
-
-    elif call.data.startswith("time_"):
-        parts = call.data.split("_")
-        city = parts[1]
-        reminder_time = parts[2]
-        user_id = call.from_user.id
-
-        user_data[user_id] = {'city': city, 'time': reminder_time, 'awaiting_days': True}
-        bot.edit_message_text(f"⏰ *Выбери дни для напоминания*\n\n"
-                              f"📍 Город: {city}\n"
-                              f"⏱ Время: {reminder_time}\n\n"
-                              f"В какие дни присылать прогноз?",
-                              call.message.chat.id,
-                              call.message.message_id,
-                              parse_mode='Markdown',
-                              reply_markup=get_days_keyboard(city, reminder_time))
+    weather_msg, error_msg = get_weather_info(city)
+
+    if weather_msg:
+        bot.send_message(call.message.chat.id, weather_msg, parse_mode='Markdown')
+        bot.send_message(call.message.chat.id, "👇 *Что делаем дальше?*",
+                         parse_mode='Markdown', reply_markup=get_weather_actions_keyboard(canonical_city_name(city)))
+    else:
+        bot.send_message(call.message.chat.id, error_msg)
+
+
+# Кнопка «Искать как есть» под подсказками: то же, что кнопка города, по тексту пользователя
+@callback_route('s', 'search', 'search')
+def handle_search_callback(call, city):
+    handle_city_callback(call, city)
+
+
+# Переключение вида прогноза: меняем текст того же сообщения
+@callback_route('v', 'forecast_view', 'view', 'city')
+def handle_forecast_view_callback(call, view, city):
+    forecast_msg, error_msg = get_forecast_info(city, view)
+    if forecast_msg:
+        bot.edit_message_text(forecast_msg, call.message.chat.id, call.message.message_id,
+                              parse_mode='Markdown', reply_markup=get_forecast_keyboard(city, view))
+    else:
+        bot.send_message(call.message.chat.id, error_msg)
+
+
+# Кнопка прогноза после погоды: прогноз на сегодня новым сообщением
+@callback_route('f', 'forecast', 'city')
+def handle_forecast_callback(call, city):
+    forecast_msg, error_msg = get_forecast_info(city, 'today')
+    if forecast_msg:
+        bot.send_message(call.message.chat.id, forecast_msg, parse_mode='Markdown',
+                         reply_markup=get_forecast_keyboard(city, 'today'))
+    else:
+        bot.send_message(call.message.chat.id, error_msg)
 
-    elif call.data.startswith("custom_time_"):
-        city = call.data.replace("custom_time_", "")
-        user_id = call.from_user.id
 
-        user_data[user_id] = {'city': city, 'awaiting_time': True}
+# Начало настройки напоминания: выбор времени
+@callback_route('r', 'set_reminder', 'city')
+def handle_set_reminder_callback(call, city):
+    bot.send_message(call.message.chat.id,
+                     f"⏰ *Выбери время для напоминания о погоде в {city}:*",
+                     parse_mode='Markdown',
+                     reply_markup=get_time_keyboard(city))
 
-        bot.edit_message_text(f"✏️ *Введи своё время*\n\n"
-                              f"Город: {city}\n\n"
-                              f"Напиши время в формате *ЧЧ:ММ*\n"
-                              f"Например: 14:30, 09:15, 23:45\n\n"
-                              f"❗️Время должно быть от 00:00 до 23:59",
+
+# Время выбрано кнопкой: выбор дней
+@callback_route('t', 'time', 'city', 'time')
+def handle_time_callback(call, city, reminder_time):
+    user_id = call.from_user.id
+
+    conversation_store.set(user_id, 'awaiting_days', city, reminder_time)
+    bot.edit_message_text(f"⏰ *Выбери дни для напоминания*\n\n"
+                          f"📍 Город: {city}\n"
+                          f"⏱ Время: {reminder_time}\n\n"
+                          f"В какие дни присылать прогноз?",
+                          call.message.chat.id,
+                          call.message.message_id,
+                          parse_mode='Markdown',
+                          reply_markup=get_days_keyboard(city, reminder_time))
+
+
+# Своё время: ждём его текстом
+@callback_route('u', 'custom_time', 'city')
+def handle_custom_time_callback(call, city):
+    user_id = call.from_user.id
+
+    conversation_store.set(user_id, 'awaiting_time', city)
+
+    bot.edit_message_text(f"✏️ *Введи своё время*\n\n"
+                          f"Город: {city}\n\n"
+                          f"Напиши время в формате *ЧЧ:ММ*\n"
+                          f"Например: 14:30, 09:15, 23:45\n\n"
+                          f"❗️Время должно быть от 00:00 до 23:59",
+                          call.message.chat.id,
+                          call.message.message_id,
+                          parse_mode='Markdown')
+
+
+# Дни выбраны: сохраняем напоминание
+@callback_route('d', 'day', 'city', 'time', 'days')
+def handle_day_callback(call, city, reminder_time, days_option):
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+
+    if days_option == "everyday":
+        days_string = "everyday"
+        days_text = "ежедневно"
+    elif days_option == "workdays":
+        days_string = "workdays"
+        days_text = "будни (Пн-Пт)"
+    elif days_option == "weekend":
+        days_string = "weekend"
+        days_text = "выходные (Сб, Вс)"
+    else:
+        days_string = days_option
+        day_names = {"1": "Пн", "2": "Вт", "3": "Ср", "4": "Чт",
+                     "5": "Пт", "6": "Сб", "7": "Вс"}
+        days_text = day_names.get(days_option, "")
+
+    add_reminder(user_id, chat_id, city, reminder_time, days_string)
+
+    success_text = (
+        f"✅ *Напоминание установлено!*\n\n"
+        f"📍 Город: {city}\n"
+        f"⏰ Время: {reminder_time}\n"
+        f"📅 Дни: {days_text}\n\n"
+        f"Я буду присылать тебе погоду в выбранные дни! 🌤"
+    )
+
+    bot.edit_message_text(success_text,
+                          chat_id,
+                          call.message.message_id,
+                          parse_mode='Markdown')
+
+    bot.send_message(chat_id, "👇 *Что делаем дальше?*",
+                     parse_mode='Markdown', reply_markup=get_main_keyboard())
+
+    conversation_store.delete(user_id)
+
+
+# Удаление напоминания из списка
+@callback_route('x', 'delete', 'int')
+def handle_delete_callback(call, reminder_id):
+    delete_reminder(reminder_id)
+
+    bot.answer_callback_query(call.id, "✅ Напоминание удалено!")
+
+    user_id = call.from_user.id
+    reminders = get_user_reminders(user_id)
+
+    if reminders:
+        bot.edit_message_text("📋 *Твои активные напоминания:*\n\n"
+                              "Нажми на напоминание, чтобы удалить его:",
+                              call.message.chat.id,
+                              call.message.message_id,
+                              parse_mode='Markdown',
+                              reply_markup=get_manage_reminders_keyboard(user_id))
+    else:
+        bot.edit_message_text("📋 *У тебя больше нет активных напоминаний*",
                               call.message.chat.id,
                               call.message.message_id,
                               parse_mode='Markdown')
+        bot.send_message(call.message.chat.id,
+                         "Хочешь создать новое? Нажми «⏰ Напомнить о погоде»! 🌤",
+                         reply_markup=get_main_keyboard())
 
-    elif call.data.startswith("day_"):
-        parts = call.data.split("_")
-        city = parts[1]
-        reminder_time = parts[2]
-        days_option = parts[3]
-        user_id = call.from_user.id
-        chat_id = call.message.chat.id
-
-        if days_option == "everyday":
-            days_string = "everyday"
-            days_text = "ежедневно"
-        elif days_option == "workdays":
-            days_string = "workdays"
-            days_text = "будни (Пн-Пт)"
-        elif days_option == "weekend":
-            days_string = "weekend"
-            days_text = "выходные (Сб, Вс)"
-        else:
-            days_string = days_option
-            day_names = {"1": "Пн", "2": "Вт", "3": "Ср", "4": "Чт",
-                         "5": "Пт", "6": "Сб", "7": "Вс"}
-            days_text = day_names.get(days_option, "")
-
-        add_reminder(user_id, chat_id, city, reminder_time, days_string)
-
-        success_text = (
-            f"✅ *Напоминание установлено!*\n\n"
-            f"📍 Город: {city}\n"
-            f"⏰ Время: {reminder_time}\n"
-            f"📅 Дни: {days_text}\n\n"
-            f"Я буду присылать тебе погоду в выбранные дни! 🌤"
-        )
 
-        bot.edit_message_text(success_text,
-                              chat_id,
-                              call.message.message_id,
-                              parse_mode='Markdown')
+# Возврат от выбора дней к выбору времени
+@callback_route('b', 'back_to_time', 'city')
+def handle_back_to_time_callback(call, city):
+    bot.edit_message_text(f"⏰ *Выбери время для напоминания о погоде в {city}:*",
+                          call.message.chat.id,
+                          call.message.message_id,
+                          parse_mode='Markdown',
+                          reply_markup=get_time_keyboard(city))
 
-        bot.send_message(chat_id, "👇 *Что делаем дальше?*",
-                         parse_mode='Markdown', reply_markup=get_main_keyboard())
 
-        if user_id in user_data:
-            del user_data[user_id]
+# Другой город: ждём название текстом
+@callback_route('o', 'other_city')
+def handle_other_city_callback(call):
+    bot.send_message(call.message.chat.id,
+                     "🏙 *Введите название города:*",
+                     parse_mode='Markdown')
 
-    elif call.data.startswith("delete_"):
-        reminder_id = call.data.replace("delete_", "")
-        delete_reminder(reminder_id)
 
-        bot.answer_callback_query(call.id, "✅ Напоминание удалено!")
+# Список популярных городов
+@callback_route('p', 'show_popular')
+def handle_show_popular_callback(call):
+    bot.send_message(call.message.chat.id,
+                     "🌆 *Популярные города:*\nВыберите город из списка:",
+                     parse_mode='Markdown',
+                     reply_markup=get_cities_keyboard())
 
-        user_id = call.from_user.id
-        reminders = get_user_reminders(user_id)
 
-        if reminders:
-            bot.edit_message_text("📋 *Твои активные напоминания:*\n\n"
-                                  "Нажми на напоминание, чтобы удалить его:",
-                                  call.message.chat.id,
-                                  call.message.message_id,
-                                  parse_mode='Markdown',
-                                  reply_markup=get_manage_reminders_keyboard(user_id))
+# Возврат в главное меню
+@callback_route('m', 'back_to_menu')
+def handle_back_to_menu_callback(call):
+    bot.send_message(call.message.chat.id,
+                     "🏠 *Главное меню*",
+                     parse_mode='Markdown',
+                     reply_markup=get_main_keyboard())
+
+
+# Сколько городов показывать в подсказках инлайн-режима
+INLINE_RESULTS_LIMIT = 10
+
+
+# Инлайн-режим: подсказки городов из локального справочника по мере ввода названия.
+# Выбранный город отправляется сообщением, и бот отвечает на него погодой.
+@inline_handler(func=lambda query: True)
+@timed_handler('inline', lambda query: 'search' if query.query.strip() else 'popular')
+def handle_inline_query(query):
+    text = query.query.strip()
+    if text:
+        cities = search_cities(text, INLINE_RESULTS_LIMIT)
+    else:
+        index = get_city_index()
+        cities = [index.exact(normalize_city_name(city)) for city in popular_cities] if index is not None else []
+        cities = [city for city in cities if city is not None]
+
+    results = [
+        InlineQueryResultArticle(id=str(number), title=f"{name}, {country}", description=name_en,
+                                 input_message_content=InputTextMessageContent(name))
+        for number, (_, _, name, country, name_en, _) in enumerate(cities)
+    ]
+    bot.answer_inline_query(query.id, results, cache_time=300)
+
+
+# Режим asyncio: те же обработчики на AsyncTeleBot
+
+# Вызовы Telegram API, собранные во время работы обработчика в режиме asyncio
+pending_bot_calls = contextvars.ContextVar('pending_bot_calls', default=None)
+
+# Методы, которые идут через очередь исходящих сообщений, и позиция chat_id в их аргументах
+RATE_LIMITED_METHODS = {'send_message': 0, 'edit_message_text': 1}
+
+
+# Функция для вызова метода асинхронного бота (сообщения в чаты - через очередь с лимитами)
+async def call_async_bot(async_bot, name, args, kwargs, priority=OutboundQueue.INTERACTIVE):
+    method = getattr(async_bot, name)
+    if name not in RATE_LIMITED_METHODS:
+        return await method(*args, **kwargs)
+
+    position = RATE_LIMITED_METHODS[name]
+    chat_id = args[position] if len(args) > position else kwargs.get('chat_id')
+    loop = asyncio.get_running_loop()
+
+    def send():
+        return asyncio.run_coroutine_threadsafe(method(*args, **kwargs), loop).result()
+
+    return await asyncio.wrap_future(outbound_queue.submit(chat_id, send, priority))
+
+
+# Мост для обработчиков: вызовы bot.* собираются и выполняются асинхронно после обработчика
+class AsyncBotBridge:
+    def __init__(self, async_bot):
+        self.async_bot = async_bot
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            pending = pending_bot_calls.get()
+            if pending is None:
+                return asyncio.ensure_future(call_async_bot(self.async_bot, name, args, kwargs))
+            pending.append((name, args, kwargs))
+
+        return call
+
+
+# Функция для определения города, погоду которого запросит обработчик сообщения
+def weather_query_for_message(message):
+    if message.text is None or message.text in main_menu_buttons:
+        return None
+    state = conversation_store.get(message.from_user.id)
+    if state and state.get('awaiting_time'):
+        return None
+    if city_input_rejection(message.text) is not None or get_city_suggestions(message.text):
+        return None
+    return message.text
+
+
+# Функция для определения города, погоду которого запросит обработчик кнопки
+def weather_query_for_callback(call):
+    parsed = parse_callback_data(call.data)
+    if parsed is not None and parsed[0] in ('city', 'search'):
+        return parsed[2][0]
+    return None
+
+
+# Функция для определения города, прогноз которого покажет обработчик кнопки
+def forecast_query_for_callback(call):
+    parsed = parse_callback_data(call.data)
+    if parsed is not None and parsed[0] in ('forecast', 'forecast_view'):
+        return parsed[2][-1]
+    return None
+
+
+# Функция для оборачивания обычного обработчика в асинхронный
+def make_async_handler(async_bot, handler, weather_query, forecast_query=None):
+    async def async_handler(update):
+        lookups_token = city_lookups.set({})
+        try:
+            await run_handler(update)
+        finally:
+            city_lookups.reset(lookups_token)
+
+    async def run_handler(update):
+        # Сетевые запросы делаем заранее и асинхронно, сам обработчик берёт готовый результат
+        prefetched = {}
+        city = weather_query(update)
+        if city:
+            prefetched[city] = await async_get_weather_info(city)
+        forecast_city = forecast_query(update) if forecast_query else None
+        if forecast_city:
+            await async_prefetch_forecast(forecast_city)
+
+        pending = []
+        prefetched_token = prefetched_weather.set(prefetched)
+        pending_token = pending_bot_calls.set(pending)
+        try:
+            handler(update)
+        finally:
+            prefetched_weather.reset(prefetched_token)
+            pending_bot_calls.reset(pending_token)
+            # Отправляем ответы по порядку, как их вызвал обработчик
+            for name, args, kwargs in pending:
+                await call_async_bot(async_bot, name, args, kwargs)
+
+    return async_handler
+
+
+# Бот для режима asyncio с зарегистрированными обработчиками
+def create_async_bot():
+    global bot
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+
+    if TELEGRAM_API_URL:
+        asyncio_helper.API_URL = TELEGRAM_API_URL.rstrip('/') + '/bot{0}/{1}'
+
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+    for handler, filters in message_handler_specs:
+        async_bot.register_message_handler(make_async_handler(async_bot, handler, weather_query_for_message),
+                                           **filters)
+    for handler, filters in callback_query_handler_specs:
+        async_bot.register_callback_query_handler(make_async_handler(async_bot, handler, weather_query_for_callback,
+                                                                     forecast_query_for_callback),
+                                                  **filters)
+    for handler, filters in inline_handler_specs:
+        async_bot.register_inline_handler(make_async_handler(async_bot, handler, lambda query: None), **filters)
+
+    # Обработчики обращаются к глобальному bot, поэтому подменяем его мостом
+    bot = AsyncBotBridge(async_bot)
+    return async_bot
+
+
+# Обработка одного обновления от вебхука в режиме asyncio
+async def async_process_webhook_update(async_bot, payload, semaphore):
+    try:
+        await async_bot.process_new_updates([parse_webhook_update(payload)])
+    except Exception as e:
+        print(f"Ошибка обработки обновления: {e}")
+    finally:
+        semaphore.release()
+
+
+# Задача, которая передаёт обновления из очереди вебхука обработчикам в режиме asyncio
+# (одновременно обрабатывается не больше WEBHOOK_WORKERS обновлений)
+async def async_process_webhook_updates(async_bot):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(WEBHOOK_WORKERS)
+    tasks = set()
+    while True:
+        try:
+            # Очередь пополняют потоки HTTP-сервера, поэтому ждём её в пуле, а не в цикле событий
+            payload = await loop.run_in_executor(None, update_queue.get, True, 1)
+        except queue.Empty:
+            continue
+        await semaphore.acquire()
+        task = asyncio.create_task(async_process_webhook_update(async_bot, payload, semaphore))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+# Запуск вебхука в режиме asyncio: HTTP-сервер работает в своём потоке, обработчики - в цикле событий.
+# Возвращает False, если Telegram не принял вебхук.
+async def run_async_webhook_bot(async_bot):
+    server = create_webhook_server()
+    try:
+        await async_bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    except Exception as e:
+        abandon_webhook_server(server)
+        print(f"Не удалось запустить вебхук, переходим на polling: {e}")
+        return False
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"🌐 Вебхук слушает порт {HTTP_PORT}")
+    await async_process_webhook_updates(async_bot)
+    return True
+
+
+# Запуск бота в режиме asyncio
+async def run_async_bot(async_bot):
+    reminder_task = asyncio.create_task(async_check_reminders(async_bot))
+    try:
+        if not WEBHOOK_URL or not await run_async_webhook_bot(async_bot):
+            # Зарегистрированный ранее вебхук мешает получать обновления через polling
+            await async_bot.delete_webhook()
+            await async_bot.infinity_polling()
+    finally:
+        reminder_task.cancel()
+        await async_weather_client.close()
+        await async_bot.close_session()
+
+
+# Встроенный HTTP-сервер (вебхук Telegram и служебные страницы)
+
+# Настройки вебхука: если задан WEBHOOK_URL, обновления приходят по HTTP, иначе работает polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Секрет вебхука обязателен: без WEBHOOK_SECRET он создаётся при запуске (при нескольких копиях
+# за одним адресом его нужно задать явно - иначе вебхук примет секрет только последней запущенной)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+HTTP_HOST = os.getenv('HTTP_HOST', '0.0.0.0')
+HTTP_PORT = int(os.getenv('PORT', '8080'))
+# Предельный размер тела запроса (обновления Telegram занимают единицы килобайт)
+HTTP_MAX_BODY = int(os.getenv('HTTP_MAX_BODY', '262144'))
+
+# Очередь входящих обновлений от вебхука (ограничена, чтобы не копить их без конца)
+update_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+
+# Проверка работоспособности для балансировщика
+def handle_health_request(headers, payload):
+    return 200, 'text/plain', b'ok'
+
+
+# Приём обновления от Telegram: проверяем секрет и кладём в очередь
+def handle_webhook_request(headers, payload):
+    token = headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return 403, 'text/plain', b'forbidden'
+
+    try:
+        update_queue.put_nowait(payload)
+    except queue.Full:
+        # Telegram повторит доставку позже
+        return 503, 'text/plain', b'busy'
+    return 200, 'text/plain', b'ok'
+
+
+# Страница метрик в формате Prometheus
+def handle_metrics_request(headers, payload):
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', render_metrics()
+
+
+# Маршруты сервера: (метод, путь) -> функция(заголовки, тело) -> (код, тип содержимого, ответ)
+http_routes = {
+    ('GET', '/'): handle_health_request,
+}
+if METRICS_ENABLED:
+    http_routes[('GET', '/metrics')] = handle_metrics_request
+
+# Размеры очередей и кэшей - вычисляются при запросе /metrics
+Gauge('weather_bot_outbound_queue_depth', 'Сообщения в очереди отправки', outbound_queue.depth)
+Gauge('weather_bot_update_queue_depth', 'Обновления вебхука в очереди', update_queue.qsize)
+Gauge('weather_bot_weather_cache_entries', 'Точки в кэше погоды', lambda: len(weather_cache))
+Gauge('weather_bot_forecast_cache_entries', 'Точки в кэше прогнозов', lambda: len(forecast_cache))
+Gauge('weather_bot_geocode_cache_entries', 'Города в кэше координат', lambda: len(geocode_cache))
+Gauge('weather_bot_geocode_miss_cache_entries', 'Ненайденные названия в кэше', lambda: len(geocode_miss_cache))
+Gauge('weather_bot_weather_api_breaker_open', 'Выключатель запросов к OpenWeatherMap разомкнут',
+      lambda: int(upstream_governor.is_open()))
+Gauge('weather_bot_reminders_active', 'Активные напоминания',
+      lambda: get_db().execute('SELECT COUNT(*) FROM reminders WHERE is_active = 1').fetchone()[0])
+Gauge('weather_bot_conversations', 'Незавершённые диалоги', lambda: len(conversation_store))
+Gauge('weather_bot_reminder_shards_owned', 'Шарды напоминаний этой копии', lambda: len(shard_leases))
+
+
+class BotHTTPRequestHandler(BaseHTTPRequestHandler):
+    def handle_route(self, method):
+        route = http_routes.get((method, self.path.split('?')[0]))
+        if route is None:
+            status, content_type, body = 404, 'text/plain', b'not found'
         else:
-            bot.edit_message_text("📋 *У тебя больше нет активных напоминаний*",
-                                  call.message.chat.id,
-                                  call.message.message_id,
-                                  parse_mode='Markdown')
-            bot.send_message(call.message.chat.id,
-                             "Хочешь создать новое? Нажми «⏰ Напомнить о погоде»! 🌤",
-                             reply_markup=get_main_keyboard())
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                status, content_type, body = 400, 'text/plain', b'bad request'
+                self.close_connection = True
+            elif length > HTTP_MAX_BODY:
+                # Тело не читаем, соединение закрываем
+                status, content_type, body = 413, 'text/plain', b'payload too large'
+                self.close_connection = True
+            else:
+                payload = self.rfile.read(length) if length else b''
+                status, content_type, body = route(self.headers, payload)
 
-    elif call.data.startswith("back_to_time_"):
-        city = call.data.replace("back_to_time_", "")
-        bot.edit_message_text(f"⏰ *Выбери время для напоминания о погоде в {city}:*",
-                              call.message.chat.id,
-                              call.message.message_id,
-                              parse_mode='Markdown',
-                              reply_markup=get_time_keyboard(city))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-    elif call.data == "other_city":
-        bot.send_message(call.message.chat.id,
-                         "🏙 *Введите название города:*",
-                         parse_mode='Markdown')
+    def do_GET(self):
+        self.handle_route('GET')
 
-    elif call.data == "show_popular":
-        bot.send_message(call.message.chat.id,
-                         "🌆 *Популярные города:*\nВыберите город из списка:",
-                         parse_mode='Markdown',
-                         reply_markup=get_cities_keyboard())
+    def do_POST(self):
+        self.handle_route('POST')
 
-    elif call.data == "back_to_menu":
-        bot.send_message(call.message.chat.id,
-                         "🏠 *Главное меню*",
-                         parse_mode='Markdown',
-                         reply_markup=get_main_keyboard())
+    # Не печатаем каждый запрос в лог
+    def log_message(self, format, *args):
+        pass
 
-    bot.answer_callback_query(call.id)
 
+# Функция для создания HTTP-сервера
+def create_http_server():
+    server = ThreadingHTTPServer((HTTP_HOST, HTTP_PORT), BotHTTPRequestHandler)
+    server.daemon_threads = True
+    return server
 
-# Запускаем бота
-if __name__ == '__main__':
-    print("✨ Бот погоды запущен...")
-    print(f"👨‍💻 Разработчик: {CREATOR_NAME} ({CREATOR_NICKNAME})")
-    print(f"📱 Версия: {BOT_VERSION}")
-    print("⏰ Система напоминаний активна (с поддержкой дней недели)")
-    print("📱 Нажми Ctrl+C для остановки")
 
+# Функция для разбора обновления из тела запроса вебхука (с записью в журнал трафика)
+def parse_webhook_update(payload):
+    text = payload.decode('utf-8')
+    if traffic_recorder is not None:
+        traffic_recorder.record_update(json.loads(text))
+    return telebot.types.Update.de_json(text)
+
+
+# Фоновая задача: передаёт обновления из очереди обработчикам бота
+def process_webhook_updates():
+    while True:
+        payload = update_queue.get()
+        try:
+            bot.process_new_updates([parse_webhook_update(payload)])
+        except Exception as e:
+            print(f"Ошибка обработки обновления: {e}")
+
+
+# Функция для создания HTTP-сервера с маршрутом вебхука (секрет создаётся, если не задан)
+def create_webhook_server():
+    global WEBHOOK_SECRET
+    if not WEBHOOK_SECRET:
+        WEBHOOK_SECRET = os.urandom(24).hex()
+        print("⚠️ WEBHOOK_SECRET не задан, секрет вебхука создан при запуске")
+    server = create_http_server()
+    http_routes[('POST', WEBHOOK_PATH)] = handle_webhook_request
+    return server
+
+
+# Функция для отказа от сервера вебхука, если Telegram его не принял: бот переходит на polling,
+# а сервер остаётся только для метрик (без него /metrics пропали бы в обоих режимах)
+def abandon_webhook_server(server):
+    http_routes.pop(('POST', WEBHOOK_PATH), None)
+    if METRICS_ENABLED:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"📈 Метрики доступны на порту {HTTP_PORT}/metrics")
+    else:
+        server.server_close()
+
+
+# Запуск бота в режиме вебхука
+def run_webhook_bot():
+    server = create_webhook_server()
+    try:
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    except Exception:
+        abandon_webhook_server(server)
+        raise
+
+    # Обработчики выполняются в наших потоках, число которых ограничено WEBHOOK_WORKERS
+    bot.threaded = False
+    for _ in range(WEBHOOK_WORKERS):
+        threading.Thread(target=process_webhook_updates, daemon=True).start()
+
+    print(f"🌐 Вебхук слушает порт {HTTP_PORT}")
+    server.serve_forever()
+
+
+# Функция для запуска HTTP-сервера с метриками в фоне (для режимов без вебхука)
+def start_metrics_server():
+    try:
+        server = create_http_server()
+    except OSError as e:
+        print(f"Не удалось запустить сервер метрик: {e}")
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 Метрики доступны на порту {HTTP_PORT}/metrics")
+
+
+# Запуск бота в режиме polling
+def run_polling_bot():
+    bot.remove_webhook()
     while True:
         try:
             bot.polling(none_stop=True)
         except Exception as e:
             print(f"Ошибка: {e}")
             time.sleep(5)
-            continue
\ No newline at end of file
+            continue
+
+
+# Приложение: база, бот и фоновые задачи создаются по требованию, поэтому импорт модуля
+# не трогает базу, сеть и потоки (его можно импортировать из тестов и утилит)
+class WeatherBotApp:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.database_ready = False
+        self.scheduler_started = False
+
+    # База: миграции схемы и загрузка кэша координат
+    def init_database(self):
+        with self.lock:
+            if not self.database_ready:
+                init_database()
+                load_geocode_cache()
+                self.database_ready = True
+
+    # Бот с зарегистрированными обработчиками (обработчики обращаются к глобальному bot)
+    def create_bot(self):
+        global bot
+        with self.lock:
+            if bot is None:
+                bot = RateLimitedTeleBot(BOT_TOKEN)
+                for handler, filters in message_handler_specs:
+                    bot.register_message_handler(functools.partial(call_with_city_lookups, handler), **filters)
+                for handler, filters in callback_query_handler_specs:
+                    bot.register_callback_query_handler(handler, **filters)
+                for handler, filters in inline_handler_specs:
+                    bot.register_inline_handler(handler, **filters)
+        return bot
+
+    # Берём свою долю шардов и запускаем проверку напоминаний в отдельном потоке
+    # (в режиме asyncio проверка запускается задачей в цикле событий)
+    def start_scheduler(self):
+        self.init_database()
+        with self.lock:
+            if self.scheduler_started:
+                return
+            self.scheduler_started = True
+
+        init_reminder_shards()
+        renew_reminder_leases()
+        threading.Thread(target=maintain_reminder_leases, daemon=True).start()
+        if BOT_RUNTIME != 'asyncio':
+            threading.Thread(target=check_reminders, daemon=True).start()
+        if PREWARM_MINUTES > 0:
+            threading.Thread(target=prewarm_reminders, daemon=True).start()
+
+    # Запуск бота в выбранном режиме
+    def run(self):
+        print("✨ Бот погоды запущен...")
+        print(f"👨‍💻 Разработчик: {CREATOR_NAME} ({CREATOR_NICKNAME})")
+        print(f"📱 Версия: {BOT_VERSION}")
+        print("⏰ Система напоминаний активна (с поддержкой дней недели)")
+        print("📱 Нажми Ctrl+C для остановки")
+
+        self.init_database()
+        # Бот создаётся до планировщика: догоняющая волна напоминаний после перезапуска
+        # может начаться сразу и уже должна отправлять сообщения
+        if BOT_RUNTIME == 'asyncio':
+            async_bot = create_async_bot()
+        else:
+            self.create_bot()
+        self.start_scheduler()
+        start_profiling()
+        start_traffic_recording()
+        # С вебхуком метрики отдаёт его HTTP-сервер (в обоих режимах), иначе - отдельный сервер
+        if METRICS_ENABLED and not WEBHOOK_URL:
+            start_metrics_server()
+
+        if BOT_RUNTIME == 'asyncio':
+            asyncio.run(run_async_bot(async_bot))
+            return
+
+        if WEBHOOK_URL:
+            try:
+                run_webhook_bot()
+            except Exception as e:
+                print(f"Не удалось запустить вебхук, переходим на polling: {e}")
+                run_polling_bot()
+        else:
+            run_polling_bot()
+
+
+app = WeatherBotApp()
+
+
+# Запускаем бота
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,79 @@
+# Сборка справочника городов для бота: data/cities.csv -> data/cities.idx
+# Запуск: python build_city_index.py [cities.csv] [cities.idx]
+import csv
+import os
+import sys
+
+from bot import CITY_INDEX_HEADER, CITY_INDEX_MAGIC, CITY_INDEX_VERSION, CITY_KEY_RECORD, CITY_RECORD, \
+    city_name_variants
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+# Варианты без буквы строятся только для названий от трёх букв, иначе опечаток слишком много
+MIN_FUZZY_LENGTH = 3
+
+
+# Функция для чтения городов из CSV
+def read_cities(path):
+    with open(path, encoding='utf-8', newline='') as file:
+        cities = list(csv.DictReader(file))
+    # Крупные города первыми: при одинаковых названиях выигрывает самый крупный
+    cities.sort(key=lambda city: int(city['population_k']), reverse=True)
+    return cities
+
+
+# Функция для сборки файла справочника
+def build_index(cities):
+    strings = bytearray()
+    string_offsets = {}
+
+    # Функция для добавления строки в общую область строк (одинаковые строки хранятся один раз)
+    def add_string(text, terminated=False):
+        data = text.encode('utf-8') + (b'\0' if terminated else b'')
+        if data not in string_offsets:
+            string_offsets[data] = len(strings)
+            strings.extend(data)
+        return string_offsets[data]
+
+    city_records = []
+    keys = []
+    for number, city in enumerate(cities):
+        city_records.append(CITY_RECORD.pack(
+            float(city['lat']), float(city['lon']), int(city['population_k']),
+            add_string(city['name_ru'], terminated=True), add_string(city['name_en'], terminated=True),
+            city['country'].encode('ascii')))
+
+        names = [city['name_ru'], city['name_en']] + [alias for alias in city['aliases'].split(';') if alias]
+        variants = set()
+        for name in names:
+            variants |= city_name_variants(name)
+        keys.extend((variant.encode('utf-8'), number) for variant in variants if variant)
+
+    # Сортировка по байтам (как сравнивает CityIndex), при равных ключах - по номеру, то есть по населению
+    keys.sort()
+    deletes = []
+    for key_number, (key, _) in enumerate(keys):
+        text = key.decode('utf-8')
+        if len(text) >= MIN_FUZZY_LENGTH:
+            for variant in {text[:i] + text[i + 1:] for i in range(len(text))}:
+                deletes.append((variant.encode('utf-8'), key_number))
+    deletes.sort()
+
+    key_records = [CITY_KEY_RECORD.pack(add_string(key.decode('utf-8')), len(key), target) for key, target in keys]
+    delete_records = [CITY_KEY_RECORD.pack(add_string(key.decode('utf-8')), len(key), target)
+                      for key, target in deletes]
+
+    header = CITY_INDEX_HEADER.pack(CITY_INDEX_MAGIC, CITY_INDEX_VERSION, len(city_records), len(key_records),
+                                    len(delete_records))
+    return header + b''.join(city_records) + b''.join(key_records) + b''.join(delete_records) + bytes(strings)
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(DATA_DIR, 'cities.csv')
+    target = sys.argv[2] if len(sys.argv) > 2 else os.path.join(DATA_DIR, 'cities.idx')
+    cities = read_cities(source)
+    data = build_index(cities)
+    # Запись через временный файл: работающий бот не увидит наполовину записанный справочник
+    with open(target + '.tmp', 'wb') as file:
+        file.write(data)
+    os.replace(target + '.tmp', target)
+    print(f"Городов: {len(cities)}, размер справочника: {len(data) // 1024} КБ -> {target}")
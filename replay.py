@@ -0,0 +1,339 @@
+# Прогон записанного трафика: обновления из записи (TRAFFIC_RECORD_PATH в bot.py) подаются боту
+# через заглушки Telegram Bot API и OpenWeatherMap из benchmark.py, бот запускается на чистой базе.
+# Считаются пропускная способность и задержка первого ответа, ответы бота сохраняются по чатам,
+# чтобы сравнить их с прогоном другой сборки.
+#
+# Пример: запись на боевом боте, прогон в 10 раз быстрее и сравнение новой сборки со старой
+#   TRAFFIC_RECORD_PATH=traffic.jsonl python bot.py
+#   python replay.py traffic.jsonl --speed 10 --bot old/bot.py --calls-output old-calls.json
+#   python replay.py traffic.jsonl --speed 10 --baseline old-calls.json --output results.json
+#
+# --speed max подаёт каждое обновление сразу после ответа на предыдущее в том же чате.
+# Нажатия кнопок подаются по надписи кнопки; если такой кнопки у бота нет, нажатие пропускается.
+import argparse
+import itertools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+
+from benchmark import BOT_SCRIPT, FakeTelegram, FakeOpenWeatherMap, bot_environment, start_bot, stop_bot, \
+    summarize, write_results
+
+
+# Функция для чата, к которому относится обновление (для инлайн-запросов - пользователь)
+def update_chat_id(update):
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        query = update['callback_query']
+        return query['message']['chat']['id'] if 'message' in query else query['from']['id']
+    if 'inline_query' in update:
+        return update['inline_query']['from']['id']
+    return None
+
+
+# Функция для вида обновления (для задержек по видам)
+def update_kind(update):
+    return next((kind for kind in ('message', 'callback_query', 'inline_query') if kind in update), 'other')
+
+
+# Функция для чтения записи: (заголовок, chat_id -> [(время от начала, обновление)])
+def load_recording(path):
+    meta = {}
+    chats = {}
+    first_t = None
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry['type'] == 'meta':
+                meta = entry
+            elif entry['type'] == 'update':
+                chat_id = update_chat_id(entry['update'])
+                if chat_id is None:
+                    continue
+                if first_t is None:
+                    first_t = entry['t']
+                chats.setdefault(chat_id, []).append((entry['t'] - first_t, entry['update']))
+    return meta, chats
+
+
+# Функция для разбора JSON-параметра вызова (заглушка получает его строкой)
+def parse_json_param(value):
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+    return value
+
+
+# Функция для записи вызова бота в сравнимом виде: метод, текст и надписи кнопок
+# (callback_data зависит от базы, поэтому в сравнение не входит)
+def normalize_call(method, params):
+    entry = {'method': method}
+    if params.get('text'):
+        entry['text'] = params['text']
+    markup = parse_json_param(params.get('reply_markup'))
+    if isinstance(markup, dict):
+        if 'inline_keyboard' in markup:
+            entry['buttons'] = [button['text'] for row in markup['inline_keyboard'] for button in row]
+        if 'keyboard' in markup:
+            entry['keyboard'] = [button['text'] if isinstance(button, dict) else button
+                                 for row in markup['keyboard'] for button in row]
+    results = parse_json_param(params.get('results'))
+    if isinstance(results, list):
+        entry['results'] = [result.get('title') for result in results]
+    return entry
+
+
+# Прогон записи: в каждом чате обновления идут по порядку, следующее - не раньше записанного
+# времени (с учётом скорости) и только после того, как бот ответил на предыдущее
+class TrafficReplay:
+    # Через сколько после последнего ответа шаг считается завершённым
+    # (больше интервала между сообщениями одного чата при OUTBOUND_CHAT_RATE=1)
+    SETTLE = 1.2
+    # Сколько ждать ответа бота на обновление
+    STEP_TIMEOUT = 10
+    # Сколько ждать появления нужной кнопки, прежде чем нажать её по записанной callback_data
+    BUTTON_WAIT = 3
+
+    def __init__(self, telegram, chats, speed):
+        self.telegram = telegram
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.query_ids = itertools.count(1)
+        # chat_id -> состояние чата
+        self.state = {chat_id: {'events': deque(events), 'update_id': None, 'kind': None, 'sent_at': None,
+                                'delivered_at': None, 'first_reply_at': None, 'last_reply_at': None,
+                                'keyboard': {}, 'button_wait_since': None}
+                      for chat_id, events in chats.items()}
+        # id callback- и инлайн-запросов -> chat_id (ответы на них приходят без chat_id)
+        self.query_chats = {}
+        # chat_id -> вызовы бота в сравнимом виде
+        self.calls = {chat_id: [] for chat_id in chats}
+        self.latencies = {}
+        self.completed = 0
+        self.timeouts = 0
+        self.unresolved_buttons = 0
+        telegram.listeners.append(self.on_call)
+
+    def on_call(self, now, method, params):
+        with self.lock:
+            if method == 'getUpdates':
+                for update in params['updates']:
+                    chat = self.state.get(update_chat_id(update))
+                    if chat is not None and chat['update_id'] == update['update_id']:
+                        chat['delivered_at'] = now
+                return
+
+            query_id = params.get('callback_query_id') or params.get('inline_query_id')
+            if query_id:
+                chat_id = self.query_chats.get(query_id)
+            else:
+                try:
+                    chat_id = int(params.get('chat_id') or 0)
+                except ValueError:
+                    return
+            chat = self.state.get(chat_id)
+            if chat is None:
+                return
+
+            entry = normalize_call(method, params)
+            self.calls[chat_id].append(entry)
+            markup = parse_json_param(params.get('reply_markup'))
+            if isinstance(markup, dict) and 'inline_keyboard' in markup:
+                # Кнопки копятся: нажать можно и кнопку из более раннего сообщения
+                chat['keyboard'].update((button['text'], button.get('callback_data'))
+                                        for row in markup['inline_keyboard'] for button in row)
+
+            if chat['update_id'] is None:
+                return
+            if chat['first_reply_at'] is None:
+                chat['first_reply_at'] = now
+                self.latencies.setdefault(chat['kind'], []).append(now - (chat['delivered_at'] or chat['sent_at']))
+            chat['last_reply_at'] = now
+
+    # Подготовить записанное обновление к отправке: новые id запросов, текущая дата
+    # и callback_data кнопки с той же надписью из клавиатур бота в этом чате.
+    # Нажатие без такой кнопки не подаётся (None): записанная callback_data ссылается на записи
+    # другой базы и попала бы в чужие строки.
+    def prepare_update(self, chat_id, chat, update):
+        update = json.loads(json.dumps(update))
+        if 'message' in update:
+            update['message']['date'] = int(time.time())
+        elif 'callback_query' in update:
+            query = update['callback_query']
+            query['id'] = f'replay{next(self.query_ids)}'
+            self.query_chats[query['id']] = chat_id
+            if 'message' in query:
+                query['message']['date'] = int(time.time())
+            button = query.pop('button', None)
+            if button is None or button not in chat['keyboard']:
+                self.unresolved_buttons += 1
+                self.calls[chat_id].append({'method': 'skipped_press', 'text': button})
+                return None
+            query['data'] = chat['keyboard'][button]
+        elif 'inline_query' in update:
+            update['inline_query']['id'] = f'replay{next(self.query_ids)}'
+            self.query_chats[update['inline_query']['id']] = chat_id
+        return update
+
+    # Нажатие ждёт (не дольше BUTTON_WAIT), пока в клавиатурах бота не появится кнопка с той же надписью
+    def button_ready(self, chat, update, now):
+        button = update.get('callback_query', {}).get('button')
+        if button is None or button in chat['keyboard']:
+            return True
+        if chat['button_wait_since'] is None:
+            chat['button_wait_since'] = now
+        return now - chat['button_wait_since'] > self.BUTTON_WAIT
+
+    def send_next(self, chat_id, chat):
+        chat['button_wait_since'] = None
+        _, update = chat['events'].popleft()
+        update = self.prepare_update(chat_id, chat, update)
+        if update is None:
+            return
+        chat.update(kind=update_kind(update), sent_at=time.monotonic(), delivered_at=None, first_reply_at=None,
+                    last_reply_at=None)
+        chat['update_id'] = self.telegram.push_update(update)
+
+    # Возвращает True, когда все обновления поданы и обработаны
+    def step(self, started_at):
+        now = time.monotonic()
+        finished = True
+        with self.lock:
+            for chat_id, chat in self.state.items():
+                if chat['update_id'] is not None:
+                    if chat['last_reply_at'] is not None and now - chat['last_reply_at'] > self.SETTLE:
+                        self.completed += 1
+                    elif now - chat['sent_at'] > self.STEP_TIMEOUT:
+                        self.timeouts += 1
+                        self.calls[chat_id].append({'method': 'timeout'})
+                    else:
+                        finished = False
+                        continue
+                    chat['update_id'] = None
+                if chat['events']:
+                    finished = False
+                    due_at = started_at + chat['events'][0][0] / self.speed if self.speed else 0
+                    if now >= due_at and self.button_ready(chat, chat['events'][0][1], now):
+                        self.send_next(chat_id, chat)
+        return finished
+
+
+# Функция для сравнения вызовов двух прогонов по чатам. Цифры в сравнении не учитываются:
+# в ответах есть даты и время прогона.
+def compare_calls(baseline, current, limit=20):
+    def masked(entries):
+        return [re.sub(r'\d', '#', json.dumps(entry, ensure_ascii=False, sort_keys=True)) for entry in entries]
+
+    same = 0
+    differences = []
+    for chat_id in sorted(set(baseline) | set(current)):
+        before = masked(baseline.get(chat_id, []))
+        after = masked(current.get(chat_id, []))
+        if before == after:
+            same += 1
+            continue
+        index = next((index for index, (left, right) in enumerate(zip(before, after)) if left != right),
+                     min(len(before), len(after)))
+        differences.append({
+            'chat_id': chat_id,
+            'calls_before': len(before),
+            'calls_after': len(after),
+            'first_difference': index,
+            'before': baseline.get(chat_id, [])[index] if index < len(before) else None,
+            'after': current.get(chat_id, [])[index] if index < len(after) else None,
+        })
+    return {'chats_same': same, 'chats_different': len(differences), 'examples': differences[:limit]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Прогон записанного трафика бота погоды на локальных заглушках')
+    parser.add_argument('recording', help='запись трафика (JSONL из TRAFFIC_RECORD_PATH)')
+    parser.add_argument('--speed', default='1', help='ускорение относительно записи (1, 10, ...) или max')
+    parser.add_argument('--bot', default=BOT_SCRIPT, help='скрипт бота (другая сборка для сравнения)')
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='задержка заглушки Telegram, с')
+    parser.add_argument('--owm-latency', type=float, default=0.05, help='задержка заглушки OpenWeatherMap, с')
+    parser.add_argument('--calls-output', help='файл для вызовов бота по чатам (для --baseline другой сборки)')
+    parser.add_argument('--baseline', help='вызовы бота из прогона другой сборки (--calls-output)')
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    parser.add_argument('--bot-log', help='файл для вывода бота')
+    parser.add_argument('--env', action='append', default=[], help='дополнительные переменные бота NAME=VALUE')
+    args = parser.parse_args()
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    meta, chats = load_recording(args.recording)
+    if not chats:
+        print('В записи нет обновлений:', args.recording)
+        return
+
+    telegram = FakeTelegram(args.tg_latency)
+    weather = FakeOpenWeatherMap(args.owm_latency)
+    telegram_port = telegram.start()
+    weather_port = weather.start()
+
+    workdir = tempfile.mkdtemp(prefix='weather-bot-replay-')
+    env = bot_environment(telegram_port, weather_port, os.path.join(workdir, 'reminders.db'), args.runtime,
+                          args.env)
+    # Прогон не должен сам писать трафик
+    env.pop('TRAFFIC_RECORD_PATH', None)
+
+    replay = TrafficReplay(telegram, chats, speed)
+    bot_log = open(args.bot_log or os.path.join(workdir, 'bot.log'), 'w')
+    process = start_bot(env, workdir, bot_log, args.bot)
+    try:
+        if not telegram.polling.wait(60):
+            print('Бот не начал опрос за 60 с, см. лог', bot_log.name)
+            return
+        started_at = time.monotonic()
+        while not replay.step(started_at):
+            if process.poll() is not None:
+                print('Бот завершился раньше времени, см. лог', bot_log.name)
+                break
+            time.sleep(0.01)
+        elapsed = time.monotonic() - started_at
+    finally:
+        stop_bot(process)
+        bot_log.close()
+
+    updates = sum(len(events) for events in chats.values())
+    all_latencies = [value for values in replay.latencies.values() for value in values]
+    results = {
+        'config': vars(args),
+        'recording': {key: meta.get(key) for key in ('started', 'bot_version', 'runtime')},
+        'chats': len(chats),
+        'updates': updates,
+        'elapsed_s': round(elapsed, 2),
+        'updates_completed': replay.completed,
+        'updates_timed_out': replay.timeouts,
+        'unresolved_buttons': replay.unresolved_buttons,
+        'updates_per_s': round(replay.completed / elapsed, 2) if elapsed else None,
+        'latency': summarize(all_latencies),
+        'latency_by_kind': {kind: summarize(values) for kind, values in sorted(replay.latencies.items())},
+        'upstream': {
+            'telegram_calls': telegram.calls,
+            'weather_calls': weather.calls,
+        },
+    }
+
+    calls = {str(chat_id): entries for chat_id, entries in replay.calls.items()}
+    if args.calls_output:
+        with open(args.calls_output, 'w', encoding='utf-8') as output:
+            json.dump({'bot': args.bot, 'recording': args.recording, 'chats': calls}, output, ensure_ascii=False)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline:
+            results['comparison'] = compare_calls(json.load(baseline)['chats'], calls)
+
+    write_results(results, args.output)
+
+
+if __name__ == '__main__':
+    main()
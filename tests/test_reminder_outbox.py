@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+# Бот-заглушка: сообщения "доставляются" в пуле потоков
+class FakeBulkBot:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=8)
+
+    def queue_bulk_message(self, chat_id, *args, **kwargs):
+        return self.executor.submit(time.sleep, 0.001)
+
+
+def test_wave_rows_are_sent_when_wait_returns(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'DB_PATH', str(tmp_path / 'reminders.db'))
+    monkeypatch.setattr(bot.db_local, 'conn', None, raising=False)
+    monkeypatch.setattr(bot, 'bot', FakeBulkBot())
+    monkeypatch.setattr(bot, 'get_weather_info_batch', lambda cities: {city: ("☀️", None) for city in cities})
+    # Медленная запись результата: если она идёт в колбэке Future, flush её обгоняет
+    record = bot.ReminderOutboxWriter.record
+
+    def slow_record(self, row, error=None):
+        time.sleep(0.01)
+        record(self, row, error)
+
+    monkeypatch.setattr(bot.ReminderOutboxWriter, 'record', slow_record)
+    bot.init_database()
+
+    moment = datetime.now().replace(second=0, microsecond=0)
+    fire_at = int(moment.timestamp())
+    conn = bot.get_db()
+    conn.executemany('INSERT INTO reminder_outbox (reminder_id, fire_at, chat_id, city, shard) '
+                     'VALUES (?, ?, ?, ?, 0)',
+                     [(reminder_id, fire_at, 1000 + reminder_id, 'Москва') for reminder_id in range(50)])
+    conn.commit()
+
+    bot.send_shard_reminders(moment, {0})
+
+    states = conn.execute('SELECT state, COUNT(*) FROM reminder_outbox GROUP BY state').fetchall()
+    assert states == [('sent', 50)]